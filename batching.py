@@ -0,0 +1,142 @@
+"""
+Multi-invoice request batching for the extraction step.
+
+ExtractionBatcher collects up to `max_batch` invoices that reach the same tier within `linger`
+seconds and sends them as one multimodal request with an InvoiceBatch (list of GermanInvoice)
+structured output. Results are mapped back to each graph run by filename. Invoices missing from
+the batch answer, or a batch that fails validation, fall back to one request per invoice.
+
+Every request starts with the same fixed text (extraction prompt, then the batch rules) and the
+images come after it. Keeping that prefix byte-identical lets the provider's implicit prefix
+caching apply when the prompt is long enough.
+"""
+
+import asyncio
+import logging
+from langchain_core.messages import HumanMessage
+from orchestrator import GermanInvoice, get_tier_llms, get_batch_llm
+from llm_gateway import TransientLLMError
+from instrumentation import observe, inc
+
+logger = logging.getLogger(__name__)
+
+BATCH_INSTRUCTIONS = """
+    ### BATCH
+    This request contains several invoice images. Each image is preceded by a line "filename: <label>".
+    Extract every invoice independently and return exactly one entry per image in `invoices`,
+    with `filename` set to that image's label, in the order the images are given.
+    """
+
+# max_batch <= 1 disables batching
+batch_settings = {"max_batch": 1, "linger": 0.05}
+
+
+def configure_batching(max_batch=1, linger_ms=50):
+    batch_settings["max_batch"] = max_batch
+    batch_settings["linger"] = linger_ms / 1000.0
+    _batchers.clear()
+
+
+class ExtractionBatcher:
+    def __init__(self, tier, prompt, max_batch=8, linger=0.05):
+        self.tier = tier
+        self.prompt = prompt
+        self.max_batch = max_batch
+        self.linger = linger
+        self.llm = get_tier_llms()[tier]
+        self._pending = []  # (filename, image_b64, future)
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, filename, image_b64):
+        """Queues one invoice and waits for its GermanInvoice (raises what a single request would)."""
+        if any(name == filename for name, _, _ in self._pending):
+            self._flush()  # Labels must be unique within a request
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((filename, image_b64, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _message(self, batch):
+        content = [{"type": "text", "text": self.prompt + BATCH_INSTRUCTIONS}]
+        for filename, image_b64, _ in batch:
+            content.append({"type": "text", "text": f"filename: {filename}"})
+            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}})
+        return HumanMessage(content=content)
+
+    async def _single(self, filename, image_b64, future):
+        msg = HumanMessage(content=[
+            {"type": "text", "text": self.prompt},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+        ])
+        try:
+            result = await self.llm.ainvoke([msg])
+        except Exception as e:
+            _resolve(future, error=e)
+        else:
+            _resolve(future, result)
+
+    async def _run(self, batch):
+        observe("batch_size", len(batch), model=self.llm.name)
+        if len(batch) == 1:
+            await self._single(*batch[0])
+            return
+
+        by_name = {}
+        try:
+            result = await get_batch_llm(self.tier).ainvoke([self._message(batch)])
+            by_name = {item.filename: item for item in result.invoices}
+        except TransientLLMError as e:
+            # The API is down for everyone in the batch; single requests would fail the same way
+            for _, _, future in batch:
+                _resolve(future, error=e)
+            return
+        except Exception as e:
+            logger.warning(f"Batch of {len(batch)} failed validation, falling back to single requests: {e}")
+
+        fallback = []
+        for filename, image_b64, future in batch:
+            item = by_name.get(filename)
+            if item is None:
+                fallback.append((filename, image_b64, future))
+            else:
+                _resolve(future, GermanInvoice.model_validate(item.model_dump(exclude={"filename"})))
+        if fallback:
+            logger.info(f"{len(fallback)} of {len(batch)} invoices missing from the batch answer, sending them singly.")
+            inc("batch_fallback_total", len(fallback), model=self.llm.name)
+            await asyncio.gather(*(self._single(*item) for item in fallback))
+
+
+def _resolve(future, result=None, error=None):
+    if future.done():  # The graph run was cancelled meanwhile
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+_batchers = {}
+
+
+def get_batcher(tier, prompt):
+    """Batcher for `tier`, or None when batching is off. Rebuilt if the tiers were reconfigured."""
+    if batch_settings["max_batch"] <= 1:
+        return None
+    batcher = _batchers.get(tier)
+    if batcher is None or batcher.llm is not get_tier_llms()[tier]:
+        batcher = _batchers[tier] = ExtractionBatcher(tier, prompt, batch_settings["max_batch"], batch_settings["linger"])
+    return batcher
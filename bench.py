@@ -0,0 +1,272 @@
+"""
+Offline load test for the pipeline: the Gemini tiers are swapped for fake_llm.FakeChatModel,
+so a sweep costs no API quota. Every combination of --agents x --counts x --sizes runs the real
+decode pool, graph, sinks and review queue against synthetic invoice images.
+
+Per run it reports invoices/sec, peak RSS, event-loop lag and p50/p95/p99 invoice latency.
+
+    python bench.py --save benchmarks/baseline.json          # record a baseline
+    python bench.py --compare benchmarks/baseline.json       # exit 1 on regressions
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+# orchestrator builds the real Gemini clients at import; they are replaced before any call is made
+os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+
+import orchestrator
+from fake_llm import FakeChatModel
+from main import compile_workflow, iter_image_paths, run_pipeline
+from review_queue import configure_review_queue
+from extraction_cache import configure_cache
+from batching import configure_batching
+from llm_gateway import configure_hedging
+from log_setup import setup_logging
+from instrumentation import enable_metrics, get_metrics
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# Relative change that counts as a regression, per metric; higher_is_better decides the direction
+REGRESSION_CHECKS = {
+    "invoices_per_sec": True,
+    "p95_seconds": False,
+    "p99_seconds": False,
+    "loop_lag_p99_ms": False,
+    "peak_rss_mb": False,
+}
+
+
+def make_invoice_images(folder, count, size, seed=0):
+    """Writes `count` synthetic A4-ish invoices: text lines, a table grid and some noise so JPEG sizes are realistic."""
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    w, h = size
+    base = Image.effect_noise((w, h), 24).convert("RGB")
+    for i in range(count):
+        img = base.copy()
+        draw = ImageDraw.Draw(img)
+        for line in range(40):
+            y = int(h * (0.05 + line * 0.022))
+            draw.text((int(w * 0.08), y), f"Pos {line} Artikel {rng.randint(100, 999)}  {rng.uniform(1, 500):.2f} EUR", fill=(0, 0, 0))
+        for col in range(5):
+            x = int(w * (0.08 + col * 0.18))
+            draw.line((x, int(h * 0.5), x, int(h * 0.8)), fill=(0, 0, 0), width=2)
+        img.save(os.path.join(folder, f"bench_{i:05d}.jpg"), format="JPEG", quality=85)
+    return folder
+
+
+def _rss_mb():
+    # Current RSS from /proc when available; ru_maxrss (KB on Linux) is only a lifetime peak
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LoopMonitor:
+    """Samples event-loop lag (how late a fixed-interval sleep wakes up) and RSS while a run is going."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.peak_rss_mb = 0.0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+            self.peak_rss_mb = max(self.peak_rss_mb, _rss_mb())
+
+    def start(self):
+        self.peak_rss_mb = _rss_mb()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    def lag_ms(self):
+        ordered = sorted(self.lags) or [0.0]
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+        return {"loop_lag_p50_ms": round(pick(0.5), 3), "loop_lag_p99_ms": round(pick(0.99), 3),
+                "loop_lag_max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def configure_fake_tiers(fake_kwargs, tiers=2):
+    """Points every tier (and the field re-extraction clients) at a fake with the given settings."""
+    names = [f"fake-tier{i}" for i in range(tiers)]
+    return orchestrator.configure_tiers(names, chat_factory=lambda name: FakeChatModel(**fake_kwargs))
+
+
+async def _timed_run(app, folder, num_agents, output_file, decode_workers, deadline=None):
+    monitor = LoopMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    jobs = ((path, None) for path in iter_image_paths(folder))
+    try:
+        counts = await run_pipeline(app, jobs, num_agents, output_file, decode_workers=decode_workers, deadline=deadline)
+    finally:
+        await monitor.stop()
+    return counts, time.perf_counter() - started, monitor
+
+
+def run_case(workdir, image_dir, num_agents, count, fake_kwargs, decode_workers=None, max_retries=4, deadline=None):
+    """One benchmark run with fresh limiter, fakes, metrics and review queue. Returns a flat result dict."""
+    run_dir = tempfile.mkdtemp(dir=workdir)
+    orchestrator.limiter.configure(max_concurrency=num_agents)
+    for tier_llm in configure_fake_tiers(fake_kwargs):
+        tier_llm.retry.max_attempts = max_retries + 1
+    configure_cache(False)
+    configure_review_queue("sqlite", os.path.join(run_dir, "review_queue.db"))
+    enable_metrics()
+    app = compile_workflow()
+
+    counts, elapsed, monitor = asyncio.run(
+        _timed_run(app, image_dir, num_agents, os.path.join(run_dir, "approved.jsonl"), decode_workers, deadline)
+    )
+    llms = orchestrator.get_tier_llms()
+    latency = get_metrics().summary()["histograms"].get("invoice_seconds", {})
+    return {
+        "invoices": count,
+        "seconds": round(elapsed, 3),
+        "invoices_per_sec": round(count / elapsed, 3) if elapsed else 0.0,
+        "p50_seconds": round(latency.get("p50", 0.0), 4),
+        "p95_seconds": round(latency.get("p95", 0.0), 4),
+        "p99_seconds": round(latency.get("p99", 0.0), 4),
+        "peak_rss_mb": round(monitor.peak_rss_mb, 1),
+        "hedged_calls": sum(llm.hedges for llm in llms),
+        **monitor.lag_ms(),
+        **counts,
+    }
+
+
+def case_key(case):
+    return f"agents={case['num_agents']},count={case['count']},size={case['size']}"
+
+
+def run_sweep(agents, counts, sizes, fake_kwargs, decode_workers=None, workdir=None, deadline=None):
+    workdir = workdir or tempfile.mkdtemp(prefix="invoice_bench_")
+    results = {}
+    # Runs chdir into the scratch dir so agent outputs (review_queue.json etc.) never touch the repo
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for size, count in itertools.product(sizes, counts):
+            image_dir = make_invoice_images(os.path.join(workdir, f"images_{size}_{count}"), count, _parse_size(size))
+            for num_agents in agents:
+                case = {"num_agents": num_agents, "count": count, "size": size}
+                result = run_case(workdir, image_dir, num_agents, count, fake_kwargs, decode_workers, deadline=deadline)
+                results[case_key(case)] = {**case, **result}
+                print(f"{case_key(case):40s} {result['invoices_per_sec']:8.2f} inv/s | p99 {result['p99_seconds']:.3f}s "
+                      f"| loop lag p99 {result['loop_lag_p99_ms']:.1f}ms | peak RSS {result['peak_rss_mb']:.0f}MB")
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def _parse_size(size):
+    w, h = size.lower().split("x")
+    return int(w), int(h)
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of human-readable regressions of `results` against `baseline` (same case keys only)."""
+    regressions = []
+    for key, base in baseline.get("cases", {}).items():
+        current = results.get(key)
+        if current is None:
+            continue
+        for metric, higher_is_better in REGRESSION_CHECKS.items():
+            old, new = base.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{key}: {metric} {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def _csv(value, cast):
+    return [cast(v) for v in value.split(",") if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark with a fake Gemini client")
+    parser.add_argument("--agents", type=str, default="1,8,32", help="Comma-separated --num_agents values")
+    parser.add_argument("--counts", type=str, default="100", help="Comma-separated numbers of invoices per run")
+    parser.add_argument("--sizes", type=str, default="1240x1754,2480x3508", help="Comma-separated image sizes (WxH)")
+    parser.add_argument("--decode_workers", type=int, default=None, help="Decode processes (default: CPU count)")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean fake model latency in seconds")
+    parser.add_argument("--latency_dist", choices=["fixed", "exp", "lognormal"], default="lognormal")
+    parser.add_argument("--latency_sigma", type=float, default=0.6, help="Spread of the lognormal latency")
+    parser.add_argument("--error_rate", type=float, default=0.01, help="Probability of a 503 per call")
+    parser.add_argument("--throttle_rate", type=float, default=0.02, help="Probability of a 429 per call")
+    parser.add_argument("--low_conf_rate", type=float, default=0.1, help="Share of extractions with low-confidence critical fields")
+    parser.add_argument("--batch_size", type=int, default=1, help="Invoices per model request (1 disables batching)")
+    parser.add_argument("--batch_linger_ms", type=float, default=50)
+    parser.add_argument("--deadline", type=float, default=None, help="Per-invoice deadline in seconds")
+    parser.add_argument("--hedge_max_ratio", type=float, default=0.0, help="Max share of hedged model calls (0 disables)")
+    parser.add_argument("--hedge_quantile", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", type=str, default=None, help="Write results as a JSON baseline")
+    parser.add_argument("--compare", type=str, default=None, help="Baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative change before a regression")
+    args = parser.parse_args()
+
+    setup_logging(level=logging.WARNING)
+    configure_batching(args.batch_size, args.batch_linger_ms)
+    configure_hedging(args.hedge_max_ratio, args.hedge_quantile)
+
+    fake_kwargs = {
+        "latency": args.latency, "latency_dist": args.latency_dist, "latency_sigma": args.latency_sigma,
+        "error_rate": args.error_rate, "throttle_rate": args.throttle_rate,
+        "low_conf_rate": args.low_conf_rate, "seed": args.seed,
+    }
+    results = run_sweep(_csv(args.agents, int), _csv(args.counts, int), _csv(args.sizes, str), fake_kwargs,
+                        decode_workers=args.decode_workers, deadline=args.deadline)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "fake_llm": fake_kwargs,
+        "batching": {"batch_size": args.batch_size, "linger_ms": args.batch_linger_ms},
+        "tail": {"deadline": args.deadline, "hedge_max_ratio": args.hedge_max_ratio, "hedge_quantile": args.hedge_quantile},
+        "cases": results,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("fake_llm") != fake_kwargs:
+            print("Warning: fake client settings differ from the baseline's")
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions against {args.compare}")
@@ -0,0 +1,101 @@
+"""
+Image handles for the graph state.
+
+AgentState carries `image_ref` instead of the image itself: either a file path (files that
+can be sent to the model as they are) or a "blob:<n>" key into an in-memory store holding
+normalised or dataset-supplied JPEG bytes. Nodes that call the model load the bytes with
+load_image_b64()/load_image_bytes() and drop them when they return; the worker releases the
+blob once the invoice has left the graph, so resident image memory tracks in-flight invoices.
+PDFs (see pdf_prep) also carry `document_pages`: per page, the blob key of its rendering
+and/or its text layer.
+"""
+
+import asyncio
+import base64
+import itertools
+
+BLOB_PREFIX = "blob:"
+
+
+class BlobStore:
+    def __init__(self):
+        self._blobs = {}
+        self._ids = itertools.count()
+
+    def put(self, data):
+        ref = f"{BLOB_PREFIX}{next(self._ids)}"
+        self._blobs[ref] = bytes(data)
+        return ref
+
+    def get(self, ref):
+        return self._blobs[ref]
+
+    def release(self, ref):
+        self._blobs.pop(ref, None)
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def nbytes(self):
+        return sum(len(b) for b in self._blobs.values())
+
+
+_store = BlobStore()
+
+
+def get_blob_store():
+    return _store
+
+
+def register_image(payload, source):
+    """
+    Turns a prepare_image() or prepare_pdf() payload into graph inputs. Normalised bytes and
+    pass-through dataset bytes go into the blob store; pass-through files are referenced by path
+    and read later. `image_ref` of a PDF is its first rendered page (None if all pages are text).
+    """
+    inputs = {"image_path": payload["image_path"], "image_sha256": payload["image_sha256"]}
+    if "pages" in payload:
+        inputs["document_pages"] = [
+            {"page": p["page"], "text": p["text"], "ref": _store.put(p["image_bytes"]) if p["image_bytes"] is not None else None}
+            for p in payload["pages"]
+        ]
+        inputs["image_ref"] = next((p["ref"] for p in inputs["document_pages"] if p["ref"] is not None), None)
+    elif payload.get("image_bytes") is not None:
+        inputs["image_ref"] = _store.put(payload["image_bytes"])
+    elif isinstance(source, (bytes, bytearray)):
+        inputs["image_ref"] = _store.put(source)
+    else:
+        inputs["image_ref"] = source
+    if payload.get("image_dhash") is not None:
+        inputs["image_dhash"] = payload["image_dhash"]
+    return inputs
+
+
+def release_image(ref):
+    if ref and ref.startswith(BLOB_PREFIX):
+        _store.release(ref)
+
+
+def release_inputs(inputs):
+    """Drops every blob a set of graph inputs references, once the invoice has left the graph."""
+    release_image(inputs.get("image_ref"))
+    for page in inputs.get("document_pages") or ():
+        release_image(page["ref"])
+
+
+def _read(ref):
+    if ref.startswith(BLOB_PREFIX):
+        return _store.get(ref)
+    with open(ref, "rb") as f:
+        return f.read()
+
+
+async def load_image_bytes(ref):
+    if ref.startswith(BLOB_PREFIX):
+        return _store.get(ref)
+    return await asyncio.to_thread(_read, ref)
+
+
+async def load_image_b64(ref):
+    """Base64 payload for the model, built off the event loop."""
+    return await asyncio.to_thread(lambda: base64.b64encode(_read(ref)).decode("ascii"))
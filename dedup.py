@@ -0,0 +1,256 @@
+"""
+Duplicate detection for approved invoices.
+
+Two persistent indexes in one SQLite file:
+- images: two difference hashes (dHash) per processed image. Gradients between neighbouring
+  cells below FLAT_LEVELS count as "flat" rather than taking a sign, because blank paper would
+  otherwise flip bits on every re-encode. Each row of the fine 32x32 hash is a band, stored in
+  an indexed table; any hash within distance <= BANDS - 1 shares at least one row exactly
+  (pigeonhole), which is why max_distance is capped there. Invoices from one template share
+  their blank, letterhead and footer rows, so a row value held by more than COMMON_BAND_IMAGES
+  images is skipped: a lookup only fetches images that share a row of actual content, and reads
+  at most BANDS * COMMON_BAND_IMAGES index entries.
+  A whole-page hash cannot tell invoices of one template apart: pages differing only in number
+  and amounts can be closer than a resized copy of one page. An image match is therefore only a
+  candidate. It makes the invoice a duplicate once the audit has approved it and its invoice
+  number and total amount equal those of the approved candidate.
+- business_keys: invoice_number + iban + total_amount of every approved extraction, catching
+  the same invoice arriving as a different document (e.g. the PDF and a photo of it). It is
+  only checked once the new extraction has passed the audit as well, and only built when the
+  IBAN (the vendor identifier GermanInvoice extracts) is present: number and amount alone
+  repeat across vendors.
+
+Lookups skip entries recorded under the same filename, so a file that is processed again
+(--resume after a crash, --watch) never duplicates itself.
+"""
+
+import io
+import re
+import sqlite3
+import time
+import logging
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "dedup_index.db"
+COARSE_SIZE = 8
+FINE_SIZE = 32
+BANDS = FINE_SIZE  # One band per row of the fine hash
+COMMON_BAND_IMAGES = 64  # A row shared by more images is layout, not content, and is not looked up
+COARSE_DISTANCE = 3
+FINE_BYTES = FINE_SIZE * FINE_SIZE // 8
+FLAT_LEVELS = {COARSE_SIZE: 4, FINE_SIZE: 2}  # Gray levels under which a gradient counts as flat
+DEFAULT_MAX_DISTANCE = FINE_SIZE - 1  # Cells (of 1024) whose fine gradient differs; the most the bands can find
+
+
+def _dhash(img, size):
+    """(falling, significant) bitmasks: cells darker than their right neighbour, cells that are not flat."""
+    pixels = img.resize((size + 1, size), Image.LANCZOS).tobytes()
+    flat = FLAT_LEVELS[size]
+    falling = significant = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            diff = pixels[offset + col] - pixels[offset + col + 1]
+            falling = (falling << 1) | (diff > flat)
+            significant = (significant << 1) | (abs(diff) > flat)
+    return falling, significant
+
+
+def dhash_image(img):
+    """(coarse 64-bit hash, fine 32x32 gradient masks) of a decoded, upright image."""
+    img = img.convert("L")
+    return _dhash(img, COARSE_SIZE)[0], _dhash(img, FINE_SIZE)
+
+
+def dhash(raw):
+    """dhash_image() of image bytes."""
+    with Image.open(io.BytesIO(raw)) as img:
+        img.draft("L", (FINE_SIZE * 4, FINE_SIZE * 4))  # JPEGs decode at a fraction of full size
+        return dhash_image(ImageOps.exif_transpose(img))
+
+
+def fine_distance(a, b):
+    """Cells whose gradient is falling/rising/flat in one hash and something else in the other."""
+    (falling_a, significant_a), (falling_b, significant_b) = a, b
+    return ((significant_a ^ significant_b) | (falling_a ^ falling_b)).bit_count()
+
+
+def _pack(fine):
+    return b"".join(mask.to_bytes(FINE_BYTES, "big") for mask in fine)
+
+
+def _unpack(blob):
+    return int.from_bytes(blob[:FINE_BYTES], "big"), int.from_bytes(blob[FINE_BYTES:], "big")
+
+
+def _signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _bands(fine):
+    """(row, value) of each fine-hash row that is not entirely flat; value packs both 32-cell masks."""
+    falling, significant = fine
+    mask = (1 << FINE_SIZE) - 1
+    bands = []
+    for row in range(BANDS):
+        shift = row * FINE_SIZE
+        row_significant = (significant >> shift) & mask
+        if row_significant:
+            bands.append((row, _signed((row_significant << FINE_SIZE) | ((falling >> shift) & mask))))
+    return bands
+
+
+_NON_ALNUM_RE = re.compile(r"[^A-Z0-9]")
+
+
+def invoice_identity(extraction):
+    """Normalised invoice_number|total_amount, or None when either is missing."""
+    number = extraction.invoice_number.value
+    amount = extraction.total_amount.value
+    if number in (None, "") or amount in (None, ""):
+        return None
+    try:
+        amount = f"{float(amount):.2f}"
+    except (TypeError, ValueError):
+        amount = _NON_ALNUM_RE.sub("", str(amount).upper())
+    return f"{_NON_ALNUM_RE.sub('', str(number).upper())}|{amount}"
+
+
+def business_key(extraction):
+    """Normalised invoice_number|iban|total_amount, or None when number, IBAN or amount is missing."""
+    identity = invoice_identity(extraction)
+    iban = _NON_ALNUM_RE.sub("", str(extraction.iban.value or "").upper())
+    if identity is None or not iban:
+        return None
+    number, amount = identity.split("|")
+    return f"{number}|{iban}|{amount}"
+
+
+class DedupIndex:
+    """`max_distance` is the fine-hash distance under which two images count as duplicates."""
+
+    def __init__(self, path=DEFAULT_PATH, max_distance=DEFAULT_MAX_DISTANCE):
+        if not 0 <= max_distance < BANDS:
+            raise ValueError(f"max_distance must be between 0 and {BANDS - 1}, the most the band lookup can find")
+        self.path = path
+        self.max_distance = max_distance
+        self.hits = {"image": 0, "business_key": 0}
+
+        self._conn = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dhash INTEGER NOT NULL,
+                fine BLOB NOT NULL,
+                filename TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                extraction TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_bands (
+                band INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                image_id INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_image_bands ON image_bands(band, value)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS business_keys (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                extraction TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+
+    def _candidates(self, fine):
+        """Ids of images sharing a content row (one held by at most COMMON_BAND_IMAGES images) with `fine`."""
+        ids = set()
+        for band, value in _bands(fine):
+            rows = self._conn.execute(
+                "SELECT image_id FROM image_bands WHERE band = ? AND value = ? LIMIT ?",
+                (band, value, COMMON_BAND_IMAGES + 1),
+            ).fetchall()
+            if len(rows) <= COMMON_BAND_IMAGES:
+                ids.update(image_id for (image_id,) in rows)
+        return ids
+
+    def find_image(self, hashes, exclude=None):
+        """
+        Closest earlier image within max_distance, other than one named `exclude`, as
+        (filename, outcome, extraction_json), or None. Only a candidate, see the module docstring.
+        """
+        coarse, fine = hashes
+        ids = self._candidates(fine)
+        best = None
+        if ids:
+            query = (f"SELECT dhash, fine, filename, outcome, extraction FROM images "
+                     f"WHERE id IN ({', '.join('?' * len(ids))}) AND filename != ?")
+            for stored, stored_fine, filename, outcome, extraction in self._conn.execute(query, (*ids, exclude or "")):
+                if ((stored & 0xFFFFFFFFFFFFFFFF) ^ coarse).bit_count() > COARSE_DISTANCE:
+                    continue
+                distance = fine_distance(_unpack(stored_fine), fine)
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, filename, outcome, extraction)
+        return best[1:] if best is not None else None
+
+    def find_key(self, key, exclude=None):
+        """Earlier approved invoice with this business key, other than `exclude`, as (filename, outcome, extraction_json)."""
+        return self._conn.execute(
+            "SELECT filename, outcome, extraction FROM business_keys WHERE key = ? AND filename != ?", (key, exclude or "")
+        ).fetchone()
+
+    def remember(self, filename, outcome, extraction=None, hashes=None):
+        """Records a finished invoice under its image hashes and, if approved and complete, its business key."""
+        payload = extraction.model_dump_json() if extraction is not None else None
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if hashes is not None:
+                coarse, fine = hashes
+                image_id = self._conn.execute(
+                    "INSERT INTO images (dhash, fine, filename, outcome, extraction, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (_signed(coarse), _pack(fine), filename, outcome, payload, now),
+                ).lastrowid
+                self._conn.executemany(
+                    "INSERT INTO image_bands (band, value, image_id) VALUES (?, ?, ?)",
+                    [(band, value, image_id) for band, value in _bands(fine)],
+                )
+            # Flagged extractions are unverified, so they never make a later invoice a duplicate
+            key = business_key(extraction) if extraction is not None and outcome == "pass" else None
+            if key is not None:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO business_keys (key, filename, outcome, extraction, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, filename, outcome, payload, now),
+                )
+
+    def stats(self):
+        return (f"Duplicates: {self.hits['image']} by image hash + invoice number/amount | "
+                f"{self.hits['business_key']} by invoice number/IBAN/amount")
+
+    def close(self):
+        self._conn.close()
+
+
+_index = None
+
+
+def configure_dedup(enabled=True, path=DEFAULT_PATH, max_distance=DEFAULT_MAX_DISTANCE):
+    """Enables/disables duplicate detection. Call before the workflow runs."""
+    global _index
+    if _index is not None:
+        _index.close()
+    _index = DedupIndex(path, max_distance) if enabled else None
+    return _index
+
+
+def get_dedup_index():
+    return _index
@@ -6,79 +6,16 @@ Note: This is not finished as it was requiring a lot of time to figure out the r
 import json
 import re
 from Levenshtein import ratio
+from gt_converter import convert_gt as convert_gt_vectorized, build_ground_truth
 
 
 # --- 1. THE CONVERTER (Ground Truth Parsing) ---
 def convert_gt(gt_data):
     """
     Parses the complex 'gt_parse' structure into a clean key-value dict.
-    Reconstructs text by finding words inside label bounding boxes.
+    Reconstructs text by finding words inside label bounding boxes (see gt_converter.py).
     """
-    # 1. Safety check: Ensure we have the 'gt_parse' root
-    parse = gt_data.get('gt_parse', gt_data)  # Handle if passed directly or wrapped
-
-    # 2. Map all transcription words to their coordinates
-    words = []
-    transcriptions = parse.get('transcription', [])
-    bboxes = parse.get('bbox', [])
-
-    # Zip them together for easy lookup
-    for text, box in zip(transcriptions, bboxes):
-        words.append({
-            'text': text,
-            'x': box['x'], 'y': box['y'],
-            'w': box['width'], 'h': box['height'],
-            # Calculate center point for collision detection
-            'cx': box['x'] + (box['width'] / 2),
-            'cy': box['y'] + (box['height'] / 2)
-        })
-
-    # 3. Define the Mapping: Dataset Label -> Your Schema Key
-    label_map = {
-        "nam of the company": "company_name",
-        "address of the company": "company_address",
-        "address of the customer": "vendor_name",  # Adapting to your schema usage
-        "telephone number": "phone_number",
-        "date": "invoice_date",
-        "sum": "total_amount",
-        "IBAN": "iban",
-        "invoice_id": "invoice_number",
-        "invoice_no": "invoice_number"
-    }
-
-    cleaned_gt = {}
-
-    # 4. Iterate through labeled regions to find text
-    labels = parse.get('label', [])
-    for lbl in labels:
-        # Get the raw label name (e.g., "sum")
-        raw_label = lbl['labels'][0]
-        target_key = label_map.get(raw_label)
-
-        # Only process if this is a field we care about
-        if target_key:
-            # Label Geometry
-            lx, ly = lbl['x'], lbl['y']
-            lw, lh = lbl['width'], lbl['height']
-
-            # Find words whose CENTER point is inside the label box
-            # (Adding a tiny buffer can help with edge cases)
-            matched_words = []
-            for w in words:
-                if (lx <= w['cx'] <= lx + lw) and (ly <= w['cy'] <= ly + lh):
-                    matched_words.append(w)
-
-            # Sort words to reconstruct reading order: Top-to-Bottom, then Left-to-Right
-            matched_words.sort(key=lambda k: (int(k['y']), int(k['x'])))
-
-            # Join them
-            full_text = " ".join([w['text'] for w in matched_words])
-
-            # Store it (Overwrite if multiple boxes exist for same key, or append?)
-            # Usually overwrite or append is fine. Here we overwrite.
-            cleaned_gt[target_key] = full_text
-
-    return cleaned_gt
+    return convert_gt_vectorized(gt_data)
 
 
 # --- 2. THE EVALUATOR (Scoring) ---
@@ -128,117 +65,230 @@ def evaluate_invoice(prediction, ground_truth, log_func=print):
     return report
 
 
+_NON_ALNUM_RE = re.compile(r'[^a-z0-9]')
+
+
 def normalize_string(s):
     """Simple cleaner: lowercase and alphanumeric only"""
     if not s: return ""
-    return re.sub(r'[^a-z0-9]', '', s.lower())
+    return _NON_ALNUM_RE.sub('', s.lower())
+
+
+# --- 3. BATCH METRICS ---
+FIELDS_TO_CHECK = [
+    "company_name", "invoice_number", "invoice_date",
+    "total_amount", "iban", "vendor_name", "company_address"
+]
+NUMERIC_FIELDS = {"total_amount"}
+DATE_FIELDS = {"invoice_date", "due_date"}
+METRICS = ["levenshtein", "exact", "numeric", "date"]
+
+_NUMBER_RE = re.compile(r'[-+]?\d[\d.,\s]*')
+_DATE_PATTERNS = [
+    (re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})'), ("y", "m", "d")),
+    (re.compile(r'(\d{1,2})[./](\d{1,2})[./](\d{4})'), ("d", "m", "y")),
+    (re.compile(r'(\d{1,2})[./](\d{1,2})[./](\d{2})(?!\d)'), ("d", "m", "y")),
+]
+
+
+def parse_amount(s):
+    """Parses German ("1.050,50") and plain ("1050.5") amounts; None if there is no number."""
+    if s is None:
+        return None
+    if isinstance(s, (int, float)):
+        return float(s)
+    match = _NUMBER_RE.search(str(s))
+    if not match:
+        return None
+    num = re.sub(r'\s', '', match.group()).rstrip('.,')
+    if ',' in num and '.' in num:
+        # Whichever separator comes last is the decimal one
+        if num.rfind(',') > num.rfind('.'):
+            num = num.replace('.', '').replace(',', '.')
+        else:
+            num = num.replace(',', '')
+    elif ',' in num:
+        head, _, tail = num.rpartition(',')
+        num = f"{head.replace(',', '')}.{tail}" if len(tail) <= 2 else num.replace(',', '')
+    elif num.count('.') > 1 or re.fullmatch(r'[-+]?\d{1,3}\.\d{3}', num):
+        num = num.replace('.', '')  # German thousands separators
+    try:
+        return float(num)
+    except ValueError:
+        return None
+
+
+def normalize_date(s):
+    """Returns an ISO YYYY-MM-DD string for the first date found, or None."""
+    if s is None:
+        return None
+    for pattern, order in _DATE_PATTERNS:
+        match = pattern.search(str(s))
+        if match:
+            parts = dict(zip(order, (int(g) for g in match.groups())))
+            year = parts["y"] + 2000 if parts["y"] < 100 else parts["y"]
+            if 1 <= parts["m"] <= 12 and 1 <= parts["d"] <= 31:
+                return f"{year:04d}-{parts['m']:02d}-{parts['d']:02d}"
+    return None
+
+
+def score_field(field, pred_val, gt_val, amount_tolerance=0.01):
+    """All metrics for one field; None where a metric does not apply or cannot be computed."""
+    s1 = normalize_string(str(pred_val)) if pred_val is not None else ""
+    s2 = normalize_string(str(gt_val))
+    scores = {"levenshtein": round(ratio(s1, s2), 4), "exact": float(s1 == s2), "numeric": None, "date": None}
+
+    if field in NUMERIC_FIELDS:
+        p, g = parse_amount(pred_val), parse_amount(gt_val)
+        if g is not None:
+            scores["numeric"] = float(p is not None and abs(p - g) <= max(amount_tolerance, 0.005 * abs(g)))
+    if field in DATE_FIELDS:
+        p, g = normalize_date(pred_val), normalize_date(gt_val)
+        if g is not None:
+            scores["date"] = float(p == g)
+    return scores
+
+
+def flatten_prediction(pred_raw):
+    """{key: {value: "val", ...}} -> {key: "val"}"""
+    return {k: v["value"] if isinstance(v, dict) and "value" in v else v for k, v in pred_raw.items()}
+
+
+METRICS_COLUMNS = ["filename", "field", "prediction", "ground_truth"] + METRICS
+
+
+def _score_chunk(pairs):
+    """Worker: scores (filename, flat_prediction, ground_truth) tuples into METRICS_COLUMNS rows."""
+    rows = []
+    for filename, pred, gt in pairs:
+        for field in FIELDS_TO_CHECK:
+            gt_val = gt.get(field)
+            if gt_val is None:
+                continue  # Missing GT: nothing to score
+            pred_val = pred.get(field)
+            scores = score_field(field, pred_val, gt_val)
+            rows.append((filename, field, pred_val, gt_val, *(scores[m] for m in METRICS)))
+    return rows
+
 
 from datasets import load_dataset
+import csv
 import json
-from main import compile_workflow, main
-import asyncio
-import io
+from concurrent.futures import ProcessPoolExecutor
+from result_sink import load_results
+from gt_converter import load_ground_truth
+import argparse
 import os
-import time
+import sys
 
 DATASET_ID = "Aoschu/German_invoices_dataset_for_donut"
-def clear_gt():
-    output_file = "cleaned_ground_truth.json"
-    all_data = []
-
-    # Load existing data to prevent overwriting
-    if os.path.exists(output_file):
-        try:
-            with open(output_file, "r") as f:
-                all_data = json.load(f)
-        except (json.JSONDecodeError, OSError):
-            pass  # Start fresh if file is corrupt or empty
-
+def clear_gt(output_file="cleaned_ground_truth.jsonl", workers=None):
+    """Regenerates the ground truth from scratch, one record per invoice keyed by OCR filename."""
     dataset = load_dataset(DATASET_ID)
     train_data = dataset['train']
-    for i in range(len(train_data)):
+    count = build_ground_truth(train_data['ground_truth'], output_file, workers)
+    print(f"Wrote {count} ground-truth records to {output_file}")
 
-        gt = json.loads(train_data[i]['ground_truth'])
-        cleaned_data = convert_gt(gt)
-        all_data.append(cleaned_data)
 
-    with open(output_file, "w") as f:
-        json.dump(all_data, f, indent=2)
-
-
-def run_evaluation():
-    pred_file = "approved_invoices_donut.json"
-    gt_file = "cleaned_ground_truth.json"
+def run_evaluation(pred_file=None, gt_file=None, workers=None, chunk_size=2000,
+                   report_file="evaluation_report.txt", metrics_file="evaluation_metrics.csv", min_join_rate=0.5):
+    """
+    Joins predictions and ground truth on filename, scores every field with all metrics in a
+    worker pool, and writes a per-file/per-field metrics table plus a summary report.
+    Returns the metrics rows (METRICS_COLUMNS tuples), or None if the inputs are missing or fewer
+    than `min_join_rate` of the predictions have a ground truth. The previous report and metrics
+    files are then left as they are.
+    """
+    # Prefer the streaming sink output / regenerated GT, fall back to exported/legacy files
+    pred_file = pred_file or next((p for p in ("approved_invoices_donut.jsonl", "approved_invoices_donut.json") if os.path.exists(p)), None)
+    gt_file = gt_file or next((p for p in ("cleaned_ground_truth.jsonl", "cleaned_ground_truth.parquet", "cleaned_ground_truth.json") if os.path.exists(p)), None)
 
-    if not os.path.exists(pred_file) or not os.path.exists(gt_file):
+    if not pred_file or not gt_file:
         print(f"Files not found: {pred_file} or {gt_file}")
         return
 
-    with open(pred_file, "r") as f:
-        predictions = json.load(f)
-
-    with open(gt_file, "r") as f:
-        ground_truths = json.load(f)
+    # Latest prediction per filename (re-runs append to the sink)
+    predictions = {p["filename"]: flatten_prediction(p) for p in load_results(pred_file) if p.get("filename")}
+    ground_truths = load_ground_truth(gt_file)
+
+    matched = [name for name in predictions if name in ground_truths]
+    missing_gt = len(predictions) - len(matched)
+    print(f"Joined {len(matched)} of {len(predictions)} predictions on filename with {len(ground_truths)} ground truths.")
+    if not matched or len(matched) < min_join_rate * len(predictions):
+        # A join on mismatched filenames would score nothing and overwrite the last real report
+        print(f"Not enough predictions match the ground truth (need {min_join_rate:.0%}); "
+              f"check that {pred_file} and {gt_file} use the same filenames. No report written.")
+        if not ground_truths:
+            print("Ground truth has no filename keys; regenerate it with: python gt_converter.py")
+        return None
+    pairs = [(name, predictions[name], ground_truths[name]) for name in matched]
+
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    if len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = [row for chunk_rows in pool.map(_score_chunk, chunks) for row in chunk_rows]
+    else:
+        rows = _score_chunk(pairs)
+
+    with open(metrics_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(METRICS_COLUMNS)
+        writer.writerows(rows)
+
+    # Per-field averages of every metric, skipping metrics that do not apply
+    totals = {}
+    first_metric = len(METRICS_COLUMNS) - len(METRICS)
+    for row in rows:
+        field_totals = totals.setdefault(row[1], {m: [0.0, 0] for m in METRICS})
+        for m, value in zip(METRICS, row[first_metric:]):
+            if value is not None:
+                field_totals[m][0] += value
+                field_totals[m][1] += 1
 
-    report_file = "evaluation_report.txt"
     with open(report_file, "w") as f:
         def log(msg):
             print(msg)
             f.write(msg + "\n")
 
-        log(f"Loaded {len(predictions)} predictions and {len(ground_truths)} ground truths.")
-
-        # Accumulators for average calculation
-        field_scores = {}
-        field_counts = {}
-
-        # We assume index alignment since GT has no filename keys
-        num_items = min(len(predictions), len(ground_truths))
-
-        for i in range(num_items):
-            pred_raw = predictions[i]
-            gt_row = ground_truths[i]
-
-            # Flatten the prediction dictionary: {key: {value: "val", ...}} -> {key: "val"}
-            pred_flat = {}
-            for key, val in pred_raw.items():
-                if isinstance(val, dict) and "value" in val:
-                    pred_flat[key] = val["value"]
+        log(f"Loaded {len(predictions)} predictions and {len(ground_truths)} ground truths from {pred_file} / {gt_file}.")
+        log(f"Joined {len(matched)} on filename; {missing_gt} predictions have no ground truth.")
+
+        header = f"{'FIELD':<20} | {'SAMPLES':<8} | " + " | ".join(f"{m.upper():<11}" for m in METRICS)
+        log("\n" + "=" * len(header))
+        log(header)
+        log("=" * len(header))
+
+        averages = {m: [] for m in METRICS}
+        for field in sorted(totals):
+            cells = []
+            for m in METRICS:
+                total, count = totals[field][m]
+                if count:
+                    averages[m].append(total / count)
+                    cells.append(f"{total / count:<11.2f}")
                 else:
-                    pred_flat[key] = val
-
-            log(f"\n--- Evaluation for Item {i} ---")
-            if 'filename' in pred_flat:
-                log(f"Filename: {pred_flat['filename']}")
+                    cells.append(f"{'-':<11}")
+            log(f"{field:<20} | {totals[field]['levenshtein'][1]:<8} | " + " | ".join(cells))
 
-            # Use the existing evaluate_invoice function
-            report = evaluate_invoice(pred_flat, gt_row, log_func=log)
+        log("-" * len(header))
+        macro = " | ".join(f"{sum(v) / len(v):<11.2f}" if v else f"{'-':<11}" for v in averages.values())
+        log(f"{'GLOBAL SCORE':<20} | {'(Macro)':<8} | {macro}")
+        log("=" * len(header))
+        log(f"Per-file metrics written to {metrics_file}")
 
-            # Aggregate scores
-            for field, score in report.items():
-                if score is not None:
-                    field_scores[field] = field_scores.get(field, 0.0) + score
-                    field_counts[field] = field_counts.get(field, 0) + 1
-
-        log("\n" + "=" * 55)
-        log(f"{'FIELD':<20} | {'SAMPLES':<10} | {'AVG SCORE':<10}")
-        log("=" * 55)
-
-        field_averages = []
-
-        for field in sorted(field_scores.keys()):
-            count = field_counts[field]
-            avg = field_scores[field] / count
-            log(f"{field:<20} | {count:<10} | {avg:.2f}")
-            field_averages.append(avg)
-
-        log("-" * 55)
-        if field_averages:
-            global_score = sum(field_averages) / len(field_averages)
-            log(f"{'GLOBAL SCORE':<20} | {'(Macro)':<10} | {global_score:.2f}")
-        log("=" * 55)
+    return rows
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score predictions against the ground truth")
+    parser.add_argument("--predictions", type=str, default=None, help="JSONL/JSON predictions (default: approved_invoices_donut.*)")
+    parser.add_argument("--ground_truth", type=str, default=None, help="Ground truth keyed by filename (default: cleaned_ground_truth.*)")
+    parser.add_argument("--workers", type=int, default=None, help="Scoring processes (default: CPU count)")
+    parser.add_argument("--min_join_rate", type=float, default=0.5,
+                        help="Share of predictions that must have a ground truth, else exit with status 1 (default: 0.5)")
+    args = parser.parse_args()
+
     # clear_gt()
-    run_evaluation()
\ No newline at end of file
+    rows = run_evaluation(args.predictions, args.ground_truth, args.workers, min_join_rate=args.min_join_rate)
+    if rows is None:
+        sys.exit(1)
\ No newline at end of file
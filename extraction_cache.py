@@ -0,0 +1,148 @@
+"""
+Content-addressed cache for validated extractions.
+
+Entries are keyed by a hash of the image bytes, the extraction prompt, the model name and
+the GermanInvoice schema version, so changing any of them invalidates old entries
+automatically. Storage is a single SQLite file with size-bounded LRU eviction.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "extraction_cache.db"
+DEFAULT_MAX_MB = 512
+EVICT_BATCH = 64  # Rows deleted per eviction statement
+
+
+def cache_key(image_sha256, prompt, model_name, schema_version):
+    """`image_sha256` is the hex digest of the image bytes, computed where the image is prepared."""
+    h = hashlib.sha256()
+    for part in (prompt.encode("utf-8"), model_name.encode("utf-8"), schema_version.encode("utf-8")):
+        h.update(hashlib.sha256(part).digest())
+    h.update(bytes.fromhex(image_sha256))
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Stores extraction JSON by key. `refresh` skips lookups but still writes, so a refreshed
+    run repopulates the cache with fresh results.
+
+    get/put block on SQLite; the pipeline calls them through asyncio.to_thread, so a lock
+    serialises the shared connection. The total size lives in the database, kept current by
+    triggers, so every process sharing the file (`--workers`) evicts against the same figure.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_mb=DEFAULT_MAX_MB, refresh=False):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS extractions (
+                    key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_access ON extractions(last_access)")
+            # Seeded from the rows once, in the same transaction that adds the triggers
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)")
+            self._conn.execute("INSERT OR IGNORE INTO cache_size SELECT 0, COALESCE(SUM(size), 0) FROM extractions")
+            for trigger in (
+                "extractions_insert AFTER INSERT ON extractions "
+                "BEGIN UPDATE cache_size SET total = total + new.size; END",
+                "extractions_update AFTER UPDATE OF size ON extractions "
+                "BEGIN UPDATE cache_size SET total = total + new.size - old.size; END",
+                "extractions_delete AFTER DELETE ON extractions "
+                "BEGIN UPDATE cache_size SET total = total - old.size; END",
+            ):
+                self._conn.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger}")
+
+    def get(self, key):
+        if self.refresh:
+            self.misses += 1
+            return None
+
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute("UPDATE extractions SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, payload):
+        size = len(payload.encode("utf-8"))
+        with self._lock:
+            # An upsert, not INSERT OR REPLACE: REPLACE deletes without firing the delete trigger
+            self._conn.execute(
+                "INSERT INTO extractions (key, payload, size, last_access) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET payload = excluded.payload, size = excluded.size, "
+                "last_access = excluded.last_access",
+                (key, payload, size, time.time()),
+            )
+            if self.total() > self.max_bytes:
+                self._evict()
+
+    def total(self):
+        """Bytes stored by every process sharing the file."""
+        return self._conn.execute("SELECT total FROM cache_size").fetchone()[0]
+
+    def _evict(self):
+        # Drop least recently used entries in small batches until we are back under 90% of the budget
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            # Another process may have evicted while we waited for the write lock
+            while self.total() > target:
+                deleted = self._conn.execute(
+                    "DELETE FROM extractions WHERE key IN "
+                    "(SELECT key FROM extractions ORDER BY last_access LIMIT ?)", (EVICT_BATCH,)
+                ).rowcount
+                if not deleted:
+                    break
+                evicted += deleted
+        if evicted:
+            logger.info(f"Extraction cache evicted {evicted} entries.")
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = (self.hits / total) if total else 0.0
+        return f"Cache hits: {self.hits} | misses: {self.misses} | hit rate: {rate:.0%}"
+
+    def close(self):
+        self._conn.close()
+
+
+_cache = None
+
+
+def configure_cache(enabled=True, refresh=False, path=DEFAULT_PATH, max_mb=DEFAULT_MAX_MB):
+    """Enables/disables the cache used by extract_node. Call before the workflow runs."""
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = ExtractionCache(path, max_mb=max_mb, refresh=refresh) if enabled else None
+    return _cache
+
+
+def get_cache():
+    return _cache
@@ -0,0 +1,155 @@
+"""
+Local stand-in for the Gemini clients, for exercising the pipeline offline.
+
+FakeStructuredLLM has the same ainvoke() contract as `llm.with_structured_output(schema, include_raw=True)`
+and can inject latency, 5xx errors and 429 throttling (randomly or by enforcing a quota).
+FakeChatModel plays the part of ChatGoogleGenerativeAI, so the whole cascade can be swapped with:
+
+    orchestrator.configure_tiers(["fake-fast", "fake-strong"], chat_factory=lambda name: FakeChatModel(...))
+"""
+
+import asyncio
+import collections
+import random
+import time
+from types import SimpleNamespace
+
+from orchestrator import GermanInvoice, ExtractField
+
+LOW_CONFIDENCE = 0.5
+CRITICAL_FIELDS = ("invoice_number", "total_amount")
+
+
+class FakeAPIError(Exception):
+    """Mimics a provider error: carries an HTTP status code and an optional Retry-After."""
+
+    def __init__(self, code, message="", retry_after=None):
+        super().__init__(f"{code} {message}".strip())
+        self.code = code
+        self.retry_after = retry_after
+
+
+def fake_invoice(confidence=1.0, rng=random):
+    return GermanInvoice(
+        company_name=ExtractField(value="Muster GmbH", confidence=confidence),
+        invoice_number=ExtractField(value=str(rng.randint(1000, 99999)), confidence=confidence),
+        invoice_date=ExtractField(value="2024-01-15", confidence=confidence),
+        due_date=ExtractField(value="2024-02-15", confidence=confidence),
+        total_amount=ExtractField(value=round(rng.uniform(10, 5000), 2), confidence=confidence),
+        bank_name=ExtractField(value="Musterbank", confidence=confidence),
+        iban=ExtractField(value="DE89 3704 0044 0532 0130 00", confidence=confidence),
+    )
+
+
+class FakeStructuredLLM:
+    """
+    latency:         mean seconds per call
+    latency_dist:    "fixed", "exp" (exponential) or "lognormal" (heavy tail, `latency_sigma`)
+    error_rate:      probability of a 503
+    throttle_rate:   probability of a 429
+    quota_rps:       if set, calls beyond this many per second get a 429 with Retry-After
+    confidence:      confidence reported on every field
+    low_conf_rate:   probability that the critical fields come back at LOW_CONFIDENCE
+    schema:          output model; field-subset schemas (re-extraction) are filled from a full invoice
+                     and InvoiceBatch gets one entry per "filename: <label>" part of the request
+    batch_drop_rate: probability that an invoice is left out of a batch answer
+    """
+
+    def __init__(self, latency=0.5, error_rate=0.0, throttle_rate=0.0, quota_rps=None, confidence=1.0, seed=None,
+                 latency_dist="exp", latency_sigma=0.5, low_conf_rate=0.0, schema=GermanInvoice, include_raw=False,
+                 batch_drop_rate=0.0):
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.quota_rps = quota_rps
+        self.confidence = confidence
+        self.low_conf_rate = low_conf_rate
+        self.schema = schema
+        self.include_raw = include_raw
+        self.batch_drop_rate = batch_drop_rate
+        self.calls = 0
+        self.rejected = 0
+        self._window = collections.deque()
+        self._rng = random.Random(seed)
+
+    def _over_quota(self):
+        now = time.monotonic()
+        while self._window and now - self._window[0] > 1.0:
+            self._window.popleft()
+        if len(self._window) >= self.quota_rps:
+            return True
+        self._window.append(now)
+        return False
+
+    def _sample_latency(self):
+        if not self.latency:
+            return 0.0
+        if self.latency_dist == "fixed":
+            return self.latency
+        if self.latency_dist == "lognormal":
+            # Parameterised so the mean stays at `latency`
+            mu = -0.5 * self.latency_sigma ** 2
+            return self.latency * self._rng.lognormvariate(mu, self.latency_sigma)
+        return self._rng.expovariate(1.0 / self.latency)
+
+    def _invoice(self):
+        invoice = fake_invoice(self.confidence, self._rng)
+        if self._rng.random() < self.low_conf_rate:
+            for name in CRITICAL_FIELDS:
+                getattr(invoice, name).confidence = LOW_CONFIDENCE
+        return invoice
+
+    def _result(self, messages):
+        if "invoices" in self.schema.model_fields:
+            item_schema = self.schema.model_fields["invoices"].annotation.__args__[0]
+            items = [
+                item_schema(filename=label, **dict(self._invoice()))
+                for label in _batch_labels(messages) if self._rng.random() >= self.batch_drop_rate
+            ]
+            parsed = self.schema(invoices=items)
+        else:
+            invoice = self._invoice()
+            parsed = self.schema(**{name: getattr(invoice, name) for name in self.schema.model_fields})
+        if not self.include_raw:
+            return parsed
+        raw = SimpleNamespace(usage_metadata={"input_tokens": 1500, "output_tokens": 250})
+        return {"raw": raw, "parsed": parsed, "parsing_error": None}
+
+    async def ainvoke(self, messages, **kwargs):
+        self.calls += 1
+        if self.quota_rps is not None and self._over_quota():
+            self.rejected += 1
+            raise FakeAPIError(429, "RESOURCE_EXHAUSTED", retry_after=1.0)
+        if self._rng.random() < self.throttle_rate:
+            self.rejected += 1
+            raise FakeAPIError(429, "RESOURCE_EXHAUSTED")
+
+        await asyncio.sleep(self._sample_latency())
+
+        if self._rng.random() < self.error_rate:
+            raise FakeAPIError(503, "UNAVAILABLE")
+        return self._result(messages)
+
+
+def _batch_labels(messages):
+    labels = []
+    for msg in messages:
+        for part in getattr(msg, "content", []):
+            if isinstance(part, dict) and part.get("text", "").startswith("filename: "):
+                labels.append(part["text"][len("filename: "):])
+    return labels
+
+
+class FakeChatModel:
+    """Stands in for ChatGoogleGenerativeAI: hands out FakeStructuredLLMs sharing its settings."""
+
+    def __init__(self, **fake_kwargs):
+        self.fake_kwargs = fake_kwargs
+        self.structured = []
+
+    def with_structured_output(self, schema, include_raw=False):
+        fake = FakeStructuredLLM(schema=schema, include_raw=include_raw, **self.fake_kwargs)
+        self.structured.append(fake)
+        return fake
@@ -0,0 +1,143 @@
+"""
+Ground-truth converter for the Donut invoice dataset.
+
+Turns the layout-based 'gt_parse' structure (word boxes + labelled regions) into a flat
+{field: text} record keyed by the OCR filename. Word-to-label assignment is a single
+vectorized centre-in-box test over NumPy arrays instead of nested Python loops.
+
+    python gt_converter.py --output cleaned_ground_truth.jsonl --workers 8
+"""
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+DATASET_ID = "Aoschu/German_invoices_dataset_for_donut"
+
+# Dataset label -> schema key
+LABEL_MAP = {
+    "nam of the company": "company_name",
+    "address of the company": "company_address",
+    "address of the customer": "vendor_name",
+    "telephone number": "phone_number",
+    "date": "invoice_date",
+    "sum": "total_amount",
+    "IBAN": "iban",
+    "invoice_id": "invoice_number",
+    "invoice_no": "invoice_number",
+}
+
+
+def convert_gt(gt_data, label_map=LABEL_MAP, keep_unmapped=False):
+    """
+    Reconstructs the text of every labelled region from the words whose centre lies inside it.
+    Words are read top-to-bottom, then left-to-right. When several regions map to the same key,
+    their non-empty texts are joined in reading order of the regions, so the result does not
+    depend on label order in the source file.
+    """
+    parse = gt_data.get('gt_parse', gt_data)  # Handle if passed directly or wrapped
+
+    transcriptions = parse.get('transcription', [])
+    bboxes = parse.get('bbox', [])
+    n = min(len(transcriptions), len(bboxes))
+
+    # Only keep the labels we care about
+    regions = []
+    for lbl in parse.get('label', []):
+        raw_label = lbl['labels'][0]
+        key = label_map.get(raw_label, raw_label if keep_unmapped else None)
+        if key:
+            regions.append((key, lbl['x'], lbl['y'], lbl['width'], lbl['height']))
+
+    cleaned_gt = {}
+    if parse.get('ocr'):
+        cleaned_gt['filename'] = os.path.basename(parse['ocr'])
+    if not regions:
+        return cleaned_gt
+
+    if n:
+        words = np.array([(b['x'], b['y'], b['width'], b['height']) for b in bboxes[:n]], dtype=np.float64)
+        cx = words[:, 0] + words[:, 2] / 2
+        cy = words[:, 1] + words[:, 3] / 2
+        # Reading order of all words once; int() truncation matches the original sort key
+        word_order = np.lexsort((words[:, 0].astype(np.int64), words[:, 1].astype(np.int64)))
+    else:
+        cx = cy = np.empty(0)
+        word_order = np.empty(0, dtype=np.int64)
+
+    labels = np.array([r[1:] for r in regions], dtype=np.float64)
+    lx, ly, lw, lh = (labels[:, i:i + 1] for i in range(4))
+
+    # (regions x words) containment matrix, evaluated in one shot
+    inside = (lx <= cx) & (cx <= lx + lw) & (ly <= cy) & (cy <= ly + lh)
+    inside_ordered = inside[:, word_order]
+
+    region_order = np.lexsort((labels[:, 0], labels[:, 1]))
+    texts = {}
+    for i in region_order:
+        key = regions[i][0]
+        text = " ".join(transcriptions[j] for j in word_order[inside_ordered[i]])
+        texts.setdefault(key, [])
+        if text:
+            texts[key].append(text)
+
+    for key, parts in texts.items():
+        cleaned_gt[key] = " ".join(parts)
+    return cleaned_gt
+
+
+def _convert_row(ground_truth_json):
+    return convert_gt(json.loads(ground_truth_json))
+
+
+def build_ground_truth(rows, output_path, workers=None, chunksize=64):
+    """
+    Converts an iterable of raw 'ground_truth' JSON strings in a process pool and writes one
+    record per invoice. `.parquet` outputs are written columnar, anything else as JSONL.
+    """
+    with Pool(processes=workers) as pool:
+        records = list(pool.imap(_convert_row, rows, chunksize=chunksize))
+
+    tmp_path = output_path + ".tmp"
+    if output_path.endswith(".parquet"):
+        import pandas as pd
+        pd.DataFrame.from_records(records).to_parquet(tmp_path, index=False)
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, output_path)
+    return len(records)
+
+
+def load_ground_truth(path):
+    """Returns {filename: record}. Legacy JSON arrays without filenames are not joinable and are skipped."""
+    if path.endswith(".parquet"):
+        import pandas as pd
+        records = pd.read_parquet(path).to_dict(orient="records")
+        records = [{k: v for k, v in r.items() if isinstance(v, str)} for r in records]
+    elif path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+    return {r["filename"]: r for r in records if r.get("filename")}
+
+
+if __name__ == "__main__":
+    from datasets import load_dataset
+
+    parser = argparse.ArgumentParser(description="Regenerate cleaned ground truth from the Donut dataset")
+    parser.add_argument("--source", type=str, default=DATASET_ID, help="HF dataset id")
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--output", type=str, default="cleaned_ground_truth.jsonl", help=".jsonl or .parquet")
+    parser.add_argument("--workers", type=int, default=None, help="Converter processes (default: CPU count)")
+    args = parser.parse_args()
+
+    data = load_dataset(args.source, split=args.split)
+    count = build_ground_truth(data['ground_truth'], args.output, args.workers)
+    print(f"Wrote {count} ground-truth records to {args.output}")
@@ -0,0 +1,160 @@
+"""
+CPU-bound image preparation, meant to run inside a process pool.
+
+Everything here is a plain module-level function so it can be pickled to pool workers.
+Only images that had to be re-encoded travel back to the event loop; files that can be
+sent as they are stay on disk and are referenced by path (see blob_store).
+"""
+
+import base64
+import hashlib
+import io
+import os
+from PIL import Image, ImageOps
+from dedup import dhash
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+EXIF_ORIENTATION = 0x0112
+
+# How images are encoded before they are sent. "original" keeps the historical behaviour:
+# sendable JPEGs pass through untouched, everything else is re-encoded at full resolution.
+ENCODING_PROFILES = {
+    "original": {"max_long_edge": None, "grayscale": False, "quality": None, "autocrop": False},
+    "balanced": {"max_long_edge": 2048, "grayscale": False, "quality": 85, "autocrop": True},
+    "compact": {"max_long_edge": 1600, "grayscale": True, "quality": 75, "autocrop": True},
+    "tiny": {"max_long_edge": 1024, "grayscale": True, "quality": 60, "autocrop": True},
+}
+DEFAULT_QUALITY = 90
+WHITE_THRESHOLD = 235  # Pixels lighter than this count as margin for autocrop
+AUTOCROP_PADDING = 0.01  # Keep 1% of the page size around the detected content
+
+# Active profile in the parent process; passed explicitly to pool workers
+active_profile = dict(ENCODING_PROFILES["original"])
+
+
+def configure_encoding(profile="original", **overrides):
+    """Selects a named profile; non-None keyword overrides replace single settings."""
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {profile} (choose from {', '.join(ENCODING_PROFILES)})")
+    active_profile.clear()
+    active_profile.update(ENCODING_PROFILES[profile])
+    active_profile.update({k: v for k, v in overrides.items() if v is not None})
+    return active_profile
+
+
+def get_encoding_profile():
+    return dict(active_profile)
+
+
+def _is_passthrough(profile):
+    return not profile or not (profile.get("max_long_edge") or profile.get("grayscale")
+                               or profile.get("quality") or profile.get("autocrop"))
+
+
+def _is_sendable_jpeg(raw):
+    """True when the bytes are a JPEG that can be sent as-is: RGB and upright."""
+    if not raw.startswith(JPEG_MAGIC):
+        return False
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            return img.format == "JPEG" and img.mode == "RGB" and img.getexif().get(EXIF_ORIENTATION, 1) == 1
+    except Exception:
+        return False
+
+
+def _normalize(raw):
+    """Decodes, applies the EXIF orientation, converts to RGB and re-encodes as JPEG."""
+    with Image.open(io.BytesIO(raw)) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        b = io.BytesIO()
+        img.save(b, format="JPEG")
+        return b.getvalue()
+
+
+def _autocrop(img):
+    """Trims near-white margins, keeping a little padding. Blank pages are returned unchanged."""
+    mask = img.convert("L").point(lambda v: 255 if v < WHITE_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return img
+    pad_x, pad_y = int(img.width * AUTOCROP_PADDING), int(img.height * AUTOCROP_PADDING)
+    left, top, right, bottom = bbox
+    return img.crop((max(0, left - pad_x), max(0, top - pad_y), min(img.width, right + pad_x), min(img.height, bottom + pad_y)))
+
+
+def encode_image(img, profile):
+    """Optionally autocrops/grayscales/downscales a decoded, upright image and encodes it as JPEG."""
+    max_edge = profile.get("max_long_edge")
+    if profile.get("autocrop"):
+        img = _autocrop(img)
+    img = img.convert("L" if profile.get("grayscale") else "RGB")
+    if max_edge and max(img.size) > max_edge:
+        scale = max_edge / max(img.size)
+        img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+    b = io.BytesIO()
+    img.save(b, format="JPEG", quality=profile.get("quality") or DEFAULT_QUALITY)
+    return b.getvalue()
+
+
+def encode_with_profile(raw, profile):
+    """Decodes, orients, optionally autocrops/grayscales/downscales and re-encodes as JPEG."""
+    max_edge = profile.get("max_long_edge")
+    with Image.open(io.BytesIO(raw)) as img:
+        if img.format == "JPEG":
+            # Let libjpeg decode straight to grayscale and at a reduced scale (1/2, 1/4, 1/8)
+            # when that still covers max_edge
+            img.draft("L" if profile.get("grayscale") else img.mode, (max_edge, max_edge) if max_edge else img.size)
+        return encode_image(ImageOps.exif_transpose(img), profile)
+
+
+def prepare_image(source, name=None, profile=None, with_dhash=False):
+    """
+    Checks a file path (or raw image bytes) and encodes it for sending. With the default
+    ("original") profile, JPEGs that are already RGB and upright pass through byte-for-byte and
+    come back with `image_bytes=None`, so the caller keeps referencing its own copy; anything
+    else returns the re-encoded JPEG. Other profiles re-encode unless that would grow the file.
+    `with_dhash` adds the perceptual hash of the source image for duplicate detection.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        raw = bytes(source)
+    else:
+        with open(source, "rb") as f:
+            raw = f.read()
+        name = name or os.path.basename(source)
+
+    sendable = _is_sendable_jpeg(raw)
+    if _is_passthrough(profile):
+        jpeg = raw if sendable else _normalize(raw)
+    else:
+        jpeg = encode_with_profile(raw, profile)
+        if sendable and len(jpeg) >= len(raw):
+            jpeg = raw  # Never send more bytes than the original
+        sendable = jpeg is raw
+
+    return {
+        "image_path": name,
+        "image_bytes": None if sendable else jpeg,
+        "image_sha256": hashlib.sha256(jpeg).hexdigest(),
+        "image_dhash": dhash(raw) if with_dhash else None,
+    }
+
+
+def crop_region(jpeg, box, min_long_edge=1600, max_scale=2.0):
+    """
+    Crops a relative (left, top, right, bottom) box out of prepared JPEG bytes and upscales
+    small crops (up to `max_scale`) so fine print survives. Returns a new base64 JPEG.
+    """
+    with Image.open(io.BytesIO(jpeg)) as img:
+        w, h = img.size
+        left, top, right, bottom = box
+        crop = img.crop((int(left * w), int(top * h), int(right * w), int(bottom * h)))
+
+        scale = min(max_scale, min_long_edge / max(crop.size))
+        if scale > 1.0:
+            crop = crop.resize((int(crop.width * scale), int(crop.height * scale)), Image.LANCZOS)
+
+        b = io.BytesIO()
+        crop.save(b, format="JPEG", quality=90)
+        return base64.b64encode(b.getvalue()).decode("ascii")
@@ -0,0 +1,151 @@
+"""
+Optional run instrumentation: latency/size histograms and counters for the workflow.
+
+Disabled by default. When disabled, nodes are registered unwrapped and observe()/inc() return
+after a single global check, so the hot path pays next to nothing. When enabled, results are
+exported as a Prometheus text file and a per-run JSON summary.
+"""
+
+import functools
+import json
+import os
+import random
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Exact count/sum plus a bounded reservoir sample for the quantiles."""
+
+    def __init__(self, reservoir_size=10000):
+        self.count = 0
+        self.sum = 0.0
+        self.reservoir_size = reservoir_size
+        self.samples = []
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if len(self.samples) < self.reservoir_size:
+            self.samples.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.reservoir_size:
+                self.samples[i] = value
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_prometheus(self):
+        lines = []
+        seen = set()
+        for (name, labels), hist in sorted(self.histograms.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} summary")
+                seen.add(name)
+            for q, value in hist.quantiles().items():
+                lines.append(f"{name}{_labels(labels, quantile=q)} {value:.6f}")
+            lines.append(f"{name}_sum{_labels(labels)} {hist.sum:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        histograms = {}
+        for (name, labels), hist in sorted(self.histograms.items()):
+            q = hist.quantiles()
+            histograms[name + _labels(labels)] = {
+                "count": hist.count, "sum": round(hist.sum, 6),
+                "p50": q[0.5], "p95": q[0.95], "p99": q[0.99],
+            }
+        counters = {name + _labels(labels): value for (name, labels), value in sorted(self.counters.items())}
+        return {"histograms": histograms, "counters": counters}
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+_metrics = None
+
+
+def enable_metrics():
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def get_metrics():
+    return _metrics
+
+
+def observe(name, value, **labels):
+    if _metrics is not None:
+        _metrics.observe(name, value, **labels)
+
+
+def inc(name, value=1, **labels):
+    if _metrics is not None:
+        _metrics.inc(name, value, **labels)
+
+
+def instrument_node(name, fn):
+    """Wraps an async graph node to record its wall time and errors. Only used when enabled."""
+    @functools.wraps(fn)
+    async def wrapper(state):
+        started = time.perf_counter()
+        try:
+            return await fn(state)
+        except Exception:
+            inc("node_errors_total", node=name)
+            raise
+        finally:
+            observe("node_duration_seconds", time.perf_counter() - started, node=name)
+    return wrapper
+
+
+def export_metrics(metrics_dir, run_info=None):
+    """Writes metrics.prom and run_summary.json into `metrics_dir`."""
+    if _metrics is None:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    prom_path = os.path.join(metrics_dir, "metrics.prom")
+    with open(prom_path + ".tmp", "w") as f:
+        f.write(_metrics.to_prometheus())
+    os.replace(prom_path + ".tmp", prom_path)
+
+    summary = {"run": run_info or {}, **_metrics.summary()}
+    with open(os.path.join(metrics_dir, "run_summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    logger.info(f"Metrics written to {metrics_dir}")
@@ -1,25 +1,51 @@
-import base64
-import os
 import asyncio
-import json
 from langchain_core.messages import HumanMessage
-from orchestrator import AgentState, structured_llm
+from orchestrator import AgentState, GermanInvoice, SCHEMA_VERSION, get_tier_llms, get_field_llm
+from image_prep import crop_region
+from blob_store import load_image_b64, load_image_bytes
+from review_queue import get_review_queue
+from extraction_cache import get_cache, cache_key
+from llm_gateway import TransientLLMError
+from batching import get_batcher
+from dedup import get_dedup_index, business_key, invoice_identity
+from instrumentation import inc
+from log_setup import log_fields
 import logging
 logger = logging.getLogger(__name__)
 
-file_write_lock = asyncio.Lock()
+CRITICAL_FIELDS = ("invoice_number", "total_amount")
 
+# Minimum confidence on the critical fields. Results from a non-final tier must reach
+# `escalate_below` to be accepted, otherwise they are escalated to the next model.
+audit_thresholds = {"confidence": 0.85, "escalate_below": 0.85}
 
-async def extract_node(state: AgentState):
-    logger.info(f"Extracting data for {state['image_path']}...")
 
-    if not state['image_bytes']:
-        logger.error("No image bytes found.")
-        return {"extraction": None, "safety_check": "flagged"}
+def configure_audit(confidence=0.85, escalate_below=None):
+    audit_thresholds["confidence"] = confidence
+    audit_thresholds["escalate_below"] = confidence if escalate_below is None else escalate_below
+
+
+# Where each critical field usually sits on a German invoice, as relative (left, top, right, bottom)
+FIELD_REGIONS = {
+    "invoice_number": (0.0, 0.0, 1.0, 0.45),  # Header block
+    "total_amount": (0.0, 0.4, 1.0, 1.0),  # Totals and footer
+}
+
+FIELD_HINTS = {
+    "invoice_number": 'Look for "Rechnungsnummer", "Rechnungs-Nr.", "Beleg-Nr.", "Rech-Nr".',
+    "total_amount": 'Look for "Gesamtbetrag", "Bruttobetrag", "Zahlbetrag", "Summe". Convert the German format (e.g. "1.050,50") to a float (1050.50).',
+}
 
-    image_b64 = base64.b64encode(state['image_bytes']).decode("utf-8")
+# Targeted re-extractions allowed per invoice before falling back to escalation/human review
+reextract_budget = {"max_attempts": 1}
 
-    system_instructions = """
+
+def configure_reextract(max_attempts=1):
+    reextract_budget["max_attempts"] = max_attempts
+
+
+# Kept at module level so the extraction cache can key on the exact prompt text
+EXTRACTION_PROMPT = """
     ### ROLE
     You are a specialized AI assistant for German Accounting (DACH region). Your task is to extract structured data from invoice images with high precision.
 
@@ -43,67 +69,270 @@ async def extract_node(state: AgentState):
     4. If a field is not found, return null for value and 0.0 for confidence.
     """
 
+# Appended to EXTRACTION_PROMPT for PDFs (see pdf_prep), before the pages
+DOCUMENT_NOTE = """
+    ### DOCUMENT
+    The invoice is a multi-page document. Its pages follow in order, each marked "--- Page n ---"
+    and given either as an image or as the text embedded in the PDF.
+    Return ONE invoice for the whole document: the header fields are usually on the first page,
+    the totals and bank details on the last one.
+    """
+
+
+async def _document_parts(pages):
+    """Message parts for a PDF: per page a marker, then its text layer and/or its image."""
+    parts = [{"type": "text", "text": DOCUMENT_NOTE}]
+    for page in pages:
+        marker = f"--- Page {page['page']} ---"
+        parts.append({"type": "text", "text": f"{marker}\n{page['text']}" if page["text"] else marker})
+        if page["ref"]:
+            image_b64 = await load_image_b64(page["ref"])
+            parts.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}})
+    return parts
+
+
+async def _extract_with_tier(state: AgentState, tier: int):
+    llm = get_tier_llms()[tier]
+    pages = state.get('document_pages')
+
+    if not state.get('image_ref') and not pages:
+        logger.error("No image payload found.", extra=log_fields(state['image_path'], "extract", decision="flagged"))
+        return {"extraction": None, "safety_check": "flagged", "model_tier": tier}
+
+    prompt = EXTRACTION_PROMPT + DOCUMENT_NOTE if pages else EXTRACTION_PROMPT
+    cache = get_cache()
+    key = None
+    if cache is not None:
+        key = cache_key(state['image_sha256'], prompt, llm.name, SCHEMA_VERSION)
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            logger.info("Cache hit for %s.", state['image_path'], extra=log_fields(state['image_path'], "extract", decision="cache_hit"))
+            inc("extraction_cache_total", result="hit")
+            return {"extraction": GermanInvoice.model_validate_json(cached), "model_tier": tier}
+
+    # Loaded here and dropped when the node returns; the state only carries the references
+    batcher = get_batcher(tier, EXTRACTION_PROMPT) if not pages else None  # Batches hold single images only
+
+    try:
+        if batcher is not None:
+            image_b64 = await load_image_b64(state['image_ref'])
+            result = await batcher.submit(state['image_path'], image_b64)
+        else:
+            # Fixed prompt first and the image(s) last, so the request prefix is identical across invoices
+            if pages:
+                content = [{"type": "text", "text": EXTRACTION_PROMPT}, *await _document_parts(pages)]
+            else:
+                image_b64 = await load_image_b64(state['image_ref'])
+                content = [
+                    {"type": "text", "text": EXTRACTION_PROMPT},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+                ]
+            result = await llm.ainvoke([HumanMessage(content=content)])
+        if cache is not None and result is not None:
+            await asyncio.to_thread(cache.put, key, result.model_dump_json())
+        return {"extraction": result, "model_tier": tier}
+    except TransientLLMError as e:
+        # API trouble, not a bad invoice: keep it out of the review queue so it can be retried
+        logger.error("Extraction failed after retries: %s", e, extra=log_fields(state['image_path'], "extract", decision="errored"))
+        return {"extraction": None, "safety_check": "errored", "model_tier": tier}
+    except Exception as e:
+        logger.error("Extraction failed: %s", e, extra=log_fields(state['image_path'], "extract", decision="flagged"))
+        return {"extraction": None, "safety_check": "flagged", "model_tier": tier}
+
+
+async def extract_node(state: AgentState):
+    logger.info("Extracting data for %s...", state['image_path'], extra=log_fields(state['image_path'], "extract"))
+    return await _extract_with_tier(state, 0)
+
+
+async def escalate_node(state: AgentState):
+    """Re-runs the full extraction on the next model tier after the audit flagged the result."""
+    tier = state.get('model_tier', 0) + 1
+    logger.info("Escalating %s to %s (%s).", state['image_path'], get_tier_llms()[tier].name, state.get('review_reason'),
+                extra=log_fields(state['image_path'], "escalate", decision=f"tier{tier}"))
+
+    update = await _extract_with_tier(state, tier)
+    if update["extraction"] is None and update.get("safety_check") != "errored":
+        # Keep the cheaper tier's answer; the audit will send it on to a human
+        update.pop("extraction")
+    return update
+
+
+def _duplicate(state, kind, match):
+    filename, outcome, extraction = match
+    logger.info("%s duplicates %s (%s), reusing its %s result.", state['image_path'], filename, kind, outcome,
+                extra=log_fields(state['image_path'], "dedup", decision="duplicate"))
+    get_dedup_index().hits[kind] += 1
+    inc("duplicates_total", kind=kind)
+    return {
+        "safety_check": "duplicate",
+        "duplicate_of": filename,
+        "extraction": GermanInvoice.model_validate_json(extraction) if extraction else state.get('extraction'),
+    }
+
+
+async def dedup_node(state: AgentState):
+    """Looks up an earlier near-identical image. It is only a candidate until dedup_key_node confirms it."""
+    index = get_dedup_index()
+    if index is None or state.get('image_dhash') is None:
+        return {}
+    return {"image_match": index.find_image(state['image_dhash'], exclude=state['image_path'])}
+
+
+async def dedup_key_node(state: AgentState):
+    """
+    After an approving audit: short-circuits invoices whose number/IBAN/amount were approved before,
+    or whose image candidate was approved with the same number and amount.
+    """
+    index = get_dedup_index()
+    data = state.get('extraction')
+    if index is None or data is None or state.get('safety_check') != 'pass':
+        return {}
+    key = business_key(data)
+    match = index.find_key(key, exclude=state['image_path']) if key else None
+    if match:
+        return _duplicate(state, "business_key", match)
+
+    # Same-template invoices hash alike, so the image alone never decides
+    candidate = state.get('image_match')
+    if candidate and candidate[1] == "pass" and candidate[2]:
+        identity = invoice_identity(data)
+        if identity is not None and identity == invoice_identity(GermanInvoice.model_validate_json(candidate[2])):
+            return _duplicate(state, "image", candidate)
+    return {}
+
+
+async def remember_node(state: AgentState):
+    """Records the final pass/flagged result so later copies of this invoice are recognised."""
+    index = get_dedup_index()
+    if index is not None:
+        index.remember(state['image_path'], state['safety_check'], state.get('extraction'), state.get('image_dhash'))
+    return {}
+
+
+def is_duplicate(state: AgentState):
+    return state.get('safety_check') == 'duplicate'
+
+
+def _crop_box(fields):
+    """Union of the regions of `fields`; the whole page if any field has no known region."""
+    boxes = [FIELD_REGIONS.get(name) for name in fields]
+    if not boxes or None in boxes:
+        return (0.0, 0.0, 1.0, 1.0)
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def _page_for(state, fields):
+    """Page to crop: the first one, except for footer-only fields of a PDF (the last rendered page)."""
+    refs = [page["ref"] for page in state.get('document_pages') or () if page["ref"]]
+    if refs and all(FIELD_REGIONS.get(name, (0.0, 0.0))[1] > 0.0 for name in fields):
+        return refs[-1]
+    return state['image_ref']
+
+
+async def reextract_node(state: AgentState):
+    """
+    Re-asks only for the fields the audit flagged, on a cropped and upscaled part of the page,
+    and merges any answer that is more confident than the one we already have.
+    """
+    fields = list(state.get('flagged_fields') or [])
+    tier = state.get('model_tier', 0)
+    attempts = state.get('reextract_attempts', 0) + 1
+    logger.info("Re-extracting %s for %s (attempt %d).", fields, state['image_path'], attempts, extra=log_fields(state['image_path'], "reextract"))
+
+    jpeg = await load_image_bytes(_page_for(state, fields))
+    crop_b64 = await asyncio.to_thread(crop_region, jpeg, _crop_box(fields))
+    hints = "\n".join(f"- **{name}**: {FIELD_HINTS.get(name, '')}" for name in fields)
+    prompt = (
+        "This is a cropped part of a German invoice (\"Rechnung\"). "
+        f"Extract only these fields:\n{hints}\n"
+        "If a field is not visible, return null for value and 0.0 for confidence."
+    )
     msg = HumanMessage(content=[
-        {"type": "text", "text": system_instructions},
-        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+        {"type": "text", "text": prompt},
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{crop_b64}"}}
     ])
 
     try:
-        result = await structured_llm.ainvoke([msg])
-        return {"extraction": result}
+        result = await get_field_llm(tier, fields).ainvoke([msg])
     except Exception as e:
-        logger.error(f"Extraction failed: {e}")
-        return {"extraction": None, "safety_check": "flagged"}
+        # Keep the existing extraction; the audit will route it onwards
+        logger.error("Re-extraction failed: %s", e, extra=log_fields(state['image_path'], "reextract"))
+        return {"reextract_attempts": attempts}
+
+    data = state['extraction']
+    improved = {}
+    for name in fields:
+        new = getattr(result, name, None)
+        if new is not None and new.value is not None and new.confidence > getattr(data, name).confidence:
+            improved[name] = new
+
+    logger.info("Re-extraction improved %s for %s.", list(improved), state['image_path'], extra=log_fields(state['image_path'], "reextract"))
+    return {"extraction": data.model_copy(update=improved), "reextract_attempts": attempts}
+
+
+def should_reextract(state: AgentState):
+    return (
+        state.get('safety_check') == 'flagged'
+        and state.get('extraction') is not None
+        and state.get('review_reason') in ("low_confidence", "missing_value")
+        and state.get('image_ref') is not None  # Text-only PDFs have no page image to crop
+        and state.get('reextract_attempts', 0) < reextract_budget["max_attempts"]
+    )
+
+
+def should_escalate(state: AgentState):
+    return state.get('safety_check') == 'flagged' and state.get('model_tier', 0) + 1 < len(get_tier_llms())
 
 
 async def audit_node(state: AgentState):
+    if state.get('safety_check') == 'errored':
+        return {}
+
     data = state.get('extraction')
 
     if not data:
-        logger.warning("No data extracted. Flagging.")
-        return {"safety_check": "flagged"}
+        logger.warning("No data extracted. Flagging.", extra=log_fields(state.get('image_path'), "audit", decision="flagged"))
+        inc("audit_decisions_total", decision="flagged", reason="no_extraction")
+        return {"safety_check": "flagged", "review_reason": "no_extraction", "flagged_fields": []}
+
+    critical_fields = {name: getattr(data, name) for name in CRITICAL_FIELDS}
 
-    critical_fields = [data.invoice_number, data.total_amount]
+    is_final_tier = state.get('model_tier', 0) + 1 >= len(get_tier_llms())
+    threshold = audit_thresholds["confidence" if is_final_tier else "escalate_below"]
 
-    if any(f.confidence < 0.85 for f in critical_fields):
-        logger.info(f"DECISION: Low confidence detected for {state.get('image_path')}. Routing to Human.")
-        return {"safety_check": "flagged"}
+    low_confidence = [name for name, f in critical_fields.items() if f.confidence < threshold]
+    if low_confidence:
+        logger.info("DECISION: Low confidence detected for %s. Flagging.", state.get('image_path'),
+                    extra=log_fields(state.get('image_path'), "audit", decision="flagged"))
+        inc("audit_decisions_total", decision="flagged", reason="low_confidence")
+        return {"safety_check": "flagged", "review_reason": "low_confidence", "flagged_fields": low_confidence}
 
-    if data.total_amount.value is None or data.invoice_number.value is None:
-        logger.info(f"DECISION: Missing critical values for {state.get('image_path')}. Routing to Human.")
-        return {"safety_check": "flagged"}
+    missing = [name for name, f in critical_fields.items() if f.value is None]
+    if missing:
+        logger.info("DECISION: Missing critical values for %s. Flagging.", state.get('image_path'),
+                    extra=log_fields(state.get('image_path'), "audit", decision="flagged"))
+        inc("audit_decisions_total", decision="flagged", reason="missing_value")
+        return {"safety_check": "flagged", "review_reason": "missing_value", "flagged_fields": missing}
 
-    logger.info(f"DECISION: High confidence for {state.get('image_path')}. Auto-approving.")
+    logger.info("DECISION: High confidence for %s. Auto-approving.", state.get('image_path'),
+                extra=log_fields(state.get('image_path'), "audit", decision="pass"))
+    inc("audit_decisions_total", decision="pass")
     return {"safety_check": "pass"}
 
 
 async def human_review_node(state: AgentState):
     """
-    Adds the filename to review_queue.json safely using a Lock.
+    Adds the filename to the configured review queue (see review_queue.py).
     """
     filename = state.get('image_path', 'unknown_invoice.jpg')
-    review_file = "review_queue.json"
 
-    logger.info(f"Flagging file: {filename} for human review.")
-
-    async with file_write_lock:
-        if os.path.exists(review_file):
-            try:
-                with open(review_file, "r") as f:
-                    data = json.load(f)
-            except json.JSONDecodeError:
-                data = {"invoice_needs_review": []}
-        else:
-            data = {"invoice_needs_review": []}
+    logger.info("Flagging file: %s for human review.", filename, extra=log_fields(filename, "human_review", decision="flagged"))
 
-        if filename not in data["invoice_needs_review"]:
-            data["invoice_needs_review"].append(filename)
-
-            with open(review_file, "w") as f:
-                json.dump(data, f, indent=2)
-            logger.info("File write complete.")
-        else:
-            logger.info(f"File {filename} is already in the queue.")
+    get_review_queue().add(
+        filename,
+        reason=state.get('review_reason'),
+        flagged_fields=state.get('flagged_fields'),
+    )
 
     return {"messages": [f"Flagged {filename}"]}
-
@@ -0,0 +1,407 @@
+"""
+Shared throttling and retry layer around the structured Gemini client.
+
+- AdaptiveLimiter: requests/sec and tokens/min budgets plus AIMD concurrency
+  (additive increase on success, halve on 429).
+- ThrottledLLM: wraps any runnable with .ainvoke(), retrying 429/5xx and network errors with jittered
+  exponential backoff that honours Retry-After. When retries run out it raises
+  TransientLLMError so callers can tell API trouble apart from bad invoices.
+- Hedging (off by default, see configure_hedging): when a request is still running after the
+  model's observed p95 latency, a second identical request is sent and the first answer wins.
+  Hedges are capped at a fraction of all calls so a slow API cannot double the load.
+"""
+
+import asyncio
+import collections
+import random
+import re
+import time
+import logging
+from instrumentation import Histogram, get_metrics, observe, inc
+
+try:
+    from aiohttp import ClientError
+except ImportError:  # Optional dependency; without it only the stdlib network errors apply
+    ClientError = None
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# Matched as whole words in messages of errors without a status code, so an invoice number or a
+# byte count containing "500" does not make an error retryable
+THROTTLE_MARKERS = re.compile(r"\b(?:429|RESOURCE_EXHAUSTED|rate limit(?:ed)?|quota)\b", re.IGNORECASE)
+TRANSIENT_MARKERS = re.compile(r"\b(?:500|502|503|504|UNAVAILABLE|DEADLINE_EXCEEDED|INTERNAL|timed out)\b")
+
+# Connection refused/reset, DNS failures, dropped connections and truncated bodies. Errors that
+# carry an HTTP status (e.g. aiohttp's ClientResponseError) are classified by the status instead.
+NETWORK_ERRORS = (OSError,) + ((ClientError,) if ClientError is not None else ())
+
+# Rough Gemini accounting: ~4 characters per text token, a fixed budget per image part
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 1290
+
+
+class TransientLLMError(Exception):
+    """Raised when a retryable API error persists after all retries."""
+
+
+# max_ratio <= 0 disables hedging. min_samples: latencies observed before the quantile is trusted.
+hedge_settings = {"max_ratio": 0.0, "quantile": 0.95, "min_samples": 20}
+
+
+def configure_hedging(max_ratio=0.0, quantile=0.95, min_samples=20):
+    hedge_settings["max_ratio"] = max_ratio
+    hedge_settings["quantile"] = quantile
+    hedge_settings["min_samples"] = min_samples
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_take(self, amount=1.0):
+        """Takes `amount` if it is available right now; never waits."""
+        amount = min(amount, self.capacity)
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    async def take(self, amount=1.0):
+        amount = min(amount, self.capacity)  # Oversized requests wait for a full bucket, never forever
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter:
+    """
+    Gate every model call goes through. Concurrency follows AIMD between
+    `min_concurrency` and `max_concurrency`; the buckets enforce the rate budgets.
+    """
+
+    def __init__(self, rps=None, tpm=None, max_concurrency=32, min_concurrency=1, initial_concurrency=None):
+        self.configure(rps, tpm, max_concurrency, min_concurrency, initial_concurrency)
+        self._in_flight = 0
+        self._cond = None
+        self._loop = None
+
+    def configure(self, rps=None, tpm=None, max_concurrency=32, min_concurrency=1, initial_concurrency=None):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._rps = TokenBucket(rps, max(1.0, rps)) if rps else None
+        self._tpm = TokenBucket(tpm / 60.0, tpm) if tpm else None
+
+    def _condition(self):
+        # Bind to the running loop lazily so one limiter survives several asyncio.run() calls
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._cond, self._loop, self._in_flight = asyncio.Condition(), loop, 0
+        return self._cond
+
+    async def acquire(self, tokens=0):
+        async with self._condition():
+            await self._cond.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        try:
+            # Honour a provider-requested cool-down for every caller, not just the throttled one
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if self._rps is not None:
+                await self._rps.take(1)
+            if self._tpm is not None and tokens:
+                await self._tpm.take(tokens)
+        except BaseException:
+            await self.release("error")
+            raise
+
+    def try_acquire(self, tokens=0):
+        """
+        acquire() for optional work (hedges): takes a slot and the rate budget only if all of them
+        are free right now. Returns False instead of waiting; release() is only owed after True.
+        """
+        self._condition()
+        if self._in_flight >= int(self.limit) or self._paused_until > time.monotonic():
+            return False
+        if self._tpm is not None and tokens and self._tpm.tokens < min(tokens, self._tpm.capacity):
+            return False
+        if self._rps is not None and not self._rps.try_take(1):
+            return False
+        if self._tpm is not None and tokens:
+            self._tpm.try_take(tokens)
+        self._in_flight += 1
+        return True
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def release(self, outcome="ok"):
+        if outcome == "ok":
+            # Additive increase: roughly +1 slot per window of successful calls
+            self.limit = min(self.max_concurrency, self.limit + 1.0 / max(self.limit, 1.0))
+        elif outcome == "throttled" and time.monotonic() - self._last_decrease > 1.0:
+            # Halve at most once per second so a burst of 429s from one window counts once
+            self._last_decrease = time.monotonic()
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            logger.warning(f"Throttled by the API, concurrency limit lowered to {int(self.limit)}")
+
+        async with self._condition():
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+
+def _status_code(exc):
+    for attr in ("status_code", "status", "http_status", "code"):
+        code = getattr(exc, attr, None)
+        code = getattr(code, "value", code)  # HTTPStatus / enum codes
+        if isinstance(code, int):
+            return code
+    response = getattr(exc, "response", None)
+    code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def _retry_after(exc):
+    value = getattr(exc, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+        value = headers.get("Retry-After") or headers.get("retry-after")
+    if value is None:
+        # Gemini puts the hint in the error details, e.g. "retryDelay": "23s"
+        match = re.search(r"retry[_ ]?delay\W*(?:seconds:\s*)?(\d+(?:\.\d+)?)", str(exc), re.IGNORECASE)
+        value = match.group(1) if match else None
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc):
+    """Returns ("throttled" | "transient" | None, retry_after_seconds)."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return "transient", None
+
+    code = _status_code(exc)
+    if code is None and isinstance(exc, NETWORK_ERRORS):
+        return "transient", None
+    text = str(exc)
+    if code == 429 or (code is None and THROTTLE_MARKERS.search(text)):
+        return "throttled", _retry_after(exc)
+    if code in RETRYABLE_STATUS or (code is None and TRANSIENT_MARKERS.search(text)):
+        return "transient", _retry_after(exc)
+    return None, None
+
+
+def estimate_tokens(messages):
+    tokens = 0
+    for msg in messages:
+        content = getattr(msg, "content", msg)
+        parts = content if isinstance(content, list) else [content]
+        for part in parts:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                text = part.get("text", "") if isinstance(part, dict) else str(part)
+                tokens += len(text) // CHARS_PER_TOKEN
+    return tokens
+
+
+def payload_bytes(messages):
+    size = 0
+    for msg in messages:
+        content = getattr(msg, "content", msg)
+        for part in content if isinstance(content, list) else [content]:
+            if isinstance(part, dict):
+                size += len(part.get("text", "")) + len(part.get("image_url", {}).get("url", ""))
+            else:
+                size += len(str(part))
+    return size
+
+
+def unwrap_structured(result):
+    """
+    Structured clients are built with include_raw=True so token usage is visible.
+    Returns (parsed, raw_message); plain results (e.g. the fake client) pass through.
+    """
+    if isinstance(result, dict) and "parsed" in result:
+        if result.get("parsing_error") is not None:
+            raise result["parsing_error"]
+        if result["parsed"] is None:
+            raise ValueError("Model returned no structured output")
+        return result["parsed"], result.get("raw")
+    return result, None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class ThrottledLLM:
+    """Drop-in replacement for a structured-output runnable: same ainvoke(), plus limits and retries."""
+
+    def __init__(self, runnable, limiter, retry=None, name="llm"):
+        self.runnable = runnable
+        self.limiter = limiter
+        self.retry = retry or RetryPolicy()
+        self.name = name
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.hedges = 0
+        # Seconds per successful call, including retries; a bounded sample, so long-running
+        # processes (service, --watch) do not grow it forever
+        self.latencies = Histogram(reservoir_size=2000)
+        self._request_seconds = collections.deque(maxlen=500)  # Single successful requests, for the hedge delay
+        self._hedge_delay = None
+        self._releases = set()
+
+    async def ainvoke(self, messages, **kwargs):
+        tokens = estimate_tokens(messages)
+        started = time.monotonic()
+        if get_metrics() is not None:
+            observe("llm_request_bytes", payload_bytes(messages), model=self.name)
+
+        for attempt in range(1, self.retry.max_attempts + 1):
+            waited = time.monotonic()
+            await self.limiter.acquire(tokens)
+            observe("llm_limiter_wait_seconds", time.monotonic() - waited, model=self.name)
+            self.calls += 1
+            try:
+                result = await self._request(messages, kwargs, tokens)
+            except asyncio.CancelledError:
+                # The invoice's deadline passed (or its run was cancelled): give the slot back
+                await self.limiter.release("error")
+                raise
+            except Exception as e:
+                kind, retry_after = classify_error(e)
+                await self.limiter.release("throttled" if kind == "throttled" else "error")
+                if kind is None:
+                    raise
+                if kind == "throttled":
+                    self.throttled += 1
+                    if retry_after:
+                        self.limiter.pause(retry_after)
+                if attempt == self.retry.max_attempts:
+                    raise TransientLLMError(f"{self.name}: giving up after {attempt} attempts: {e}") from e
+
+                delay = self.retry.delay(attempt, retry_after)
+                self.retries += 1
+                inc("llm_retries_total", model=self.name, kind=kind)
+                logger.info(f"{self.name}: {kind} error (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+
+            await self.limiter.release("ok")
+            self.latencies.observe(time.monotonic() - started)
+
+            parsed, raw = unwrap_structured(result)
+            if get_metrics() is not None:
+                observe("llm_call_seconds", time.monotonic() - started, model=self.name)
+                if hasattr(parsed, "model_dump_json"):
+                    observe("llm_response_bytes", len(parsed.model_dump_json()), model=self.name)
+                usage = getattr(raw, "usage_metadata", None) or {}
+                for kind in ("input_tokens", "output_tokens"):
+                    if usage.get(kind):
+                        inc("llm_tokens_total", usage[kind], model=self.name, kind=kind)
+                        observe(f"llm_{kind}", usage[kind], model=self.name)
+            return parsed
+
+    def _hedge_after(self):
+        """Seconds after which a request is hedged, or None (hedging off, too few samples, budget spent)."""
+        if hedge_settings["max_ratio"] <= 0 or len(self._request_seconds) < hedge_settings["min_samples"]:
+            return None
+        if self.hedges >= hedge_settings["max_ratio"] * self.calls:
+            return None
+        if self._hedge_delay is None or self.calls % 20 == 0:  # Re-sorting every call is wasted work
+            ordered = sorted(self._request_seconds)
+            self._hedge_delay = ordered[min(len(ordered) - 1, int(hedge_settings["quantile"] * len(ordered)))]
+        return self._hedge_delay
+
+    def _release_hedge(self, task):
+        """Done callback of a hedge: returns the slot taken by try_acquire(), even if it never started."""
+        if task.cancelled():  # Lost the race
+            outcome = "error"
+        elif task.exception() is not None:
+            outcome = "throttled" if classify_error(task.exception())[0] == "throttled" else "error"
+        else:
+            outcome = "ok"
+        release = asyncio.ensure_future(self.limiter.release(outcome))
+        self._releases.add(release)  # The loop only keeps weak references to tasks
+        release.add_done_callback(self._releases.discard)
+
+    async def _request(self, messages, kwargs, tokens):
+        """One attempt: the plain request, plus a hedge if it outlives the observed tail latency."""
+        started = time.monotonic()
+        delay = self._hedge_after()
+        if delay is None:
+            result = await self.runnable.ainvoke(messages, **kwargs)
+            self._request_seconds.append(time.monotonic() - started)
+            return result
+
+        primary = asyncio.ensure_future(self.runnable.ainvoke(messages, **kwargs))
+        pending = {primary}
+        try:
+            # A cancelled caller (e.g. the invoice deadline) must not leave requests running:
+            # they would spend quota with no limiter slot held, so the finally below cancels them
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                pending = set()
+                self._request_seconds.append(time.monotonic() - started)
+                return primary.result()
+
+            # A hedge is a real extra request and needs its own slot and rate budget. The workers
+            # normally hold every slot, so waiting for one would mostly count hedges never sent:
+            # without a free slot right now, keep waiting on the primary alone
+            if not self.limiter.try_acquire(tokens):
+                inc("llm_hedges_skipped_total", model=self.name)
+                result = await primary
+                pending = set()
+                self._request_seconds.append(time.monotonic() - started)
+                return result
+
+            self.hedges += 1
+            hedge = asyncio.ensure_future(self.runnable.ainvoke(messages, **kwargs))
+            hedge.add_done_callback(self._release_hedge)
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._request_seconds.append(time.monotonic() - started)
+                        inc("llm_hedges_total", model=self.name, winner="hedge" if task is hedge else "primary")
+                        return task.result()
+            # Both failed: surface the primary's error so the retry logic classifies it
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def summary(self):
+        p50 = self.latencies.quantiles()[0.5]
+        hedged = f" | hedged {self.hedges}" if self.hedges else ""
+        return f"{self.name}: calls {self.calls} | retries {self.retries} | throttled {self.throttled}{hedged} | p50 latency {p50:.2f}s"
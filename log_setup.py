@@ -0,0 +1,140 @@
+"""
+Logging for pipeline runs: the event loop only enqueues records, a background thread writes them.
+
+setup_logging() puts a single QueueHandler on the root logger. A QueueListener thread formats
+the records and writes them to the console and to a size-rotated log file (appended to, so
+history survives across runs). Logging calls in graph nodes therefore never wait on disk I/O.
+
+Per-invoice records carry structured fields, passed with `extra=log_fields(...)`:
+
+    logger.info("DECISION: ... %s", path, extra=log_fields(path, "audit", decision="flagged"))
+
+Pass the arguments %-style rather than as an f-string: the message is then only built for records
+that survive sampling, on the listener thread.
+
+With `json_format` the file gets one JSON object per line, holding filename, node, duration
+and decision next to the message. With `sample_rate` < 1, only that share of invoices keeps its
+INFO lines. The choice is made per filename, so a sampled invoice keeps all of its lines.
+Warnings, errors and records without a filename are always kept. Dropped records are filtered
+out before they reach the queue.
+
+Call it from entry points (main.py, service.py, bench.py, run_donut.py), not at import time,
+so spawned pool processes and library users never open log files.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import zlib
+from datetime import datetime, timezone
+
+DEFAULT_LOG_FILE = "agent.log"
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+QUIET_LOGGERS = ("httpx", "httpcore", "googleapiclient")  # Libraries that log every request at INFO
+
+# LogRecord attribute -> JSON key. LogRecord already has a `filename` (the source file), so the
+# invoice's filename travels as `invoice`.
+STRUCTURED_FIELDS = {"invoice": "filename", "node": "node", "duration": "duration", "decision": "decision"}
+
+_listener = None
+_queue_handler = None
+
+
+def log_fields(filename, node, decision=None, duration=None):
+    """`extra` for a per-invoice log call."""
+    fields = {"invoice": filename, "node": node}
+    if decision is not None:
+        fields["decision"] = decision
+    if duration is not None:
+        fields["duration"] = round(duration, 4)
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for attr, key in STRUCTURED_FIELDS.items():
+            value = getattr(record, attr, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class InvoiceSampler(logging.Filter):
+    """Keeps INFO-and-below records of `rate` of the invoices, chosen by a hash of the filename."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.threshold = int(rate * 0xFFFFFFFF)
+
+    def filter(self, record):
+        invoice = getattr(record, "invoice", None)
+        if invoice is None or record.levelno > logging.INFO:
+            return True
+        return zlib.crc32(str(invoice).encode("utf-8")) <= self.threshold
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues the record as is. The stock QueueHandler formats it on the calling thread, so it can
+    be pickled. Our queue never leaves the process, so formatting waits for the listener thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(log_file=DEFAULT_LOG_FILE, json_format=False, max_bytes=50 * 1024 * 1024, backup_count=5,
+                  sample_rate=1.0, level=logging.INFO):
+    """
+    Routes the root logger through a queue to the console and a RotatingFileHandler on `log_file`.
+    Calling it again (e.g. in a --workers process) replaces the previous setup.
+    """
+    global _listener, _queue_handler
+    stop_logging()
+
+    text = logging.Formatter(TEXT_FORMAT)
+    console = logging.StreamHandler()
+    console.setFormatter(text)
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                                        encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter() if json_format else text)
+
+    log_queue = queue.SimpleQueue()
+    _queue_handler = _DeferredQueueHandler(log_queue)
+    if sample_rate < 1.0:
+        _queue_handler.addFilter(InvoiceSampler(sample_rate))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_queue_handler)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, console, file_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Drains the queue, stops the writer thread and closes the files. Registered with atexit."""
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
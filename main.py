@@ -1,149 +1,635 @@
 import argparse
+import contextlib
+import json
 import os
-import io
+import signal
 import logging
 import asyncio
-import json
-from PIL import Image
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from langgraph.graph import StateGraph, END
-from invoice_agents import AgentState, extract_node, audit_node, human_review_node
-
-
-def setup_logger():
-    logger = logging.getLogger()
-    # Prevent adding duplicate handlers if function is called multiple times
-    if logger.hasHandlers():
-        return logger
-
-    logger.setLevel(logging.INFO)
-
-    # Format: [Time] [Level] Message
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    # Handler 1: Console (Terminal)
-    ch = logging.StreamHandler()
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+from invoice_agents import (
+    AgentState, extract_node, reextract_node, escalate_node, audit_node, human_review_node,
+    should_reextract, should_escalate, configure_audit, configure_reextract,
+    dedup_node, dedup_key_node, remember_node, is_duplicate,
+)
+from batching import configure_batching
+from result_sink import JsonlResultSink, iter_jsonl
+from parquet_sink import ParquetResultSink, invoice_row
+from review_queue import (
+    configure_review_queue, close_review_queue, get_review_queue, sync_review_queue_every, DEFAULT_DB, DEFAULT_JSON,
+    SYNC_INTERVAL as REVIEW_SYNC_INTERVAL,
+)
+from extraction_cache import configure_cache, get_cache
+from dedup import configure_dedup, get_dedup_index, DEFAULT_MAX_DISTANCE
+from image_prep import prepare_image, configure_encoding, get_encoding_profile, ENCODING_PROFILES
+from pdf_prep import prepare_pdf, is_pdf, configure_pdf, INPUT_EXTENSIONS, INPUT_ERRORS
+from blob_store import register_image, release_inputs
+from watcher import DirectoryWatcher
+from run_manifest import (
+    RUNS_DIR, FINISHED, OUTCOME_STATUS, RunManifest, new_run_id, run_dir, create_run, load_run, load_statuses, compact,
+    should_process, summarize, run_exists,
+)
+from orchestrator import limiter, configure_tiers, get_tier_llms, DEFAULT_MODEL_TIERS
+from llm_gateway import configure_hedging
+from instrumentation import enable_metrics, get_metrics, instrument_node, observe, inc, export_metrics
+from log_setup import setup_logging, log_fields, DEFAULT_LOG_FILE
+
+
+def setup_logger(args, log_file=None):
+    """Starts queue-based logging (see log_setup) with the CLI's log settings."""
+    return setup_logging(log_file or args.log_file, json_format=args.log_json, max_bytes=int(args.log_max_mb * 1024 * 1024),
+                         backup_count=args.log_backups, sample_rate=args.log_sample)
 
-    # Handler 2: File (agent.log)
-    fh = logging.FileHandler("agent.log", mode='w')  # mode='w' overwrites each run
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
 
-    # Silence noisy libraries that log at INFO level
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-    logging.getLogger("httpcore").setLevel(logging.WARNING)
-    logging.getLogger("googleapiclient").setLevel(logging.WARNING)
-
-    return logger
-setup_logger()
 logger = logging.getLogger(__name__)
 
 
 def compile_workflow():
     workflow = StateGraph(AgentState)
-    workflow.add_node("extract", extract_node)
-    workflow.add_node("audit", audit_node)
-    workflow.add_node("human_review", human_review_node)
-
-    workflow.set_entry_point("extract")
+    # Nodes are only wrapped when instrumentation was enabled before compiling
+    wrap = instrument_node if get_metrics() is not None else (lambda name, fn: fn)
+    workflow.add_node("extract", wrap("extract", extract_node))
+    workflow.add_node("audit", wrap("audit", audit_node))
+    workflow.add_node("reextract", wrap("reextract", reextract_node))
+    workflow.add_node("escalate", wrap("escalate", escalate_node))
+    workflow.add_node("human_review", wrap("human_review", human_review_node))
+    workflow.add_edge("reextract", "audit")
+    workflow.add_edge("escalate", "audit")
+
+    # Dedup nodes are only part of the graph when an index is configured
+    dedup = get_dedup_index() is not None
+    if dedup:
+        workflow.add_node("dedup", wrap("dedup", dedup_node))
+        workflow.add_node("dedup_key", wrap("dedup_key", dedup_key_node))
+        workflow.add_node("remember", wrap("remember", remember_node))
+        workflow.set_entry_point("dedup")
+        workflow.add_edge("dedup", "extract")
+        # Duplicates are only decided once the audit approved the extraction
+        workflow.add_conditional_edges("dedup_key", lambda state: END if is_duplicate(state) else "remember")
+        workflow.add_edge("human_review", "remember")
+    else:
+        workflow.set_entry_point("extract")
     workflow.add_edge("extract", "audit")
+    done = "dedup_key" if dedup else END
 
     def route_decision(state):
-        return "human_review" if state["safety_check"] == "flagged" else END
+        # Cheapest fix first: re-ask for the failing fields, then a stronger model, then a human
+        if should_reextract(state):
+            return "reextract"
+        if should_escalate(state):
+            return "escalate"
+        if state["safety_check"] == "flagged":
+            return "human_review"
+        # API errors are not remembered, so a retry is not mistaken for a duplicate
+        return done if state["safety_check"] == "pass" else END
 
     workflow.add_conditional_edges("audit", route_decision)
     return workflow.compile()
 
 
-def load_images_generator(source):
+def iter_image_paths(source):
     if os.path.isdir(source):
-        files = [os.path.join(source, f) for f in os.listdir(source) if f.endswith(('.jpg', '.png'))]
+        # scandir streams entries instead of materialising the whole listing
+        for entry in os.scandir(source):
+            if entry.is_file() and entry.name.endswith(INPUT_EXTENSIONS):
+                yield entry.path
     else:
-        files = [source]
+        yield source
 
-    logger.info(f"Found {len(files)} images in source.")
-
-    for path in files:
-        try:
-            with Image.open(path) as img:
-                img = img.convert('RGB')
-                b = io.BytesIO()
-                img.save(b, format='JPEG')
-                yield os.path.basename(path), b.getvalue()
-        except Exception as e:
-            logger.error(f"Could not load {path}: {e}")
 
+_DONE = object()  # Sentinel telling a worker that the producer is finished
 
-async def worker(app, semaphore, filename, img_bytes):
-    async with semaphore:
-        inputs = {"image_bytes": img_bytes, "image_path": filename, "messages": []}
-        # Use ainvoke for async
-        return await app.ainvoke(inputs)
 
+async def producer(queue, jobs, num_agents, pool, num_decoders, manifest=None):
+    """
+    Checks/normalises images in the process pool and feeds the bounded queue with image references.
+    PDFs are split into one pool task per page (see pdf_prep.prepare_pdf) but stay one queue item.
+    `jobs` yields (source, name) pairs where source is a path or raw image/PDF bytes; it may also be
+    an async iterable (e.g. watcher.DirectoryWatcher) that keeps yielding as files arrive.
+    queue.put() blocks while the queue is full, so decoding never runs far ahead of the agents.
+    """
+    loop = asyncio.get_running_loop()
+    loaded = 0
+    profile = get_encoding_profile()  # Pool workers do not share the parent's module state
+    with_dhash = get_dedup_index() is not None
 
-async def main(app, input_folder, num_agents, test_mode=None):
-    semaphore = asyncio.Semaphore(num_agents)
-    tasks = []
+    if hasattr(jobs, "__aiter__"):
+        async_jobs = aiter(jobs)
+        pulling = asyncio.Lock()  # An async generator cannot be advanced by two decoders at once
 
-    logger.info(f"Spawning Pool with {num_agents} Agents")
-    if test_mode is not None:
-        fname = test_mode[0]
-        ibytes = test_mode[1]
-        tasks.append(worker(app, semaphore, fname, ibytes))
+        async def next_job():
+            async with pulling:
+                return await anext(async_jobs, None)
     else:
-        for fname, ibytes in load_images_generator(input_folder):
-            tasks.append(worker(app, semaphore, fname, ibytes))
-
-    # Run all tasks, ignore crashes
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+        sync_jobs = iter(jobs)
+
+        async def next_job():
+            return next(sync_jobs, None)
+
+    async def decode():
+        nonlocal loaded
+        # Shared iterator: each decoder pulls the next job
+        while (job := await next_job()) is not None:
+            source, name = job
+            try:
+                if is_pdf(source, name):
+                    payload = await prepare_pdf(loop, pool, source, name, profile, with_dhash)
+                else:
+                    payload = await loop.run_in_executor(pool, prepare_image, source, name, profile, with_dhash)
+            except INPUT_ERRORS as e:
+                logger.error(f"Could not load {name or source}: {e}")
+                if manifest is not None:
+                    manifest.finish(name or os.path.basename(source), "unreadable")
+                continue
+            except Exception as e:
+                # Pool crashes, IO and memory trouble, missing PDF support: not the file's fault,
+                # so the file stays eligible for --resume / --retry-errors
+                logger.error(f"Could not prepare {name or source} ({type(e).__name__}): {e}")
+                if manifest is not None:
+                    manifest.finish(name or os.path.basename(source), "errored")
+                continue
+            loaded += 1
+            await queue.put((time.monotonic(), register_image(payload, source)))
+
+    try:
+        await asyncio.gather(*(decode() for _ in range(num_decoders)))
+        logger.info(f"Loaded {loaded} images from source.")
+    finally:
+        for _ in range(num_agents):
+            await queue.put(_DONE)
+
+
+# The only parts of a finished graph state that outlive the run
+RESULT_KEYS = ("image_path", "extraction", "safety_check", "model_tier", "review_reason", "flagged_fields", "duplicate_of")
+
+
+def slim_result(state):
+    return {key: state.get(key) for key in RESULT_KEYS}
+
+
+async def worker(app, queue, on_result, pacer=None, manifest=None, deadline=None):
+    while True:
+        item = await queue.get()
+        if item is _DONE:
+            return
+        enqueued_at, inputs = item
+        filename = inputs["image_path"]
+        inputs = {**inputs, "messages": []}
+        if pacer is not None:
+            await pacer.wait()
+        started = time.monotonic()
+        observe("queue_wait_seconds", started - enqueued_at)
+        if manifest is not None:
+            manifest.start(filename)
+        try:
+            # Use ainvoke for async
+            run = app.ainvoke(inputs)
+            res = slim_result(await (asyncio.wait_for(run, deadline) if deadline else run))
+        except asyncio.TimeoutError:
+            # Cancelling the run also cancels its model calls and frees their limiter slots
+            logger.warning(f"{filename} missed its {deadline:g}s deadline and was cancelled")
+            inc("invoice_deadline_exceeded_total")
+            res = {**slim_result(inputs), "safety_check": "errored", "review_reason": "deadline_exceeded"}
+        except Exception as e:
+            res = e
+        finally:
+            release_inputs(inputs)
+        seconds = time.monotonic() - started
+        observe("invoice_seconds", seconds)
+        if not isinstance(res, Exception):
+            logger.info("Finished %s: %s in %.2fs", filename, res.get('safety_check'), seconds,
+                        extra=log_fields(filename, "pipeline", decision=res.get('safety_check'), duration=seconds))
+        on_result(filename, res, seconds)
+
+
+class RatePacer:
+    """Spaces out submissions so that at most `rate` start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+async def run_pipeline(app, jobs, num_agents, output_file, queue_size=None, decode_workers=None, rate=None, metrics_dir=None,
+                       review_export=DEFAULT_JSON, manifest=None, deadline=None, parquet_dir=None, review_sync=None):
+    """
+    Streams `jobs` ((source, name) pairs) through decoding and the compiled graph in one event loop.
+    Approved invoices are appended to `output_file` as they finish. `review_export=None` skips
+    refreshing review_queue.json (worker processes leave that to the parent). Each invoice's
+    status is appended to `manifest` (a run_manifest.RunManifest) as it starts and finishes.
+    Invoices still running `deadline` seconds after they start are cancelled and count as errored.
+    With `parquet_dir`, approved and flagged invoices are also exported there (see parquet_sink).
+    `review_sync` (seconds) commits the review queue and refreshes `review_export` on a timer, for
+    runs that may never finish (--watch).
+    """
+    # Keep a small buffer of decoded images ahead of the agents, never the whole input
+    queue = asyncio.Queue(maxsize=queue_size or num_agents * 2)
+
+    sink = JsonlResultSink(output_file)
+    parquet = ParquetResultSink(parquet_dir) if parquet_dir else None
+    counts = {"success": 0, "fail": 0, "errored": 0, "duplicate": 0}
+    tier_counts = {}
+
+    def handle_result(filename, res, seconds):
+        # Handle each result as soon as its graph run finishes
+        if isinstance(res, Exception):
+            logger.critical(f"Worker crashed on {filename} with error: {res}")
+            return
 
-    approved_data = []
-    success_count = 0
-    fail_count = 0
+        if res.get('safety_check') == 'duplicate':
+            # The earlier copy's result is already in the sink or the review queue
+            counts["duplicate"] += 1
+            inc("invoices_total", outcome="duplicate")
+            return
 
-    for res in results:
-        if isinstance(res, Exception):
-            logger.critical(f"Worker crashed with error: {res}")
-            continue
+        tier = res.get('model_tier') or 0
+        tier_counts[tier] = tier_counts.get(tier, 0) + 1
+        inc("invoices_total", outcome=res.get('safety_check'), tier=tier)
 
         if res.get('safety_check') == 'pass':
             clean_json = res['extraction'].model_dump()
             clean_json['filename'] = res['image_path']
-            approved_data.append(clean_json)
-            success_count += 1
+            sink.write(clean_json)
+            counts["success"] += 1
+            if counts["success"] == 1:
+                logger.info(f"First invoice approved: {filename}")
+        elif res.get('safety_check') == 'errored':
+            counts["errored"] += 1
         else:
-            fail_count += 1
-
-    output_file = "approved_invoices.json" if test_mode is None else "approved_invoices_donut.json"
-    existing_data = []
+            counts["fail"] += 1
+        if parquet is not None and res.get('safety_check') != 'errored':
+            parquet.write(invoice_row(res['image_path'], "approved" if res['safety_check'] == 'pass' else "flagged",
+                                      res.get('extraction'), res.get('review_reason'), res.get('flagged_fields'),
+                                      get_tier_llms()[tier].name, tier, round(seconds, 3)))
+
+    def on_result(filename, res, seconds):
+        handle_result(filename, res, seconds)
+        if manifest is not None:
+            # Recorded after the sink write: a crash in between re-runs the invoice instead of losing it
+            status = "crashed" if isinstance(res, Exception) else OUTCOME_STATUS.get(res.get('safety_check'), "flagged")
+            if status == "flagged":
+                # Resume skips flagged files, so their review-queue row must be committed first
+                get_review_queue().flush()
+            manifest.finish(filename, status)
+
+    pacer = RatePacer(rate) if rate else None
 
-    if os.path.exists(output_file):
-        try:
-            with open(output_file, "r") as f:
-                file_content = json.load(f)
-                if isinstance(file_content, list):
-                    existing_data = file_content
-        except (json.JSONDecodeError, OSError):
-            pass  # Start fresh if file is corrupt or unreadable
-
-    existing_data.extend(approved_data)
+    logger.info(f"Spawning Pool with {num_agents} Agents")
 
-    with open(output_file, "w") as f:
-        json.dump(existing_data, f, indent=2, default=str)
+    # Image decoding/encoding is CPU-bound: keep it off the event loop
+    decode_workers = decode_workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=decode_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    workers = [asyncio.create_task(worker(app, queue, on_result, pacer, manifest, deadline)) for _ in range(num_agents)]
+    syncer = asyncio.create_task(sync_review_queue_every(review_sync, review_export)) if review_sync else None
+    try:
+        await producer(queue, jobs, num_agents, pool, decode_workers, manifest)
+        await asyncio.gather(*workers)
+    finally:
+        if syncer is not None:
+            syncer.cancel()
+        pool.shutdown(cancel_futures=True)
+        sink.close()
+        if parquet is not None:
+            parquet.close()
+        if manifest is not None:
+            manifest.close()
+        close_review_queue(review_export)
+
+    logger.info(f"Complete. Approved invoices appended to {output_file}")
+    logger.info(f"Success: {counts['success']} | Flagged for human review: {counts['fail']} | API errors: {counts['errored']} | Duplicates: {counts['duplicate']}")
+    for tier, llm in enumerate(get_tier_llms()):
+        logger.info(f"Tier {tier} finished {tier_counts.get(tier, 0)} invoices | {llm.summary()}")
+    if metrics_dir:
+        export_metrics(metrics_dir, {"output_file": output_file, "num_agents": num_agents, **counts})
+    if get_cache() is not None:
+        logger.info(get_cache().stats())
+    if get_dedup_index() is not None:
+        logger.info(get_dedup_index().stats())
+    return counts
+
+
+def run_jobs(input_path, statuses=None, retry_errors=False):
+    """(path, None) jobs for a run. Resumed runs (`statuses` from the manifest) skip finished files."""
+    if retry_errors:
+        # Straight from the manifest: the input folder is not listed again
+        return ((os.path.join(input_path, name) if os.path.isdir(input_path) else input_path, None)
+                for name, entry in statuses.items() if entry["status"] == "errored")
+    paths = iter_image_paths(input_path)
+    if statuses:
+        paths = (path for path in paths if should_process(os.path.basename(path), statuses))
+    return ((path, None) for path in paths)
+
+
+JOB_ORDERS = ("listing", "largest", "smallest", "priority")
+
+
+def load_priorities(path):
+    """Sidecar JSON {"filename": priority}; higher runs first, unlisted files count as 0."""
+    with open(path, "r", encoding="utf-8") as f:
+        return {os.path.basename(name): float(priority) for name, priority in json.load(f).items()}
+
+
+def order_jobs(jobs, order="listing", priorities=None):
+    """
+    Orders (path, name) jobs before they are queued. "listing" keeps streaming in directory
+    order; the other orders collect the paths (not the images) up front to sort them:
+    - largest: biggest files first, so slow invoices start early instead of finishing last;
+      this shortens the time until the whole batch is done.
+    - smallest: smallest files first, for the quickest first results.
+    - priority: by `priorities` (see load_priorities), ties largest first.
+    """
+    if order == "listing":
+        return jobs
+    sized = [(os.path.getsize(path), path, name) for path, name in jobs]
+    if order == "smallest":
+        sized.sort(key=lambda job: job[0])
+    elif order == "largest":
+        sized.sort(key=lambda job: -job[0])
+    else:
+        priorities = priorities or {}
+        sized.sort(key=lambda job: (-priorities.get(os.path.basename(job[1]), 0.0), -job[0]))
+    logger.info(f"Scheduling {len(sized)} invoices in {order} order")
+    return iter([(path, name) for _, path, name in sized])
+
+
+def open_run(args):
+    """
+    Creates the run directory for --run_id (default: a timestamp), or reopens the one named by
+    --resume. Returns (run path, statuses recorded by earlier attempts).
+    """
+    if args.resume:
+        run = load_run(args.resume, args.runs_dir)
+        args.input_path = args.input_path or run["input_path"]
+        path = run_dir(args.resume, args.runs_dir)
+        statuses = compact(path)
+        done = summarize(statuses)
+        logger.info(f"Resuming run {args.resume} over {args.input_path}: {sum(done.values())} files in the manifest {done}")
+        return path, statuses
+    run_id = args.run_id or new_run_id()
+    path = create_run(run_id, args.input_path, args.runs_dir)
+    logger.info(f"Run {run_id}: progress is recorded in {path} (continue it with --resume {run_id})")
+    return path, {}
+
+
+def watch_folder(input_folder, statuses=None, debounce=1.0, poll_interval=2.0):
+    """
+    DirectoryWatcher over `input_folder` that skips files the manifest already finished, and
+    stops (letting in-flight invoices drain) on SIGINT/SIGTERM.
+    """
+    seen = {name for name, entry in (statuses or {}).items() if entry["status"] in FINISHED}
+    watcher = DirectoryWatcher(input_folder, seen, debounce=debounce, poll_interval=poll_interval)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):  # No signal handlers on Windows event loops
+            loop.add_signal_handler(sig, watcher.stop)
+    return watcher
+
+
+async def main(app, input_folder, num_agents, test_mode=None, queue_size=None, decode_workers=None, metrics_dir=None,
+               run_path=None, statuses=None, retry_errors=False, watch=None, order="listing", priorities=None,
+               deadline=None, parquet_dir=None):
+    """
+    `watch` = {"debounce": s, "poll_interval": s} keeps feeding new files from `input_folder` until
+    stopped. `order`/`priorities` schedule a one-off run (see order_jobs).
+    """
+    manifest = None
+    if test_mode is not None:
+        jobs = iter([(test_mode[1], test_mode[0])])
+    elif watch is not None:
+        jobs = watch_folder(input_folder, statuses, **watch)
+        if run_path is not None:
+            manifest = RunManifest(run_path, statuses)
+    else:
+        jobs = order_jobs(run_jobs(input_folder, statuses, retry_errors), order, priorities)
+        if run_path is not None:
+            manifest = RunManifest(run_path, statuses)
+
+    output_file = "approved_invoices.jsonl" if test_mode is None else "approved_invoices_donut.jsonl"
+    return await run_pipeline(app, jobs, num_agents, output_file, queue_size=queue_size, decode_workers=decode_workers,
+                              metrics_dir=metrics_dir, manifest=manifest, deadline=deadline, parquet_dir=parquet_dir,
+                              review_sync=REVIEW_SYNC_INTERVAL if watch is not None else None)
+
+
+def shard_of(name, workers):
+    """Stable worker index for a file name (identical across processes and runs, unlike hash())."""
+    digest = hashlib.blake2b(os.path.basename(name).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % workers
+
+
+def split_budget(total, workers, index):
+    """Share of an integer budget for worker `index`; the remainder goes to the first workers."""
+    return max(1, total // workers + (1 if index < total % workers else 0))
+
+
+def add_pipeline_arguments(parser):
+    """Flags shared by every entry point that runs the workflow (main.py, service.py)."""
+    parser.add_argument("--rps", type=float, default=None, help="Max model requests per second")
+    parser.add_argument("--tpm", type=float, default=None, help="Max model tokens per minute (estimated)")
+    parser.add_argument("--max_retries", type=int, default=4, help="Retries for 429/5xx responses before giving up")
+    parser.add_argument("--models", type=str, default=",".join(DEFAULT_MODEL_TIERS), help="Comma-separated model cascade, cheapest first")
+    parser.add_argument("--confidence_threshold", type=float, default=0.85, help="Min confidence on critical fields to auto-approve")
+    parser.add_argument("--escalate_below", type=float, default=None, help="Min confidence to accept a non-final tier without escalating (default: --confidence_threshold)")
+    parser.add_argument("--reextract_attempts", type=int, default=1, help="Targeted re-extractions of flagged fields per invoice (0 disables)")
+    parser.add_argument("--log_file", type=str, default=DEFAULT_LOG_FILE, help="Log file, appended to and rotated by size (--workers: one per worker)")
+    parser.add_argument("--log_json", action="store_true", help="Write the log file as JSON lines with filename/node/duration/decision fields")
+    parser.add_argument("--log_max_mb", type=float, default=50, help="Log file size that triggers a rotation")
+    parser.add_argument("--log_backups", type=int, default=5, help="Rotated log files to keep")
+    parser.add_argument("--log_sample", type=float, default=1.0, help="Share of invoices whose per-invoice INFO lines are logged (warnings are always kept)")
+    parser.add_argument("--metrics_dir", type=str, default=None, help="Enable instrumentation and write metrics.prom/run_summary.json here")
+    parser.add_argument("--parquet_dir", type=str, default=None, help="Also export approved and flagged invoices as a Parquet dataset partitioned by run date")
+    parser.add_argument("--review_backend", choices=["sqlite", "json"], default="sqlite", help="Storage for flagged invoices (default: sqlite)")
+    parser.add_argument("--review_path", type=str, default=None, help="Review queue location (default: review_queue.db / review_queue.json)")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help="Disable the extraction cache")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached extractions but store the fresh results")
+    parser.add_argument("--cache_path", type=str, default="extraction_cache.db", help="Extraction cache location")
+    parser.add_argument("--cache_max_mb", type=float, default=512, help="Extraction cache size limit in MB (LRU eviction)")
+    parser.add_argument("--encoding_profile", choices=list(ENCODING_PROFILES), default="original", help="How images are encoded before sending (see image_prep.ENCODING_PROFILES)")
+    parser.add_argument("--max_long_edge", type=int, default=None, help="Override the profile's max long edge in pixels")
+    parser.add_argument("--jpeg_quality", type=int, default=None, help="Override the profile's JPEG quality")
+    parser.add_argument("--grayscale", action="store_true", default=None, help="Send grayscale images")
+    parser.add_argument("--autocrop", action="store_true", default=None, help="Trim white page margins")
+    parser.add_argument("--pdf_dpi", type=int, default=150, help="Resolution PDF pages are rasterized at")
+    parser.add_argument("--pdf_text", choices=["auto", "both", "off"], default="auto", help="Send a PDF page's text layer instead of (auto) or next to (both) its image, or never (off)")
+    parser.add_argument("--pdf_max_pages", type=int, default=8, help="Pages sent per PDF; longer documents keep their first pages and the last one")
+    parser.add_argument("--dedup", action="store_true", help="Keep invoices that were already approved out of the outputs (image hash or number/IBAN/amount)")
+    parser.add_argument("--dedup_path", type=str, default="dedup_index.db", help="Persistent duplicate index location")
+    parser.add_argument("--dedup_distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help=f"Max differing gradient cells (of 1024) between near-duplicate images (at most {DEFAULT_MAX_DISTANCE})")
+    parser.add_argument("--batch_size", type=int, default=1, help="Invoices per model request (1 disables batching)")
+    parser.add_argument("--batch_linger_ms", type=float, default=50, help="How long a batch waits to fill up")
+    parser.add_argument("--deadline", type=float, default=None, help="Seconds an invoice may take before it is cancelled and counted as an API error")
+    parser.add_argument("--hedge_max_ratio", type=float, default=0.0, help="Max share of model calls that may be hedged (0 disables hedging)")
+    parser.add_argument("--hedge_quantile", type=float, default=0.95, help="Observed latency quantile after which a request is hedged")
+    return parser
+
+
+def configure_pipeline(args, num_agents, rps=None, tpm=None):
+    """Applies the CLI settings to the process-wide singletons and compiles the graph."""
+    configure_review_queue(args.review_backend, args.review_path)
+    configure_cache(not args.no_cache, args.refresh, args.cache_path, args.cache_max_mb)
+    configure_dedup(args.dedup, args.dedup_path, args.dedup_distance)
+    limiter.configure(rps=rps, tpm=tpm, max_concurrency=num_agents)
+    for tier_llm in configure_tiers(args.models.split(",")):
+        tier_llm.retry.max_attempts = args.max_retries + 1
+    configure_audit(args.confidence_threshold, args.escalate_below)
+    configure_reextract(args.reextract_attempts)
+    configure_batching(args.batch_size, args.batch_linger_ms)
+    configure_hedging(args.hedge_max_ratio, args.hedge_quantile)
+    configure_encoding(args.encoding_profile, max_long_edge=args.max_long_edge, quality=args.jpeg_quality,
+                       grayscale=args.grayscale, autocrop=args.autocrop)
+    configure_pdf(args.pdf_dpi, args.pdf_text, args.pdf_max_pages)
+    if args.metrics_dir:
+        enable_metrics()
+    return compile_workflow()
+
+
+def worker_process(args, index, workers, output_file, run_path=None):
+    """
+    Entry point of one --workers process: its own graph, event loop and decode pool, the files
+    whose name hashes to `index`, and a 1/workers share of the agent and rate budgets.
+    Progress goes to the worker's own manifest shard in `run_path`.
+    """
+    setup_logger(args, worker_output(args.log_file, index))
+    num_agents = split_budget(args.num_agents, workers, index)
+    rps = args.rps / workers if args.rps else None
+    tpm = args.tpm / workers if args.tpm else None
+    decode_workers = args.decode_workers or max(1, (os.cpu_count() or 1) // workers)
+    app = configure_pipeline(args, num_agents, rps, tpm)
+
+    statuses = load_statuses(run_path) if run_path else None
+    manifest = RunManifest(run_path, statuses, shard=index) if run_path else None
+    jobs = (job for job in run_jobs(args.input_path, statuses, args.retry_errors) if shard_of(job[0], workers) == index)
+    priorities = load_priorities(args.priority_file) if args.priority_file else None
+    jobs = order_jobs(jobs, args.order, priorities)
+    metrics_dir = os.path.join(args.metrics_dir, f"worker{index}") if args.metrics_dir else None
+    return asyncio.run(run_pipeline(app, jobs, num_agents, worker_output(output_file, index), queue_size=args.queue_size,
+                                    decode_workers=decode_workers, metrics_dir=metrics_dir, review_export=None,
+                                    manifest=manifest, deadline=args.deadline, parquet_dir=args.parquet_dir))
+
+
+def worker_output(output_file, index):
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.worker{index}{ext}"
+
+
+def merge_shards(output_file, workers):
+    """Appends every worker's JSONL shard to `output_file` and removes the shards. Torn last lines are dropped."""
+    merged = 0
+    with JsonlResultSink(output_file) as sink:
+        for index in range(workers):
+            shard = worker_output(output_file, index)
+            if not os.path.exists(shard):
+                continue
+            for record in iter_jsonl(shard):
+                sink.write(record)
+                merged += 1
+            os.remove(shard)
+    return merged
+
+
+def run_multiprocess(args, output_file="approved_invoices.jsonl", run_path=None):
+    """
+    --workers mode. Workers share the SQLite review queue and extraction cache (WAL, busy timeout);
+    both are created here first so the workers never race on schema setup or the legacy import.
+    """
+    workers = args.workers
+    args.review_backend = "sqlite"
+    args.review_path = args.review_path or DEFAULT_DB
+    configure_review_queue("sqlite", args.review_path)
+    close_review_queue(export_path=None)
+    if not args.no_cache:
+        configure_cache(True, path=args.cache_path, max_mb=args.cache_max_mb)
+        configure_cache(False)
+    if args.dedup:
+        configure_dedup(True, args.dedup_path, args.dedup_distance)
+        configure_dedup(False)
+
+    logger.info(f"Starting {workers} worker processes for {args.num_agents} agents")
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        futures = [pool.submit(worker_process, args, index, workers, output_file, run_path) for index in range(workers)]
+        totals = {"success": 0, "fail": 0, "errored": 0, "duplicate": 0}
+        for index, future in enumerate(futures):
+            try:
+                counts = future.result()
+            except Exception as e:
+                logger.critical(f"Worker process {index} crashed: {e}")
+                continue
+            for key in totals:
+                totals[key] += counts.get(key, 0)
+
+    merged = merge_shards(output_file, workers)
+    configure_review_queue("sqlite", args.review_path)
+    close_review_queue(DEFAULT_JSON)
+    logger.info(f"Merged {merged} approved invoices into {output_file}")
+    logger.info(f"Success: {totals['success']} | Flagged for human review: {totals['fail']} | API errors: {totals['errored']} | Duplicates: {totals['duplicate']}")
+    return totals
 
-    logger.info(f"Complete.")
-    logger.info(f"Success: {success_count} | Flagged for human review: {fail_count}")
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Invoice Processing CLI")
-    parser.add_argument("--input_path", required=True, type=str, help="Path to an image file or directory of images")
+    parser.add_argument("--input_path", type=str, default=None, help="Path to an image file or directory of images (default with --resume: the run's)")
     parser.add_argument("--num_agents", required=True, type=int, default=1, help="Number of agents to work in parallel")
+    parser.add_argument("--queue_size", type=int, default=None, help="Max images buffered ahead of the agents (default: 2 x num_agents)")
+    parser.add_argument("--decode_workers", type=int, default=None, help="Processes used to decode/encode images (default: CPU count, split across --workers)")
+    parser.add_argument("--workers", type=int, default=1, help="Pipeline processes; files are split between them by name hash")
+    parser.add_argument("--run_id", type=str, default=None, help="Name of this run's manifest directory (default: a timestamp)")
+    parser.add_argument("--resume", type=str, default=None, metavar="RUN_ID", help="Continue a run: only unfinished, errored or crashed files")
+    parser.add_argument("--retry_errors", "--retry-errors", action="store_true", help="With --resume, only replay files that failed with API errors")
+    parser.add_argument("--runs_dir", type=str, default=RUNS_DIR, help="Where run manifests are kept")
+    parser.add_argument("--order", choices=JOB_ORDERS, default=None, help="Processing order (default: listing, or priority with --priority_file)")
+    parser.add_argument("--priority_file", type=str, default=None, help='JSON sidecar {"filename": priority}; higher is processed first')
+    parser.add_argument("--watch", action="store_true", help="Keep running and process images as they are added to --input_path")
+    parser.add_argument("--watch_debounce", type=float, default=1.0, help="Seconds a new file must stay unchanged before it is read")
+    parser.add_argument("--poll_interval", type=float, default=2.0, help="Folder listing interval when inotify is unavailable")
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
+    setup_logger(args)
+    if not args.input_path and not args.resume:
+        parser.error("--input_path is required unless --resume is given")
+    if args.retry_errors and not args.resume:
+        parser.error("--retry_errors needs --resume <run-id>")
+    args.order = args.order or ("priority" if args.priority_file else "listing")
+    if args.order == "priority" and not args.priority_file:
+        parser.error("--order priority needs --priority_file")
+    if args.watch:
+        if args.order != "listing":
+            parser.error("--watch processes files as they arrive and cannot reorder them")
+        if args.workers > 1 or args.retry_errors:
+            parser.error("--watch runs in a single process and cannot be combined with --workers or --retry_errors")
+        if args.input_path and not os.path.isdir(args.input_path):
+            parser.error("--watch needs a directory as --input_path")
+        # A watch run keeps one manifest across restarts: it doubles as the persisted seen-set
+        args.run_id = args.run_id or f"watch-{os.path.basename(os.path.abspath(args.input_path or '.'))}"
+        if not args.resume and run_exists(args.run_id, args.runs_dir):
+            args.resume = args.run_id
+    try:
+        run_path, statuses = open_run(args)
+    except ValueError as e:
+        parser.error(str(e))
 
     input_path = args.input_path
     num_agents = args.num_agents
 
-    app = compile_workflow()
-    asyncio.run(main(app, input_path, num_agents))
+    if args.workers > 1:
+        run_multiprocess(args, run_path=run_path)
+    else:
+        app = configure_pipeline(args, num_agents, args.rps, args.tpm)
+        watch = {"debounce": args.watch_debounce, "poll_interval": args.poll_interval} if args.watch else None
+        priorities = load_priorities(args.priority_file) if args.priority_file else None
+        asyncio.run(main(app, input_path, num_agents, queue_size=args.queue_size, decode_workers=args.decode_workers,
+                         metrics_dir=args.metrics_dir, run_path=run_path, statuses=statuses, retry_errors=args.retry_errors,
+                         watch=watch, order=args.order, priorities=priorities, deadline=args.deadline,
+                         parquet_dir=args.parquet_dir))
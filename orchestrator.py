@@ -1,12 +1,15 @@
 import os
+import json
 import asyncio
+import hashlib
 from typing import TypedDict, List, Optional, Union
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, create_model
 from dotenv import find_dotenv, load_dotenv
 load_dotenv(find_dotenv())
 
 
 from langchain_google_genai import ChatGoogleGenerativeAI
+from llm_gateway import AdaptiveLimiter, ThrottledLLM
 
 file_write_lock = asyncio.Lock()
 
@@ -28,22 +31,121 @@ class GermanInvoice(BaseModel):
     iban: ExtractField = Field(..., description="International Bank Account Number")
 
 
+class BatchedInvoice(GermanInvoice):
+    filename: str = Field(..., description="The filename label given right before this invoice's image")
+
+
+class InvoiceBatch(BaseModel):
+    """Structured output for one multi-invoice request (see batching.py)."""
+    invoices: List[BatchedInvoice] = Field(..., description="One entry per invoice image, in the order given")
+
+
+# Changes whenever a field, type or description in the schema changes; part of the cache key
+SCHEMA_VERSION = hashlib.sha256(
+    json.dumps(GermanInvoice.model_json_schema(), sort_keys=True).encode("utf-8")
+).hexdigest()[:16]
+
+
 # --- State Definition ---
 class AgentState(TypedDict):
-    image_bytes: bytes
+    image_ref: Optional[str]  # File path or blob-store key of the JPEG (see blob_store); bytes are loaded only to call the model
+    image_sha256: str  # Digest of the JPEG bytes, used as the content key for caching
     image_path: str
+    image_dhash: Optional[tuple]  # (coarse, fine) perceptual hashes, only set when dedup is enabled
+    document_pages: Optional[List[dict]]  # PDFs only: {"page", "ref", "text"} per sent page (see pdf_prep)
     extraction: Optional[GermanInvoice]
-    safety_check: str  # "pass" or "flagged"
+    safety_check: str  # "pass", "flagged", "errored" (API failure after retries) or "duplicate"
+    image_match: Optional[tuple]  # (filename, outcome, extraction_json) of a near-identical earlier image
+    duplicate_of: Optional[str]  # Earlier filename this invoice duplicates
+    model_tier: int  # Index into orchestrator.tier_llms of the model that produced `extraction`
+    reextract_attempts: int  # Targeted re-extractions spent on this invoice
+    review_reason: Optional[str]  # Why audit flagged the invoice, e.g. "low_confidence"
+    flagged_fields: List[str]  # Critical fields that failed the audit
     messages: List[str]
 
 
 # --- Model Setup ---
-# Gemini 2.0 Flash is excellent for vision + structured data
-llm = ChatGoogleGenerativeAI(
-    model="gemini-3-pro-image-preview",
-    temperature=0.0, # Low temp for extraction tasks
-)
-structured_llm = llm.with_structured_output(GermanInvoice)
+# Cascade tiers, cheapest first: every invoice starts on the fast tier and only
+# flagged ones are escalated to the next (stronger) model before human review.
+FAST_MODEL_NAME = "gemini-2.5-flash"
+MODEL_NAME = "gemini-3-pro-image-preview"
+DEFAULT_MODEL_TIERS = [FAST_MODEL_NAME, MODEL_NAME]
+
+# Every model call shares one limiter; main.py configures the budgets from the CLI
+limiter = AdaptiveLimiter()
+
+
+def build_chat_model(model_name):
+    return ChatGoogleGenerativeAI(
+        model=model_name,
+        temperature=0.0, # Low temp for extraction tasks
+        # One attempt per call: ThrottledLLM does the retries, and has to see every 429 to back off
+        max_retries=1,
+    )
+
+
+def build_structured_llm(model_name, chat_model=None):
+    llm = chat_model or build_chat_model(model_name)
+    # include_raw keeps the AIMessage so ThrottledLLM can record token usage
+    return ThrottledLLM(llm.with_structured_output(GermanInvoice, include_raw=True), limiter, name=model_name)
+
+
+tier_llms = []
+tier_chat_models = []
+_field_llms = {}
+_batch_llms = {}
+
+
+def configure_tiers(model_names, chat_factory=build_chat_model):
+    """
+    Builds one structured client per tier. A single model disables the cascade.
+    `chat_factory` maps a model name to a chat model (bench.py passes a local fake).
+    """
+    global tier_llms, tier_chat_models, structured_llm
+    tier_chat_models = [chat_factory(name) for name in model_names]
+    tier_llms = [build_structured_llm(name, chat) for name, chat in zip(model_names, tier_chat_models)]
+    structured_llm = tier_llms[0]
+    _field_llms.clear()
+    _batch_llms.clear()
+    return tier_llms
+
+
+def get_tier_llms():
+    return tier_llms
+
+
+def field_subset_model(fields):
+    """A GermanInvoice-shaped model containing only `fields`, for targeted re-extraction."""
+    return create_model(
+        "InvoiceFields_" + "_".join(fields),
+        **{name: (ExtractField, GermanInvoice.model_fields[name]) for name in fields},
+    )
+
+
+def get_field_llm(tier, fields):
+    """Structured client for tier `tier` that only asks for `fields` (cached per field set)."""
+    fields = tuple(sorted(fields))
+    key = (tier, fields)
+    if key not in _field_llms:
+        name = tier_llms[tier].name
+        schema = field_subset_model(fields)
+        _field_llms[key] = ThrottledLLM(
+            tier_chat_models[tier].with_structured_output(schema, include_raw=True), limiter, name=f"{name}:fields"
+        )
+    return _field_llms[key]
+
+
+def get_batch_llm(tier):
+    """Structured client for tier `tier` that returns an InvoiceBatch for a multi-image request."""
+    if tier not in _batch_llms:
+        _batch_llms[tier] = ThrottledLLM(
+            tier_chat_models[tier].with_structured_output(InvoiceBatch, include_raw=True), limiter,
+            name=f"{tier_llms[tier].name}:batch",
+        )
+    return _batch_llms[tier]
+
+
+configure_tiers(DEFAULT_MODEL_TIERS)
 
 # import os
 # import google.generativeai as genai
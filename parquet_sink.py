@@ -0,0 +1,210 @@
+"""
+Columnar export of finished invoices for analytics. Needs the optional pyarrow dependency
+(pip install pyarrow).
+
+Approved and flagged results are written as a Hive-partitioned Parquet dataset, one
+partition per run date:
+
+    parquet/run_date=2024-03-14/part-1710403200-4711-0000.parquet
+
+Every field of GermanInvoice becomes a typed value column plus a `<field>_confidence` column
+(total_amount is a decimal, invoice_date/due_date are dates, the rest strings), next to the
+filename, outcome, review reason, model, tier, latency and processing time. Files are only ever
+added: each flush writes a new part file (under a hidden temp name, then renamed), so earlier
+partitions are never rewritten and readers never see a partial file. Rows are buffered until
+`rows_per_file` or `flush_interval`; the JSONL sink stays the crash-safe record.
+
+    import pyarrow.dataset as ds
+    dataset = ds.dataset("parquet", format="parquet", partitioning="hive")
+    dataset.to_table(filter=ds.field("iban") == "DE89370400440532013000").to_pandas()
+
+Approved invoices from an existing JSONL file can be converted with:
+
+    python parquet_sink.py convert approved_invoices.jsonl parquet/ --run_date 2024-03-14
+"""
+
+import argparse
+import os
+import re
+import time
+import logging
+from datetime import date, datetime, timezone
+from decimal import Decimal, InvalidOperation
+from orchestrator import GermanInvoice
+from result_sink import iter_jsonl
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional dependency, only needed for --parquet_dir
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+INVOICE_FIELDS = list(GermanInvoice.model_fields)
+DECIMAL_FIELDS = ("total_amount",)
+DATE_FIELDS = ("invoice_date", "due_date")
+CENTS = Decimal("0.01")
+MAX_AMOUNT = Decimal("1e16")  # decimal128(18, 2) holds 16 integer digits
+
+
+def _schema():
+    columns = [
+        ("filename", pa.string()),
+        ("outcome", pa.string()),  # "approved" or "flagged"
+        ("review_reason", pa.string()),
+        ("flagged_fields", pa.list_(pa.string())),
+        ("model", pa.string()),
+        ("model_tier", pa.int8()),
+        ("latency_seconds", pa.float64()),
+        ("processed_at", pa.timestamp("ms", tz="UTC")),
+    ]
+    for name in INVOICE_FIELDS:
+        if name in DECIMAL_FIELDS:
+            value_type = pa.decimal128(18, 2)
+        elif name in DATE_FIELDS:
+            value_type = pa.date32()
+        else:
+            value_type = pa.string()
+        columns += [(name, value_type), (f"{name}_confidence", pa.float32())]
+    return pa.schema(columns)
+
+
+def to_decimal(value):
+    """Amount as a 2-place Decimal; accepts floats and "1.050,50"/"1,050.50 €" strings. None if unparseable."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        text = re.sub(r"[^0-9,.\-]", "", value)
+        if "," in text and "." in text:
+            # Whichever separator comes last is the decimal one
+            thousands = "." if text.rfind(",") > text.rfind(".") else ","
+            text = text.replace(thousands, "")
+        value = text.replace(",", ".")
+    try:
+        amount = Decimal(str(value)).quantize(CENTS)
+    except (InvalidOperation, ValueError):
+        return None
+    return amount if amount.is_finite() and abs(amount) < MAX_AMOUNT else None
+
+
+def to_date(value):
+    """ISO (YYYY-MM-DD, as the prompt asks) or German DD.MM.YYYY date; None if unparseable."""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, "%d.%m.%Y").date()
+    except ValueError:
+        return None
+
+
+def invoice_row(filename, outcome, extraction, review_reason=None, flagged_fields=None, model=None,
+                model_tier=None, latency_seconds=None, processed_at=None):
+    """One flat row; `extraction` is a GermanInvoice, its model_dump(), or None (fields stay null)."""
+    if extraction is not None and not isinstance(extraction, dict):
+        extraction = extraction.model_dump()
+    row = {
+        "filename": filename,
+        "outcome": outcome,
+        "review_reason": review_reason,
+        "flagged_fields": list(flagged_fields) if flagged_fields else None,
+        "model": model,
+        "model_tier": model_tier,
+        "latency_seconds": latency_seconds,
+        "processed_at": processed_at or datetime.now(timezone.utc),
+    }
+    for name in INVOICE_FIELDS:
+        field = (extraction or {}).get(name) or {}
+        value = field.get("value")
+        if name in DECIMAL_FIELDS:
+            value = to_decimal(value)
+        elif name in DATE_FIELDS:
+            value = to_date(value)
+        elif value is not None:
+            value = str(value)
+        row[name] = value
+        row[f"{name}_confidence"] = field.get("confidence")
+    return row
+
+
+class ParquetResultSink:
+    """
+    Buffers rows and writes them as new part files under `root`/run_date=<run_date>/.
+    `run_date` defaults to today, so a whole run lands in one partition.
+    """
+
+    def __init__(self, root, run_date=None, rows_per_file=10000, flush_interval=60.0):
+        if pa is None:
+            raise RuntimeError("Parquet export needs pyarrow: pip install pyarrow")
+        self.root = root
+        self.run_date = run_date or time.strftime("%Y-%m-%d")
+        self.rows_per_file = rows_per_file
+        self.flush_interval = flush_interval
+        self.count = 0
+        self.files = 0
+        self._schema = _schema()
+        self._rows = []
+        self._last_flush = time.monotonic()
+        self._partition = os.path.join(root, f"run_date={self.run_date}")
+        self._prefix = f"part-{int(time.time())}-{os.getpid()}"
+
+    def write(self, row):
+        self._rows.append(row)
+        self.count += 1
+        if len(self._rows) >= self.rows_per_file or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._rows:
+            return
+        os.makedirs(self._partition, exist_ok=True)
+        while True:
+            path = os.path.join(self._partition, f"{self._prefix}-{self.files:04d}.parquet")
+            self.files += 1
+            if not os.path.exists(path):  # Never replace a file written by an earlier run
+                break
+        # Dot-prefixed files are ignored by dataset readers until the rename
+        tmp_path = os.path.join(self._partition, f".{os.path.basename(path)}.tmp")
+        pq.write_table(pa.Table.from_pylist(self._rows, schema=self._schema), tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+        logger.info(f"Wrote {len(self._rows)} rows to {path}")
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert_jsonl(jsonl_path, root, run_date=None):
+    """Writes approved invoices from a JSONL sink file (model and latency are unknown there)."""
+    with ParquetResultSink(root, run_date) as sink:
+        for record in iter_jsonl(jsonl_path):
+            sink.write(invoice_row(record.get("filename"), "approved", record))
+    logger.info(f"Converted {sink.count} records from {jsonl_path} into {root}")
+    return sink.count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Parquet export utilities")
+    sub = parser.add_subparsers(dest="command", required=True)
+    convert = sub.add_parser("convert", help="Add approved invoices from a JSONL result file to a Parquet dataset")
+    convert.add_argument("jsonl_path", type=str)
+    convert.add_argument("root", type=str)
+    convert.add_argument("--run_date", type=str, default=None, help="Partition to write (default: today)")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_jsonl(args.jsonl_path, args.root, args.run_date)
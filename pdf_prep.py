@@ -0,0 +1,148 @@
+"""
+PDF ingestion. Needs the optional PyMuPDF dependency (pip install pymupdf).
+
+A PDF becomes one graph input, so a multi-page invoice is extracted in one request and yields
+one GermanInvoice. The pool tasks here follow image_prep: inspect_pdf reads the page count and
+text layer, then render_page rasterizes the pages that need an image, one pool task per page,
+so the pages of a document render in parallel. Rendered pages go to the blob store; nothing is
+written to disk.
+
+Pages with a usable text layer can be sent as text instead of an image (`text="auto"`), which
+is a small fraction of the request size, or next to it (`"both"`). `"off"` always rasterizes.
+"""
+
+import asyncio
+import hashlib
+import os
+import logging
+from PIL import Image, UnidentifiedImageError
+from image_prep import encode_image
+from dedup import dhash_image
+
+try:
+    import pymupdf
+except ImportError:  # Optional dependency; older releases only provide the `fitz` name
+    try:
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+
+logger = logging.getLogger(__name__)
+
+
+class UnsupportedInputError(RuntimeError):
+    """The input is in a format this installation cannot read (a PDF without PyMuPDF)."""
+
+
+# Errors meaning the input itself cannot be decoded, as opposed to pool crashes or IO trouble
+INPUT_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, ValueError) + (
+    (pymupdf.FileDataError,) if pymupdf is not None else ())
+
+PDF_MAGIC = b"%PDF"
+INPUT_EXTENSIONS = (".jpg", ".png", ".pdf")  # What folder inputs and the watcher pick up
+MIN_TEXT_CHARS = 40  # A page with less text than this is treated as a scan and rasterized
+DHASH_DPI = 36  # Enough for the 32x32 duplicate hash
+
+pdf_settings = {"dpi": 150, "text": "auto", "max_pages": 8}
+
+
+def configure_pdf(dpi=150, text="auto", max_pages=8):
+    if text not in ("auto", "both", "off"):
+        raise ValueError(f"Unknown PDF text mode: {text} (choose from auto, both, off)")
+    pdf_settings["dpi"] = dpi
+    pdf_settings["text"] = text
+    pdf_settings["max_pages"] = max_pages
+
+
+def is_pdf(source, name=None):
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source[:4]) == PDF_MAGIC
+    return str(name or source).lower().endswith(".pdf")
+
+
+def _open(source):
+    if pymupdf is None:
+        raise UnsupportedInputError("PDF input needs PyMuPDF: pip install pymupdf")
+    if isinstance(source, (bytes, bytearray)):
+        return pymupdf.open(stream=bytes(source), filetype="pdf")
+    return pymupdf.open(source)
+
+
+def select_pages(page_count, max_pages):
+    """Page indices to send: all of them, or the first max_pages - 1 plus the last (where the totals are)."""
+    if page_count <= max_pages:
+        return list(range(page_count))
+    return list(range(max_pages - 1)) + [page_count - 1]
+
+
+def inspect_pdf(source, max_pages, with_text):
+    """Pool task: page count, the pages to send and, with `with_text`, their text layers."""
+    with _open(source) as doc:
+        pages = select_pages(doc.page_count, max_pages)
+        texts = {}
+        if with_text:
+            for index in pages:
+                text = doc[index].get_text("text", sort=True).strip()
+                if len(text) >= MIN_TEXT_CHARS:
+                    texts[index] = text
+        return {"page_count": doc.page_count, "pages": pages, "texts": texts}
+
+
+def _render(source, index, dpi, grayscale):
+    with _open(source) as doc:
+        pix = doc[index].get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY if grayscale else pymupdf.csRGB, alpha=False)
+        return Image.frombytes("L" if grayscale else "RGB", (pix.width, pix.height), pix.samples)
+
+
+def render_page(source, index, dpi, profile):
+    """Pool task: one page as (JPEG bytes, sha256 hex), encoded with the active profile."""
+    jpeg = encode_image(_render(source, index, dpi, profile.get("grayscale")), profile)
+    return jpeg, hashlib.sha256(jpeg).hexdigest()
+
+
+def page_dhash(source, index=0):
+    """Pool task: duplicate-detection hash of a low-resolution render of one page."""
+    return dhash_image(_render(source, index, DHASH_DPI, True))
+
+
+async def prepare_pdf(loop, pool, source, name, profile, with_dhash=False):
+    """
+    Counterpart of image_prep.prepare_image for PDFs, run from the event loop: fans the pages out
+    to `pool` and returns a payload for blob_store.register_image with one entry per sent page.
+    """
+    if not isinstance(source, (bytes, bytearray)):
+        name = name or os.path.basename(source)
+    mode = pdf_settings["text"]
+    info = await loop.run_in_executor(pool, inspect_pdf, source, pdf_settings["max_pages"], mode != "off")
+    if not info["pages"]:
+        raise ValueError("PDF has no pages")
+    texts = info["texts"]
+    to_render = [index for index in info["pages"] if mode != "auto" or index not in texts]
+
+    # One pool task per page, so a document's pages render in parallel
+    rendered = await asyncio.gather(*(loop.run_in_executor(pool, render_page, source, index, pdf_settings["dpi"], profile)
+                                      for index in to_render))
+    images = dict(zip(to_render, rendered))
+    image_dhash = None
+    if with_dhash:
+        image_dhash = await loop.run_in_executor(pool, page_dhash, source, info["pages"][0])
+
+    pages = []
+    digest = hashlib.sha256(f"pdf:{mode}".encode("utf-8"))
+    for index in info["pages"]:
+        jpeg, page_sha = images.get(index, (None, None))
+        text = texts.get(index)
+        pages.append({"page": index + 1, "image_bytes": jpeg, "text": text})
+        digest.update(f"|{index}|{page_sha}|".encode("utf-8"))
+        digest.update((text or "").encode("utf-8"))
+
+    if info["page_count"] > len(info["pages"]):
+        logger.warning(f"{name}: {info['page_count']} pages, sending {len(info['pages'])} (first pages and the last)")
+    logger.info(f"{name}: {len(pages)} pages, {len(texts)} from the text layer, {len(to_render)} rasterized at {pdf_settings['dpi']} dpi")
+    return {
+        "image_path": name,
+        "pages": pages,
+        "page_count": info["page_count"],
+        "image_sha256": digest.hexdigest(),
+        "image_dhash": image_dhash,
+    }
@@ -0,0 +1,122 @@
+"""
+Append-only result storage.
+
+Approved invoices are written one JSON object per line as soon as they finish, so a crash
+only loses the records that were not yet fsynced. The pretty JSON array used by evaluate.py
+is built offline with:
+
+    python result_sink.py export approved_invoices.jsonl approved_invoices.json
+"""
+
+import argparse
+import json
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JsonlResultSink:
+    """
+    Appends one record per line. The file is flushed after every write and fsynced every
+    `fsync_every` records or `fsync_interval` seconds, whichever comes first.
+    """
+
+    def __init__(self, path, fsync_every=32, fsync_interval=1.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.count = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._f = open(path, "a", encoding="utf-8")
+
+    def write(self, record):
+        self._f.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+        self._f.flush()
+        self.count += 1
+        self._unsynced += 1
+
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._unsynced:
+            os.fsync(self._f.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self._f.closed:
+            self.sync()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_jsonl(path):
+    """Yields records from a JSONL file, skipping a torn last line left by a crash."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed line {line_no} in {path}")
+
+
+def load_results(path):
+    """Loads results from either a JSONL sink file or a legacy JSON array."""
+    if path.endswith(".jsonl"):
+        return list(iter_jsonl(path))
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return data if isinstance(data, list) else []
+
+
+def export_json(jsonl_path, json_path, dedupe=True):
+    """
+    Compacts the JSONL sink into a pretty JSON array. With `dedupe`, only the latest record
+    per filename is kept (re-runs append new records rather than rewriting old ones).
+    The output is written to a temp file and renamed, so readers never see a partial file.
+    """
+    if dedupe:
+        latest = {}
+        for record in iter_jsonl(jsonl_path):
+            latest.pop(record.get("filename"), None)  # Re-insert so order follows the latest write
+            latest[record.get("filename")] = record
+        records = list(latest.values())
+    else:
+        records = list(iter_jsonl(jsonl_path))
+
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=2, default=str, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, json_path)
+
+    logger.info(f"Exported {len(records)} records from {jsonl_path} to {json_path}")
+    return len(records)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Result sink utilities")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="Build the pretty JSON array from a JSONL result file")
+    export.add_argument("jsonl_path", type=str)
+    export.add_argument("json_path", type=str)
+    export.add_argument("--keep-duplicates", action="store_true", help="Keep every record instead of the latest per filename")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_json(args.jsonl_path, args.json_path, dedupe=not args.keep_duplicates)
@@ -0,0 +1,235 @@
+"""
+Review-queue backends used by human_review_node.
+
+The default backend is a local SQLite database with a unique index on filename, so flagging
+an invoice is a single indexed insert instead of re-reading and rewriting review_queue.json.
+WAL mode plus a busy timeout lets several processes write to the same queue.
+The legacy {"invoice_needs_review": [...]} file can be exported at any time with:
+
+    python review_queue.py export review_queue.db review_queue.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB = "review_queue.db"
+DEFAULT_JSON = "review_queue.json"
+SYNC_INTERVAL = 5.0  # Seconds between sync_review_queue() calls in long-running processes
+
+
+class ReviewQueue:
+    """Interface every backend implements. add() must not block on previous flags."""
+
+    def add(self, filename, reason=None, flagged_fields=None):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def filenames(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def export_json(self, path=DEFAULT_JSON):
+        data = {"invoice_needs_review": list(self.filenames())}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+        logger.info(f"Exported {len(data['invoice_needs_review'])} flagged files to {path}")
+
+
+class SqliteReviewQueue(ReviewQueue):
+    """
+    Buffers flags in memory and writes them with one executemany per batch.
+    Duplicate filenames are ignored by the unique index, keeping the first reason.
+    Callers that report a flag as stored (the run manifest, the service) call flush() first.
+    """
+
+    def __init__(self, path=DEFAULT_DB, batch_size=64, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self.written = 0  # Rows committed by this process
+        self.exported = 0  # `written` as of the last sync_review_queue() export
+
+        self._conn = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS review_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                reason TEXT,
+                flagged_fields TEXT,
+                flagged_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_review_filename ON review_queue(filename)")
+
+    def add(self, filename, reason=None, flagged_fields=None):
+        fields = json.dumps(list(flagged_fields)) if flagged_fields else None
+        self._buffer.append((filename, reason, fields, time.time()))
+
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO review_queue (filename, reason, flagged_fields, flagged_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        self.written += len(rows)
+
+    def filenames(self):
+        self.flush()
+        for (filename,) in self._conn.execute("SELECT filename FROM review_queue ORDER BY id"):
+            yield filename
+
+    def import_json(self, path=DEFAULT_JSON):
+        """Seeds the database from a legacy review_queue.json."""
+        try:
+            with open(path, "r") as f:
+                legacy = json.load(f).get("invoice_needs_review", [])
+        except (json.JSONDecodeError, OSError, AttributeError):
+            return 0
+        for filename in legacy:
+            self.add(filename, reason="imported")
+        self.flush()
+        return len(legacy)
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+class JsonReviewQueue(ReviewQueue):
+    """
+    Legacy single-process backend writing review_queue.json directly.
+    The file is loaded once; membership checks use a set and the file is rewritten per batch.
+    """
+
+    def __init__(self, path=DEFAULT_JSON, batch_size=64):
+        self.path = path
+        self.batch_size = batch_size
+        self._items = []
+        self._dirty = 0
+
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self._items = list(json.load(f).get("invoice_needs_review", []))
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        self._seen = set(self._items)
+
+    def add(self, filename, reason=None, flagged_fields=None):
+        if filename in self._seen:
+            logger.info(f"File {filename} is already in the queue.")
+            return
+        self._seen.add(filename)
+        self._items.append(filename)
+        self._dirty += 1
+        if self._dirty >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._dirty:
+            self.export_json(self.path)
+            self._dirty = 0
+
+    def filenames(self):
+        return iter(self._items)
+
+
+_review_queue = None
+
+
+def configure_review_queue(backend="sqlite", path=None, **kwargs):
+    """Selects the backend used by human_review_node. Call before the workflow runs."""
+    global _review_queue
+    if _review_queue is not None:
+        _review_queue.close()
+
+    if backend == "sqlite":
+        path = path or DEFAULT_DB
+        fresh = not os.path.exists(path)
+        _review_queue = SqliteReviewQueue(path, **kwargs)
+        if fresh and os.path.exists(DEFAULT_JSON):
+            imported = _review_queue.import_json(DEFAULT_JSON)
+            logger.info(f"Imported {imported} entries from {DEFAULT_JSON} into {path}")
+    elif backend == "json":
+        _review_queue = JsonReviewQueue(path or DEFAULT_JSON, **kwargs)
+    else:
+        raise ValueError(f"Unknown review queue backend: {backend}")
+    return _review_queue
+
+
+def get_review_queue():
+    if _review_queue is None:
+        configure_review_queue()
+    return _review_queue
+
+
+def sync_review_queue(export_path=DEFAULT_JSON):
+    """
+    Commits buffered flags and, if any were committed since the last sync, refreshes the JSON view.
+    For processes that never reach close_review_queue() (--watch, the service); call it on a timer.
+    """
+    if _review_queue is None:
+        return
+    _review_queue.flush()
+    if export_path and not isinstance(_review_queue, JsonReviewQueue) and _review_queue.written != _review_queue.exported:
+        _review_queue.export_json(export_path)
+        _review_queue.exported = _review_queue.written
+
+
+async def sync_review_queue_every(interval=SYNC_INTERVAL, export_path=DEFAULT_JSON):
+    """Runs sync_review_queue() every `interval` seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        sync_review_queue(export_path)
+
+
+def close_review_queue(export_path=DEFAULT_JSON):
+    """Flushes pending flags and refreshes the legacy JSON view of the queue."""
+    global _review_queue
+    if _review_queue is None:
+        return
+    if export_path and not isinstance(_review_queue, JsonReviewQueue):
+        _review_queue.export_json(export_path)
+    _review_queue.close()
+    _review_queue = None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Review queue utilities")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="Write the queue in the legacy review_queue.json format")
+    export.add_argument("db_path", type=str, nargs="?", default=DEFAULT_DB)
+    export.add_argument("json_path", type=str, nargs="?", default=DEFAULT_JSON)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        queue = SqliteReviewQueue(args.db_path)
+        queue.export_json(args.json_path)
+        queue.close()
@@ -3,12 +3,16 @@ Some utility tools to run the hf dataset
 
 """
 
-from datasets import load_dataset
-from assesment.main import compile_workflow, main
+from datasets import load_dataset, load_from_disk, Dataset, Image as HFImage
+# Settings are configured through the names main.py imported, so they reach the module objects the pipeline reads
+from assesment.main import compile_workflow, run_pipeline, configure_cache, configure_encoding, ENCODING_PROFILES, enable_metrics, get_metrics
+from assesment.gt_converter import convert_gt, load_ground_truth
+from assesment.evaluate import run_evaluation, METRICS_COLUMNS
+from assesment.log_setup import setup_logging
+import argparse
 import asyncio
 import io
 import os
-import time
 
 DATASET_ID = "Aoschu/German_invoices_dataset_for_donut"
 
@@ -25,86 +29,147 @@ import json
 def extract_text_from_gt(gt_data):
     """
     Converts the complex layout-based GT into a simple key-value dictionary.
+    Labels without a schema mapping are kept under their raw name.
     """
-    parse = gt_data.get('gt_parse', {})
-
-    # 1. Map all words to their coordinates
-    # We create a list of dicts: [{'text': 'Invoice', 'x': 10, 'y': 20...}, ...]
-    words = []
-    transcriptions = parse.get('transcription', [])
-    bboxes = parse.get('bbox', [])
-
-    # Safety check: lengths must match
-    for text, box in zip(transcriptions, bboxes):
-        words.append({
-            'text': text,
-            'x': box['x'],
-            'y': box['y'],
-            'w': box['width'],
-            'h': box['height']
-        })
-
-    # 2. Extract specific fields based on 'label' regions
-    extracted_gt = {}
-    labels = parse.get('label', [])
-
-    for lbl in labels:
-        field_name = lbl['labels'][0]  # e.g., "nam of the company"
-
-        # Define the region of interest from the label
-        lx, ly, lw, lh = lbl['x'], lbl['y'], lbl['width'], lbl['height']
-
-        # Find all words that are predominantly INSIDE this label box
-        matched_words = []
-        for w in words:
-            # Simple center-point check: is the center of the word inside the label box?
-            w_center_x = w['x'] + (w['w'] / 2)
-            w_center_y = w['y'] + (w['h'] / 2)
-
-            if (lx <= w_center_x <= lx + lw) and (ly <= w_center_y <= ly + lh):
-                matched_words.append(w)
-
-        # Sort words by Y (lines) then X (left-to-right) to reconstruct sentences
-        # (Simple sorting, might need tweaking for complex multi-column layouts)
-        matched_words.sort(key=lambda k: (int(k['y']), k['x']))
-
-        full_text = " ".join([w['text'] for w in matched_words])
-
-        # Normalize keys to match your Pydantic model
-        std_key = normalize_key(field_name)
-        extracted_gt[std_key] = full_text
-
-    return extracted_gt
-
-
-def normalize_key(raw_label):
-    """Maps dataset labels to your Agent's schema keys"""
-    mapping = {
-        "nam of the company": "company_name",
-        "address of the company": "company_address",
-        "address of the customer": "vendor_name",  # Verify this mapping based on context
-        "telephone number": "phone_number",
-        "date": "invoice_date",
-        "sum": "total_amount",
-        "IBAN": "iban",
-        # Add others as found in the dataset
-    }
-    return mapping.get(raw_label, raw_label)
-
-def run_donut_dataset():
-    dataset = load_dataset(DATASET_ID)
-    train_data = dataset['train']
-    for i in range(len(train_data)):
-        image = train_data[i]['image']
-        image_bytes = image_to_bytes(image)
-        # clean_json = extract_text_from_gt(json.loads(train_data[i]['ground_truth']))
-        file_name = os.path.basename(json.loads(train_data[i]['ground_truth'])['gt_parse']["ocr"])
+    return convert_gt(gt_data, keep_unmapped=True)
+
+
+def load_donut_dataset(source=DATASET_ID, split="train"):
+    """
+    Loads the dataset from the HF hub id or a local copy (.parquet file, .arrow file or a
+    save_to_disk directory). Images are kept as encoded bytes; decoding happens in the pool.
+    """
+    if source.endswith(".parquet"):
+        data = load_dataset("parquet", data_files=source, split="train")
+    elif source.endswith(".arrow"):
+        data = Dataset.from_file(source)
+    elif os.path.isdir(source):
+        data = load_from_disk(source)
+        if not isinstance(data, Dataset):
+            data = data[split]
+    else:
+        data = load_dataset(source, split=split)
+    return data.cast_column("image", HFImage(decode=False))
+
+
+def select_rows(data, offset=0, limit=None, shard=None):
+    """Applies --shard i/n first, then --offset/--limit within the shard."""
+    if shard:
+        index, num_shards = (int(x) for x in shard.split("/"))
+        data = data.shard(num_shards=num_shards, index=index, contiguous=True)
+    end = len(data) if limit is None else min(len(data), offset + limit)
+    return data.select(range(offset, end)) if (offset or end < len(data)) else data
+
+
+def iter_dataset_jobs(data):
+    """Yields (image_bytes, filename) pairs for run_pipeline, one row at a time."""
+    for row in data:
+        image = row['image']
+        if image.get('bytes'):
+            image_bytes = image['bytes']
+        else:
+            with open(image['path'], 'rb') as f:
+                image_bytes = f.read()
+        file_name = os.path.basename(json.loads(row['ground_truth'])['gt_parse']["ocr"])
+        yield image_bytes, file_name
+
+
+def run_donut_dataset(source=DATASET_ID, concurrency=4, rate=None, offset=0, limit=None, shard=None):
+    """Compiles the graph once and streams every selected row through a single event loop."""
+    data = select_rows(load_donut_dataset(source), offset=offset, limit=limit, shard=shard)
+    app = compile_workflow()
+    output_file = "approved_invoices_donut.jsonl"
+    return asyncio.run(run_pipeline(app, iter_dataset_jobs(data), concurrency, output_file, rate=rate))
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return round(sum(values) / len(values), 4) if values else None
+
+
+def run_profile_sweep(profiles, source=DATASET_ID, concurrency=4, rate=None, offset=0, limit=None, shard=None,
+                      ground_truth=None, report_file="profile_sweep.json"):
+    """
+    Runs the selected rows once per encoding profile (cache off, so every profile hits the model)
+    and scores each run against the ground truth. Reports bytes sent, latency and per-field accuracy.
+    Raises ValueError if the ground truth has no filename keys, and RuntimeError if a profile's
+    predictions cannot be joined with it, instead of reporting a sweep without accuracy.
+    """
+    # Check the join key before any profile spends API calls
+    ground_truth = ground_truth or next((p for p in ("cleaned_ground_truth.jsonl", "cleaned_ground_truth.parquet", "cleaned_ground_truth.json") if os.path.exists(p)), None)
+    if not ground_truth or not load_ground_truth(ground_truth):
+        raise ValueError(f"Ground truth {ground_truth} is missing or has no filenames; regenerate it with: python gt_converter.py")
+    data = select_rows(load_donut_dataset(source), offset=offset, limit=limit, shard=shard)
+    lev = METRICS_COLUMNS.index("levenshtein")
+    exact = METRICS_COLUMNS.index("exact")
+    report = {}
+
+    for profile in profiles:
+        configure_encoding(profile)
+        configure_cache(False)
+        enable_metrics()
         app = compile_workflow()
-        asyncio.run(main(app, None, num_agents=1, test_mode=[file_name, image_bytes]))
-        time.sleep(1)
+        output_file = f"approved_invoices_donut.{profile}.jsonl"
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+        counts = asyncio.run(run_pipeline(app, iter_dataset_jobs(data), concurrency, output_file, rate=rate))
+        summary = get_metrics().summary()
+        sent = [h for name, h in summary["histograms"].items() if name.startswith("llm_request_bytes")]
+        latency = summary["histograms"].get("invoice_seconds", {})
+        input_tokens = sum(v for name, v in summary["counters"].items() if name.startswith("llm_tokens_total") and 'kind="input_tokens"' in name)
+
+        rows = run_evaluation(output_file, ground_truth, report_file=f"evaluation_report.{profile}.txt",
+                              metrics_file=f"evaluation_metrics.{profile}.csv")
+        if rows is None:
+            raise RuntimeError(f"Profile {profile}: predictions in {output_file} could not be joined with {ground_truth}")
+        fields = sorted({row[1] for row in rows})
+        report[profile] = {
+            **counts,
+            "requests": sum(h["count"] for h in sent),
+            "bytes_sent": int(sum(h["sum"] for h in sent)),
+            "input_tokens": input_tokens,
+            "p50_seconds": latency.get("p50"),
+            "p95_seconds": latency.get("p95"),
+            "levenshtein": _mean(row[lev] for row in rows),
+            "fields": {f: {"levenshtein": _mean(r[lev] for r in rows if r[1] == f),
+                           "exact": _mean(r[exact] for r in rows if r[1] == f)} for f in fields},
+        }
+
+    with open(report_file, "w") as f:
+        json.dump({"profiles": {p: ENCODING_PROFILES[p] for p in profiles}, "results": report}, f, indent=2)
+
+    print(f"\n{'PROFILE':<10} | {'APPROVED':<8} | {'MB SENT':<8} | {'KB/REQ':<7} | {'P50 S':<6} | {'P95 S':<6} | {'LEVENSHTEIN'}")
+    for profile, r in report.items():
+        kb = r["bytes_sent"] / r["requests"] / 1024 if r["requests"] else 0.0
+        print(f"{profile:<10} | {r['success']:<8} | {r['bytes_sent'] / 2 ** 20:<8.2f} | {kb:<7.0f} | "
+              f"{r['p50_seconds'] or 0:<6.2f} | {r['p95_seconds'] or 0:<6.2f} | {r['levenshtein']}")
+    print(f"Per-field results written to {report_file}")
+    return report
+
 
 if __name__ == "__main__":
-    run_donut_dataset()
+    parser = argparse.ArgumentParser(description="Run the workflow over the Donut invoice dataset")
+    parser.add_argument("--source", type=str, default=DATASET_ID, help="HF dataset id or local .parquet/.arrow/save_to_disk copy")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of invoices in flight")
+    parser.add_argument("--rate", type=float, default=None, help="Max invoices started per second")
+    parser.add_argument("--offset", type=int, default=0, help="Skip the first N rows")
+    parser.add_argument("--limit", type=int, default=None, help="Process at most N rows")
+    parser.add_argument("--shard", type=str, default=None, help="Process shard i of n, written as i/n")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help="Disable the extraction cache")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached extractions but store the fresh results")
+    parser.add_argument("--sweep_profiles", type=str, default=None,
+                        help="Comma-separated encoding profiles to compare (e.g. original,balanced,compact,tiny)")
+    parser.add_argument("--ground_truth", type=str, default=None, help="Ground truth for the sweep (default: cleaned_ground_truth.*)")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.sweep_profiles:
+        run_profile_sweep(args.sweep_profiles.split(","), args.source, args.concurrency, args.rate, args.offset,
+                          args.limit, args.shard, args.ground_truth)
+    else:
+        configure_cache(not args.no_cache, args.refresh)
+        run_donut_dataset(args.source, args.concurrency, args.rate, args.offset, args.limit, args.shard)
 
 
 
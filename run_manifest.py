@@ -0,0 +1,136 @@
+"""
+Crash-safe per-run manifest.
+
+Every run gets a directory runs/<run-id>/ holding run.json (input path, creation time) and
+manifest.jsonl, an append-only log with one line per state change of an input:
+
+    {"file": "inv_0042.jpg", "status": "pending", "attempts": 1, "ts": ...}
+    {"file": "inv_0042.jpg", "status": "approved", "attempts": 1, "ts": ...}
+
+"pending" is written when an invoice enters the graph, the final status when it leaves it. The
+latest line per file wins, so a run killed at any point leaves an accurate picture: files with
+a final status are done, files that are still pending (or were never reached) are not.
+--workers processes write their own manifest.worker<i>.jsonl next to it; loading reads them all.
+
+    python main.py --input_path invoices/ --num_agents 8 --run_id march
+    python main.py --resume march --num_agents 8                   # unfinished + retryable files
+    python main.py --resume march --num_agents 8 --retry-errors    # only API failures
+"""
+
+import glob
+import json
+import os
+import time
+import logging
+from result_sink import JsonlResultSink, iter_jsonl
+
+logger = logging.getLogger(__name__)
+
+RUNS_DIR = "runs"
+MANIFEST = "manifest.jsonl"
+
+# Final statuses that a resume skips. "errored" (API failure after retries, or a decode step that
+# failed for reasons other than the file, e.g. a broken pool) and "crashed" (exception inside the
+# graph) are retried on resume; "unreadable" files (corrupt or unrecognised content) are not.
+FINISHED = {"approved", "flagged", "duplicate", "unreadable"}
+
+# Graph outcome (safety_check) -> manifest status
+OUTCOME_STATUS = {"pass": "approved", "flagged": "flagged", "errored": "errored", "duplicate": "duplicate"}
+
+
+def new_run_id():
+    return time.strftime("%Y%m%d-%H%M%S")
+
+
+def run_dir(run_id, root=RUNS_DIR):
+    return os.path.join(root, run_id)
+
+
+def create_run(run_id, input_path, root=RUNS_DIR):
+    """Creates runs/<run_id>/ with its run.json. Refuses to reuse an existing run id."""
+    path = run_dir(run_id, root)
+    if run_exists(run_id, root):
+        raise ValueError(f"Run {run_id} already exists; use --resume {run_id} to continue it")
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "run.json"), "w", encoding="utf-8") as f:
+        json.dump({"run_id": run_id, "input_path": os.path.abspath(input_path),
+                   "created": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+    return path
+
+
+def run_exists(run_id, root=RUNS_DIR):
+    return os.path.exists(os.path.join(run_dir(run_id, root), "run.json"))
+
+
+def load_run(run_id, root=RUNS_DIR):
+    if not run_exists(run_id, root):
+        raise ValueError(f"No run {run_id} under {root}/")
+    with open(os.path.join(run_dir(run_id, root), "run.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_statuses(path):
+    """Latest {"status", "attempts"} per file from every manifest file in run directory `path`."""
+    statuses = {}
+    for manifest in sorted(glob.glob(os.path.join(path, "manifest*.jsonl"))):
+        for record in iter_jsonl(manifest):
+            statuses[record["file"]] = {"status": record["status"], "attempts": record.get("attempts", 0)}
+    return statuses
+
+
+def compact(path):
+    """
+    Rewrites the run's manifest files as one manifest.jsonl with a single line per file, so a
+    resumed run reads one line per input no matter how often it was restarted. Not safe while
+    workers are writing; main.py calls it before starting any.
+    """
+    statuses = load_statuses(path)
+    target = os.path.join(path, MANIFEST)
+    tmp_path = target + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for name, entry in statuses.items():
+            f.write(json.dumps({"file": name, **entry}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, target)
+    for shard in glob.glob(os.path.join(path, "manifest.worker*.jsonl")):
+        os.remove(shard)
+    return statuses
+
+
+def should_process(name, statuses, retry_errors=False):
+    """Whether a resumed run picks up `name`. With retry_errors only API failures are replayed."""
+    entry = statuses.get(name)
+    if retry_errors:
+        return entry is not None and entry["status"] == "errored"
+    return entry is None or entry["status"] not in FINISHED
+
+
+def summarize(statuses):
+    counts = {}
+    for entry in statuses.values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    return counts
+
+
+class RunManifest:
+    """Appends status changes for one process. `statuses` (from load_statuses) carries attempt counts over."""
+
+    def __init__(self, path, statuses=None, shard=None):
+        self.path = path
+        filename = MANIFEST if shard is None else f"manifest.worker{shard}.jsonl"
+        self._attempts = {name: entry["attempts"] for name, entry in (statuses or {}).items()}
+        self._sink = JsonlResultSink(os.path.join(path, filename))
+
+    def _write(self, name, status):
+        self._sink.write({"file": name, "status": status, "attempts": self._attempts.get(name, 0), "ts": round(time.time(), 3)})
+
+    def start(self, name):
+        self._attempts[name] = self._attempts.get(name, 0) + 1
+        self._write(name, "pending")
+
+    def finish(self, name, status):
+        self._write(name, status)
+
+    def close(self):
+        self._sink.close()
@@ -0,0 +1,216 @@
+"""
+Long-running HTTP service around the workflow.
+
+The graph is compiled and the Gemini clients are built once at startup, and the decode pool
+stays warm, so a request only pays for decoding and model time. Needs the optional `aiohttp`
+dependency (pip install aiohttp).
+
+    python service.py --port 8080 --num_agents 16
+
+    POST /extract         one invoice: multipart field "file", or the raw image body with ?filename=
+    POST /extract/batch   several invoices as multipart "file" fields, processed concurrently
+    GET  /health          liveness plus configured models and in-flight count
+    GET  /metrics         Prometheus text format
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+import uuid
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from aiohttp import web
+except ImportError:  # Optional dependency, only needed for the service mode
+    web = None
+
+from main import add_pipeline_arguments, configure_pipeline, setup_logger
+from image_prep import prepare_image, get_encoding_profile
+from dedup import configure_dedup, get_dedup_index
+from PIL import UnidentifiedImageError
+from pdf_prep import prepare_pdf, is_pdf, INPUT_ERRORS, UnsupportedInputError
+from blob_store import register_image, release_inputs
+from orchestrator import get_tier_llms
+from review_queue import close_review_queue, get_review_queue, sync_review_queue_every
+from extraction_cache import configure_cache
+from result_sink import JsonlResultSink
+from parquet_sink import ParquetResultSink, invoice_row
+from instrumentation import enable_metrics, get_metrics, observe, inc, export_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionService:
+    """Holds the warm graph and decode pool; one instance per process."""
+
+    def __init__(self, app, num_agents, decode_workers=None, output_file=None, metrics_dir=None, deadline=None,
+                 parquet_dir=None):
+        self.app = app
+        self.deadline = deadline
+        self.decode_workers = decode_workers or os.cpu_count() or 1
+        self.output_file = output_file
+        self.metrics_dir = metrics_dir
+        self.parquet_dir = parquet_dir
+        # Bounds decoded images held in memory; the limiter still governs model concurrency
+        self._slots = asyncio.Semaphore(num_agents)
+        self._pool = None
+        self._sink = None
+        self._parquet = None
+        self._review_sync = None
+        self.in_flight = 0
+        self.started_at = time.time()
+
+    async def start(self, _app=None):
+        self._pool = ProcessPoolExecutor(max_workers=self.decode_workers, mp_context=multiprocessing.get_context("spawn"))
+        if self.output_file:
+            self._sink = JsonlResultSink(self.output_file)
+        if self.parquet_dir:
+            self._parquet = ParquetResultSink(self.parquet_dir)
+        self._review_sync = asyncio.create_task(sync_review_queue_every())
+
+    async def stop(self, _app=None):
+        self._review_sync.cancel()
+        self._pool.shutdown(cancel_futures=True)
+        if self._sink is not None:
+            self._sink.close()
+        if self._parquet is not None:
+            self._parquet.close()
+        close_review_queue()
+        configure_cache(False)
+        configure_dedup(False)
+        if self.metrics_dir:
+            export_metrics(self.metrics_dir, {"service": True})
+
+    async def process(self, raw, filename):
+        """Runs one invoice through the graph and returns the JSON response body."""
+        async with self._slots:
+            self.in_flight += 1
+            started = time.monotonic()
+            inputs = None
+            try:
+                loop = asyncio.get_running_loop()
+                with_dhash = get_dedup_index() is not None
+                try:
+                    if is_pdf(raw):
+                        payload = await prepare_pdf(loop, self._pool, raw, filename, get_encoding_profile(), with_dhash)
+                    else:
+                        payload = await loop.run_in_executor(self._pool, prepare_image, raw, filename, get_encoding_profile(), with_dhash)
+                except (UnsupportedInputError,) + INPUT_ERRORS as e:
+                    # The client's upload is at fault, not the model: 415 for unknown formats, 400 otherwise
+                    logger.warning(f"Rejected {filename}: {e}")
+                    inc("invoices_total", outcome="rejected")
+                    unsupported = isinstance(e, (UnsupportedInputError, UnidentifiedImageError))
+                    return {"filename": filename, "status": "rejected", "error": str(e) or type(e).__name__,
+                            "http_status": 415 if unsupported else 400}
+                inputs = register_image(payload, raw)
+                run = self.app.ainvoke({**inputs, "messages": []})
+                res = await (asyncio.wait_for(run, self.deadline) if self.deadline else run)
+            except asyncio.TimeoutError:
+                logger.warning(f"{filename} missed its {self.deadline:g}s deadline and was cancelled")
+                inc("invoice_deadline_exceeded_total")
+                inc("invoices_total", outcome="errored")
+                return {"filename": filename, "status": "error", "error": "deadline_exceeded"}
+            except Exception as e:
+                logger.error(f"Extraction failed for {filename}: {e}")
+                inc("invoices_total", outcome="crashed")
+                return {"filename": filename, "status": "error", "error": str(e)}
+            finally:
+                if inputs is not None:
+                    release_inputs(inputs)
+                self.in_flight -= 1
+                observe("invoice_seconds", time.monotonic() - started)
+
+        outcome = res.get("safety_check")
+        inc("invoices_total", outcome=outcome, tier=res.get("model_tier") or 0)
+        body = {"filename": filename, "model_tier": res.get("model_tier") or 0}
+        if self._parquet is not None and outcome not in ("duplicate", "errored"):
+            self._parquet.write(invoice_row(filename, "approved" if outcome == "pass" else "flagged", res.get("extraction"),
+                                            res.get("review_reason"), res.get("flagged_fields"),
+                                            get_tier_llms()[body["model_tier"]].name, body["model_tier"],
+                                            round(time.monotonic() - started, 3)))
+        if outcome == "duplicate":
+            invoice = res["extraction"].model_dump() if res.get("extraction") is not None else None
+            return {**body, "status": "duplicate", "duplicate_of": res.get("duplicate_of"), "invoice": invoice}
+        if outcome == "pass":
+            invoice = res["extraction"].model_dump()
+            if self._sink is not None:
+                self._sink.write({**invoice, "filename": filename})
+            return {**body, "status": "approved", "invoice": invoice}
+        if outcome == "errored":
+            return {**body, "status": "error", "error": res.get("review_reason")}
+        get_review_queue().flush()  # A "review" answer promises the flag is stored
+        return {**body, "status": "review", "reason": res.get("review_reason"),
+                "flagged_fields": res.get("flagged_fields") or []}
+
+    async def _uploads(self, request):
+        """Yields (bytes, filename) for every uploaded file in a multipart or raw-body request."""
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename or part.name == "file":
+                    yield await part.read(), part.filename or f"{uuid.uuid4().hex}.jpg"
+        else:
+            yield await request.read(), request.query.get("filename") or f"{uuid.uuid4().hex}.jpg"
+
+    async def extract(self, request):
+        uploads = [u async for u in self._uploads(request)]
+        if len(uploads) != 1 or not uploads[0][0]:
+            raise web.HTTPBadRequest(text="Expected exactly one invoice image")
+        result = await self.process(*uploads[0])
+        status = result.get("http_status") or (502 if result["status"] == "error" else 200)
+        return web.json_response(result, status=status)
+
+    async def extract_batch(self, request):
+        uploads = [u async for u in self._uploads(request)]
+        if not uploads:
+            raise web.HTTPBadRequest(text="No invoice images in the request")
+        results = await asyncio.gather(*(self.process(raw, name) for raw, name in uploads))
+        return web.json_response({"results": results})
+
+    async def health(self, request):
+        return web.json_response({
+            "status": "ok",
+            "models": [llm.name for llm in get_tier_llms()],
+            "in_flight": self.in_flight,
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+        })
+
+    async def metrics(self, request):
+        return web.Response(text=get_metrics().to_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+def build_app(service, max_upload_mb=50):
+    app = web.Application(client_max_size=int(max_upload_mb * 1024 * 1024))
+    app.router.add_post("/extract", service.extract)
+    app.router.add_post("/extract/batch", service.extract_batch)
+    app.router.add_get("/health", service.health)
+    app.router.add_get("/metrics", service.metrics)
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Invoice extraction HTTP service")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--num_agents", type=int, default=8, help="Invoices processed concurrently")
+    parser.add_argument("--decode_workers", type=int, default=None, help="Processes used to decode/encode images (default: CPU count)")
+    parser.add_argument("--output_file", type=str, default=None, help="Also append approved invoices to this JSONL file")
+    parser.add_argument("--max_upload_mb", type=float, default=50, help="Largest accepted request body")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args()
+    setup_logger(args)
+
+    if web is None:
+        raise SystemExit("service.py needs aiohttp: pip install aiohttp")
+
+    # /metrics is always served, so instrumentation is on before the graph is compiled
+    enable_metrics()
+    graph = configure_pipeline(args, args.num_agents, args.rps, args.tpm)
+    service = ExtractionService(graph, args.num_agents, args.decode_workers, args.output_file, args.metrics_dir,
+                                args.deadline, args.parquet_dir)
+    web.run_app(build_app(service, args.max_upload_mb), host=args.host, port=args.port)
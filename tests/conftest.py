@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root; orchestrator builds the real Gemini clients at import,
+# they are swapped for fakes before any call is made
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GOOGLE_API_KEY", "offline-tests")
+
+import orchestrator
+from extraction_cache import configure_cache
+from dedup import configure_dedup
+from review_queue import close_review_queue
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Runs the test inside tmp_path with a fresh limiter, no cache and no dedup index."""
+    monkeypatch.chdir(tmp_path)
+    orchestrator.limiter.configure(max_concurrency=4)
+    configure_cache(False)
+    configure_dedup(False)
+    yield tmp_path
+    close_review_queue(None)
+    configure_dedup(False)
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from bench import configure_fake_tiers, make_invoice_images
+from dedup import DEFAULT_MAX_DISTANCE, DedupIndex, configure_dedup, dhash
+from fake_llm import fake_invoice
+from invoice_agents import dedup_key_node, dedup_node
+from main import compile_workflow, iter_image_paths, run_pipeline
+from review_queue import configure_review_queue
+
+
+def hashes_of(folder):
+    paths = sorted(iter_image_paths(folder))
+    hashes = []
+    for path in paths:
+        with open(path, "rb") as f:
+            hashes.append(dhash(f.read()))
+    return paths, hashes
+
+
+def test_same_template_invoices_are_both_written(workdir):
+    # The bench invoices share a noise background and layout, and differ only in their text
+    images = make_invoice_images(str(workdir / "in"), 2, (1240, 1754))
+    (first, second), (first_hash, second_hash) = hashes_of(images)
+    configure_fake_tiers({"latency": 0.0, "seed": 0})
+    configure_review_queue("sqlite", "review_queue.db")
+    index = configure_dedup(True, "dedup_index.db")
+    jobs = [(first, None), (second, None)]
+
+    # One agent, so the first invoice is recorded before the second is looked up
+    counts = asyncio.run(run_pipeline(compile_workflow(), jobs, 1, "approved.jsonl", decode_workers=1,
+                                      review_export=None))
+
+    assert index.find_image(second_hash, exclude=os.path.basename(second))[0] == os.path.basename(first)
+    assert counts["success"] == 2 and counts["duplicate"] == 0
+    with open("approved.jsonl", encoding="utf-8") as f:
+        assert len([json.loads(line) for line in f]) == 2
+
+
+def test_lookups_skip_the_same_file(workdir):
+    images = make_invoice_images(str(workdir / "in"), 1, (600, 850))
+    _, (hashes,) = hashes_of(images)
+    index = DedupIndex("dedup_index.db")
+    invoice = fake_invoice()
+    index.remember("a.jpg", "pass", invoice, hashes)
+
+    assert index.find_image(hashes, exclude="a.jpg") is None
+    assert index.find_image(hashes, exclude="b.jpg")[0] == "a.jpg"
+    index.close()
+
+
+def test_image_candidate_needs_the_same_number_and_amount(workdir):
+    images = make_invoice_images(str(workdir / "in"), 1, (600, 850))
+    _, (hashes,) = hashes_of(images)
+    index = configure_dedup(True, "dedup_index.db")
+    invoice = fake_invoice()
+    index.remember("a.jpg", "pass", invoice, hashes)
+
+    async def check(extraction):
+        state = {"image_path": "b.jpg", "image_dhash": hashes}
+        state.update(await dedup_node(state))
+        assert state["image_match"][0] == "a.jpg"
+        return await dedup_key_node({**state, "extraction": extraction, "safety_check": "pass"})
+
+    other = invoice.model_copy(deep=True)
+    other.invoice_number.value = "R-2"
+    other.iban.value = None  # No business key either
+    assert asyncio.run(check(other)) == {}
+
+    copy = invoice.model_copy(deep=True)
+    copy.iban.value = None
+    assert asyncio.run(check(copy))["duplicate_of"] == "a.jpg"
+
+
+def test_max_distance_is_capped_by_the_bands(workdir):
+    with pytest.raises(ValueError):
+        DedupIndex("dedup_index.db", max_distance=DEFAULT_MAX_DISTANCE + 1)
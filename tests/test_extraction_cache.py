@@ -0,0 +1,44 @@
+import sqlite3
+
+from extraction_cache import ExtractionCache
+
+PAYLOAD = "x" * 1024
+
+
+def stored_bytes(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+
+
+def test_processes_sharing_the_file_keep_it_under_budget(workdir):
+    # Two caches on one file stand in for two --workers processes
+    first = ExtractionCache("cache.db", max_mb=0.05)
+    second = ExtractionCache("cache.db", max_mb=0.05)
+    for i in range(100):
+        (first if i % 2 else second).put(f"k{i}", PAYLOAD)
+        assert first.total() == second.total() == stored_bytes("cache.db") <= first.max_bytes
+
+    # The most recently written entries survive
+    assert first.get("k99") == PAYLOAD and first.get("k0") is None
+    first.close()
+    second.close()
+
+
+def test_replacing_an_entry_counts_its_new_size(workdir):
+    cache = ExtractionCache("cache.db")
+    cache.put("k", PAYLOAD)
+    cache.put("k", PAYLOAD * 2)
+    assert cache.total() == stored_bytes("cache.db") == 2 * len(PAYLOAD)
+    cache.close()
+
+
+def test_existing_cache_files_are_sized_on_open(workdir):
+    with sqlite3.connect("cache.db") as conn:
+        conn.execute("CREATE TABLE extractions (key TEXT PRIMARY KEY, payload TEXT NOT NULL, "
+                     "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        conn.execute("INSERT INTO extractions VALUES ('k', ?, ?, 0)", (PAYLOAD, len(PAYLOAD)))
+    conn.close()
+
+    cache = ExtractionCache("cache.db")
+    assert cache.total() == len(PAYLOAD)
+    cache.close()
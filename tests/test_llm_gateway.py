@@ -0,0 +1,163 @@
+import asyncio
+
+import pytest
+
+from fake_llm import FakeAPIError, FakeStructuredLLM
+from llm_gateway import (
+    AdaptiveLimiter, RetryPolicy, ThrottledLLM, TransientLLMError, classify_error, hedge_settings,
+)
+from orchestrator import FAST_MODEL_NAME, GermanInvoice, build_chat_model
+
+
+class ScriptedLLM:
+    """Raises the queued errors in order, then answers like the fake client."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+        self._fake = FakeStructuredLLM(latency=0, seed=0)
+
+    async def ainvoke(self, messages, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return await self._fake.ainvoke(messages, **kwargs)
+
+
+def throttled_llm(runnable, max_attempts=3, **limiter_kwargs):
+    limiter = AdaptiveLimiter(**limiter_kwargs)
+    return ThrottledLLM(runnable, limiter, RetryPolicy(max_attempts=max_attempts, base_delay=0.0), name="test")
+
+
+@pytest.mark.parametrize("exc, kind", [
+    (FakeAPIError(429, "RESOURCE_EXHAUSTED"), "throttled"),
+    (FakeAPIError(503, "UNAVAILABLE"), "transient"),
+    (FakeAPIError(400, "INVALID_ARGUMENT"), None),
+    (asyncio.TimeoutError(), "transient"),
+    (ConnectionResetError(104, "Connection reset by peer"), "transient"),
+    (OSError("Network is unreachable"), "transient"),
+    (ValueError("Model returned no structured output"), None),
+    (RuntimeError("503 UNAVAILABLE: the service is currently unavailable"), "transient"),
+    (RuntimeError("Resource has been exhausted (e.g. check quota)."), "throttled"),
+    (ValueError("invoice_number R-15003 failed validation"), None),
+    (ValueError("Expected 5000 bytes, got 4291"), None),
+])
+def test_classify_error(exc, kind):
+    assert classify_error(exc)[0] == kind
+
+
+def test_classify_error_aiohttp():
+    aiohttp = pytest.importorskip("aiohttp")
+    assert classify_error(aiohttp.ClientPayloadError("Response payload is not completed"))[0] == "transient"
+    assert classify_error(aiohttp.ServerDisconnectedError())[0] == "transient"
+
+
+def test_sdk_retries_are_disabled():
+    # ThrottledLLM is the only retry layer; SDK retries would hide 429s from the limiter
+    assert build_chat_model(FAST_MODEL_NAME).max_retries == 1
+
+
+def test_retry_after_is_honoured():
+    assert classify_error(FakeAPIError(429, retry_after=7)) == ("throttled", 7.0)
+
+
+def test_transient_errors_are_retried():
+    runnable = ScriptedLLM(FakeAPIError(503, "UNAVAILABLE"), ConnectionResetError(104, "reset"))
+    llm = throttled_llm(runnable)
+
+    result = asyncio.run(llm.ainvoke(["invoice"]))
+
+    assert isinstance(result, GermanInvoice)
+    assert runnable.calls == 3
+    assert llm.retries == 2
+    assert llm.limiter._in_flight == 0
+
+
+def test_gives_up_after_max_attempts():
+    runnable = ScriptedLLM(*[FakeAPIError(503, "UNAVAILABLE")] * 5)
+    llm = throttled_llm(runnable, max_attempts=3)
+
+    with pytest.raises(TransientLLMError):
+        asyncio.run(llm.ainvoke(["invoice"]))
+    assert runnable.calls == 3
+    assert llm.limiter._in_flight == 0
+
+
+def test_permanent_errors_are_not_retried():
+    runnable = ScriptedLLM(FakeAPIError(400, "INVALID_ARGUMENT"))
+    llm = throttled_llm(runnable)
+
+    with pytest.raises(FakeAPIError):
+        asyncio.run(llm.ainvoke(["invoice"]))
+    assert runnable.calls == 1
+    assert llm.retries == 0
+
+
+def test_throttling_halves_the_limit_once_per_window():
+    runnable = ScriptedLLM(FakeAPIError(429, "RESOURCE_EXHAUSTED"), FakeAPIError(429, "RESOURCE_EXHAUSTED"))
+    llm = throttled_llm(runnable, max_concurrency=8)
+
+    asyncio.run(llm.ainvoke(["invoice"]))
+
+    # Two 429s within a second count as one decrease (8 -> 4), then the success adds 1/limit
+    assert llm.throttled == 2
+    assert llm.limiter.limit == pytest.approx(4.25)
+
+
+def test_limit_recovers_additively_and_respects_bounds():
+    limiter = AdaptiveLimiter(max_concurrency=4, min_concurrency=2, initial_concurrency=2)
+
+    async def cycle(outcome):
+        await limiter.acquire()
+        await limiter.release(outcome)
+
+    async def run():
+        await cycle("throttled")
+        assert limiter.limit == 2  # Never below min_concurrency
+        for _ in range(20):
+            await cycle("ok")
+
+    asyncio.run(run())
+    assert limiter.limit == 4  # Never above max_concurrency
+
+
+def test_persistent_throttling_from_the_fake():
+    llm = throttled_llm(FakeStructuredLLM(latency=0, throttle_rate=1.0, seed=0), max_attempts=2, max_concurrency=8)
+
+    with pytest.raises(TransientLLMError):
+        asyncio.run(llm.ainvoke(["invoice"]))
+    assert llm.throttled == 2
+    assert llm.limiter.limit == 4
+
+
+def run_hedged(workers, max_concurrency, monkeypatch, calls_per_worker=40):
+    monkeypatch.setitem(hedge_settings, "max_ratio", 0.5)
+    monkeypatch.setitem(hedge_settings, "quantile", 0.5)
+    monkeypatch.setitem(hedge_settings, "min_samples", 5)
+    fake = FakeStructuredLLM(latency=0.005, latency_dist="lognormal", latency_sigma=1.0, seed=1)
+    llm = throttled_llm(fake, max_concurrency=max_concurrency)
+
+    async def worker():
+        for _ in range(calls_per_worker):
+            await llm.ainvoke(["invoice"])
+
+    async def run():
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        await asyncio.sleep(0.05)  # Let the losers' slot releases run
+
+    asyncio.run(run())
+    return fake, llm
+
+
+def test_hedges_counted_are_hedges_sent(monkeypatch):
+    # Every slot held by a worker, as with --num_agents == max_concurrency: no room to hedge
+    fake, llm = run_hedged(workers=4, max_concurrency=4, monkeypatch=monkeypatch)
+    assert fake.calls - llm.calls == llm.hedges
+    assert llm.limiter._in_flight == 0
+
+
+def test_hedges_use_free_slots(monkeypatch):
+    fake, llm = run_hedged(workers=1, max_concurrency=4, monkeypatch=monkeypatch)
+    assert llm.hedges > 0
+    assert fake.calls - llm.calls == llm.hedges
+    assert llm.limiter._in_flight == 0
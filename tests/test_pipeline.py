@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sqlite3
+
+import orchestrator
+import review_queue
+from bench import configure_fake_tiers, make_invoice_images
+from llm_gateway import RetryPolicy
+from main import compile_workflow, run_jobs, run_pipeline
+from review_queue import configure_review_queue
+from run_manifest import RunManifest, create_run, load_statuses
+
+COUNT = 3
+
+
+def run(input_dir, run_path, statuses=None):
+    manifest = RunManifest(run_path, statuses)
+    jobs = run_jobs(str(input_dir), statuses)
+    return asyncio.run(run_pipeline(compile_workflow(), jobs, 2, "approved.jsonl", decode_workers=1,
+                                    review_export=None, manifest=manifest))
+
+
+def fake_tiers(**fake_kwargs):
+    llms = configure_fake_tiers({"latency": 0.0, "seed": 0, **fake_kwargs})
+    for llm in llms:
+        llm.retry = RetryPolicy(max_attempts=2, base_delay=0.0)
+    return llms
+
+
+def fake_calls():
+    return sum(fake.calls for chat in orchestrator.tier_chat_models for fake in chat.structured)
+
+
+def crash_without_close(export_path=None):
+    """Stands in for close_review_queue() in a process that dies: nothing buffered gets written."""
+    queue = review_queue._review_queue
+    review_queue._review_queue = None
+    queue._buffer.clear()
+    queue._conn.close()
+
+
+def test_api_errors_end_as_errored_and_are_retried_on_resume(workdir):
+    images = make_invoice_images(str(workdir / "in"), COUNT, (600, 850))
+    fake_tiers(error_rate=1.0)
+    configure_review_queue("sqlite", "review_queue.db")
+    run_path = create_run("errors", images)
+
+    counts = run(images, run_path)
+
+    assert counts["errored"] == COUNT and counts["success"] == counts["fail"] == 0
+    statuses = load_statuses(run_path)
+    assert {entry["status"] for entry in statuses.values()} == {"errored"}
+    assert len(list(run_jobs(images, statuses))) == COUNT
+    with sqlite3.connect("review_queue.db") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM review_queue").fetchone()[0] == 0
+    assert not os.path.exists("approved.jsonl") or os.path.getsize("approved.jsonl") == 0
+
+
+def test_flagged_invoices_survive_a_crash_and_are_skipped_on_resume(workdir, monkeypatch):
+    images = make_invoice_images(str(workdir / "in"), COUNT, (600, 850))
+    fake_tiers(low_conf_rate=1.0)
+    # Nothing reaches the database unless the pipeline commits it itself
+    configure_review_queue("sqlite", "review_queue.db", batch_size=1000, flush_interval=3600)
+    monkeypatch.setattr("main.close_review_queue", crash_without_close)
+    run_path = create_run("flagged", images)
+
+    counts = run(images, run_path)
+
+    assert counts["fail"] == COUNT
+    statuses = load_statuses(run_path)
+    assert {entry["status"] for entry in statuses.values()} == {"flagged"}
+    with sqlite3.connect("review_queue.db") as conn:
+        flagged = {os.path.basename(name) for (name,) in conn.execute("SELECT filename FROM review_queue")}
+    assert flagged == set(statuses)
+
+    # The resumed run has nothing left to do
+    calls = fake_calls()
+    configure_review_queue("sqlite", "review_queue.db")
+    counts = run(images, run_path, statuses)
+    assert counts == {"success": 0, "fail": 0, "errored": 0, "duplicate": 0}
+    assert fake_calls() == calls
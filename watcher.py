@@ -0,0 +1,127 @@
+"""
+Directory watch mode: new images and PDFs dropped into a folder are fed into the running pipeline.
+
+Uses inotify through the optional `inotify_simple` package (pip install inotify_simple) and
+falls back to polling the folder elsewhere. With inotify the watcher sleeps on the inotify file
+descriptor, so an idle folder costs nothing; polling lists the folder every `poll_interval`.
+
+Files are handed over once their size and mtime have not changed for `debounce` seconds, so
+images that are still being copied or uploaded are never read half-written.
+"""
+
+import asyncio
+import contextlib
+import os
+import time
+import logging
+from pdf_prep import INPUT_EXTENSIONS
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Optional dependency, polling is used without it
+    INotify = None
+
+logger = logging.getLogger(__name__)
+
+
+
+class DirectoryWatcher:
+    """
+    Async iterator of (path, None) jobs for every image that appears in `folder`, including the
+    ones already there at start. Names in `seen` (e.g. finished files from the run manifest) are
+    skipped, and every name is handed over at most once. Iteration ends after stop().
+    """
+
+    def __init__(self, folder, seen=(), debounce=1.0, poll_interval=2.0, use_inotify=True):
+        self.folder = folder
+        self.seen = set(seen)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and INotify is not None
+        self._pending = {}  # name -> ((size, mtime_ns), monotonic time the file last changed)
+        self._wake = None
+        self._stopped = False
+
+    @property
+    def backend(self):
+        return "inotify" if self.use_inotify else "polling"
+
+    def stop(self):
+        self._stopped = True
+        if self._wake is not None:
+            self._wake.set()
+
+    def _add(self, name):
+        if name.endswith(INPUT_EXTENSIONS) and name not in self.seen and name not in self._pending:
+            self._pending[name] = (None, time.monotonic())
+
+    def _scan(self):
+        for entry in os.scandir(self.folder):
+            if entry.is_file():
+                self._add(entry.name)
+
+    def _on_events(self, inotify):
+        for event in inotify.read(timeout=0):
+            if event.mask & flags.Q_OVERFLOW:
+                logger.warning(f"inotify queue overflowed, rescanning {self.folder}")
+                self._scan()
+            elif event.name:
+                self._add(event.name)
+        self._wake.set()
+
+    def _settled(self):
+        """Names whose size and mtime held still for `debounce` seconds; forgets files that vanished."""
+        now = time.monotonic()
+        ready = []
+        for name, (signature, changed_at) in list(self._pending.items()):
+            try:
+                st = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                del self._pending[name]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != signature:
+                self._pending[name] = (current, now)
+            elif st.st_size > 0 and now - changed_at >= self.debounce:
+                del self._pending[name]
+                ready.append(name)
+        return ready
+
+    async def _sleep(self, timeout):
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        self._wake.clear()
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        inotify = None
+        if self.use_inotify:
+            inotify = INotify()
+            # CLOSE_WRITE: a writer finished; MOVED_TO: an atomic rename into the folder
+            inotify.add_watch(self.folder, flags.CLOSE_WRITE | flags.MOVED_TO)
+            loop.add_reader(inotify.fileno(), self._on_events, inotify)
+        logger.info(f"Watching {self.folder} for new invoices ({self.backend})")
+        try:
+            self._scan()
+            next_poll = time.monotonic() + self.poll_interval
+            while not self._stopped:
+                for name in self._settled():
+                    self.seen.add(name)
+                    yield os.path.join(self.folder, name), None
+                if inotify is None and time.monotonic() >= next_poll:
+                    self._scan()
+                    next_poll = time.monotonic() + self.poll_interval
+                    continue
+                if self._pending:
+                    timeout = self.debounce / 2
+                elif inotify is None:
+                    timeout = max(0.0, next_poll - time.monotonic())
+                else:
+                    timeout = None  # Nothing to settle: sleep until inotify or stop() wakes us
+                await self._sleep(timeout)
+        finally:
+            if inotify is not None:
+                loop.remove_reader(inotify.fileno())
+                inotify.close()
+            logger.info(f"Stopped watching {self.folder}")